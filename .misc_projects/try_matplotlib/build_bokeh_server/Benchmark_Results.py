@@ -0,0 +1,494 @@
+# Benchmarks for the history file writers and readers in Save_Results.py.
+# Run with `poetry run ./.misc_projects/try_matplotlib/build_bokeh_server/Benchmark_Results.py`
+# Everything is written to a temporary directory that is deleted afterwards.
+
+import csv
+import io
+import shutil
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timedelta
+from collections.abc import Callable
+from typing import Any
+from dataclasses import dataclass, field
+
+from Save_Results import (
+    EnvironmentLogData, _HistFileManager, _EnvironmentStateHistoryLogger, FlushPolicy,
+    WriterThreadPolicy, QueueFullPolicy, read_state_history_file, HistoryFormat, HistoryCompression,
+    convert_history_file, ENVIRONMENT_CODEC, CSV_TIME_FORMAT, _datetime_to_ns, _ns_to_datetime,
+    _ControllerHistoryLogger, ControllerLogData, CtrlLogTarget, start_results_run, ResultsDatabase,
+    EnvironmentDirectories, save_to_context_file, targets_include, now_ns, merge_histories, _CtrlFileManager, time_index_file,
+)
+from Results_Catalog import ResultsCatalog
+from File_Management import LocalPath
+
+def _environment_rows(count:int) -> list[EnvironmentLogData]:
+    "A run's worth of fake environment history, filling and emptying like the simulation does. Times aren't whole microseconds, like LogClock's."
+    start = _datetime_to_ns(datetime(2026, 1, 1)) + 789
+    level, pump = 0.0, True
+    out = []
+    for i in range(count):
+        level += 2.5 if pump else -2.5
+        if level >= 75: pump = False
+        if level <= 25: pump = True
+        out.append(EnvironmentLogData(water_level=level, pump_active=pump, upper_sensor_active=level >= 75,
+                                      lower_sensor_active=level >= 25, time_ns=start + 500_000_000*i))
+    return out
+
+def _print_rate(name:str, rows:int, seconds:float) -> None:
+    print(f"{name:<40} {rows/seconds:>12,.0f} rows/sec  ({seconds*1000:.1f} ms for {rows:,} rows)")
+
+def _legacy_save(file:Path, datas:list[EnvironmentLogData]) -> None:
+    "How rows were written before: reopening the file and making a csv.writer for every row."
+    with open(file=file, mode='w') as f:
+        _HistFileManager.write_headers(csv.writer(f))
+    for data in datas:
+        with open(file=file, mode='a') as f:
+            _HistFileManager.write_data(csv.writer(f), data)
+
+def bench_history_writer(rows:int=100_000) -> None:
+    print("="*25+"[ History Writer ]"+"="*25)
+    datas = _environment_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        file = Path(directory) / "EnvironmentHistory.csv"
+
+        start = time.perf_counter()
+        _legacy_save(file, datas)
+        _print_rate("Open per row (legacy)", rows, time.perf_counter() - start)
+
+        for policy in (FlushPolicy(max_rows=1), FlushPolicy(max_rows=100), FlushPolicy(max_rows=10_000)):
+            start = time.perf_counter()
+            logger = _EnvironmentStateHistoryLogger(file, policy, writer_thread=None)
+            for data in datas:
+                logger.save(data)
+            logger.close()
+            _print_rate(f"Buffered, flush every {policy.max_rows} rows", rows, time.perf_counter() - start)
+
+        for when_full in QueueFullPolicy:
+            start = time.perf_counter()
+            logger = _EnvironmentStateHistoryLogger(file, FlushPolicy(max_rows=1_000), WriterThreadPolicy(max_queue_rows=1_000, when_full=when_full))
+            for data in datas:
+                logger.save(data)
+            saving = time.perf_counter() - start
+            logger.close()
+            metrics = logger.metrics
+            _print_rate(f"Writer thread ({when_full.value}), caller side", rows, saving)
+            print(f"{'':<40} dropped={metrics.rows_dropped:,} max_queue_depth={metrics.max_queue_depth:,} " #type:ignore
+                  f"write mean/max={metrics.write_time_mean_sec*1000:.2f}/{metrics.write_time_max_sec*1000:.2f} ms") #type:ignore
+
+def _legacy_read_as_dataframe(file:Path) -> pd.DataFrame:
+    "How the environment CSV was read before: python converters called for every cell."
+    def to_bool(x): return x.lower() in ('true', '1', 'yes')
+    converters = {
+        'Time': lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S.%f'),
+        'level': float,
+        'is_pump_on': to_bool,
+        'is_upper_sensor_active': to_bool,
+        'is_lower_sensor_active':to_bool,
+        'is_overflowing':to_bool,
+        'is_empty':to_bool
+    }
+    return pd.read_csv(file, converters=converters)
+
+def bench_history_reader(rows:int=1_000_000) -> None:
+    print("="*25+"[ History Reader ]"+"="*25)
+    with tempfile.TemporaryDirectory() as directory:
+        file = Path(directory) / "EnvironmentHistory.csv"
+        logger = _EnvironmentStateHistoryLogger(file, FlushPolicy(max_rows=10_000), writer_thread=None)
+        for data in _environment_rows(rows):
+            logger.save(data)
+        logger.close()
+
+        start = time.perf_counter()
+        legacy = _legacy_read_as_dataframe(file)
+        legacy_time = time.perf_counter() - start
+        _print_rate("read_as_dataframe, converters (legacy)", rows, legacy_time)
+
+        start = time.perf_counter()
+        vectorized = _HistFileManager.read_as_dataframe(LocalPath(file))
+        vectorized_time = time.perf_counter() - start
+        _print_rate("read_as_dataframe, vectorized", rows, vectorized_time)
+        print(f"{legacy_time/vectorized_time:.1f}x faster, same result: {legacy.equals(vectorized)}")
+
+def bench_time_window(rows:int=1_000_000, window_rows:int=1_000) -> None:
+    "Reading a window of rows at the start, middle and end of a history, through the time index and by scanning from the top."
+    print("="*25+"[ Time Window Reads ]"+"="*25)
+    datas = _environment_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        file = Path(directory) / "EnvironmentHistory.csv"
+        logger = _EnvironmentStateHistoryLogger(file, FlushPolicy(max_rows=10_000), writer_thread=None)
+        for data in datas:
+            logger.save(data)
+        logger.close()
+        index = time_index_file(file).read_bytes()
+
+        for name, first in (("start", 0), ("middle", rows//2), ("end", rows - window_rows)):
+            start, end = datas[first].timestamp, datas[first + window_rows - 1].timestamp
+            began = time.perf_counter()
+            count = sum(1 for _ in read_state_history_file(file, start, end))
+            indexed = time.perf_counter() - began
+
+            began = time.perf_counter()
+            scanned = sum(1 for d in read_state_history_file(file) if start <= d.timestamp <= end)
+            scan = time.perf_counter() - began
+            print(f"Window at {name:<7} indexed {indexed*1000:8.1f} ms   scanned {scan*1000:8.1f} ms   ({count:,}/{scanned:,} rows)")
+            assert count == scanned == window_rows
+        assert time_index_file(file).read_bytes() == index, "The time index the writer kept was rebuilt on read."
+
+def bench_compression(rows:int=1_000_000) -> None:
+    "Size and writer CPU cost of each compression codec, in both formats, flushing every 10,000 rows like a live run would."
+    print("="*25+"[ Compressed History Output ]"+"="*25)
+    datas = _environment_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        for history_format in HistoryFormat:
+            for compression in HistoryCompression:
+                file = (Path(directory) / "EnvironmentHistory").with_suffix(history_format.value + compression.value)
+                start = time.perf_counter()
+                logger = _EnvironmentStateHistoryLogger(file, FlushPolicy(max_rows=10_000), writer_thread=None,
+                                                        history_format=history_format, compression=compression)
+                for data in datas:
+                    logger.save(data)
+                logger.close()
+                writing = time.perf_counter() - start
+                size = file.stat().st_size
+
+                start = time.perf_counter()
+                _HistFileManager.read_as_dataframe(LocalPath(file))
+                reading = time.perf_counter() - start
+                metrics = logger.compression_metrics
+                print(f"{file.name:<28} {size/1024/1024:8.2f} MiB  ratio {metrics.ratio:5.1f}  "
+                      f"compress {metrics.compress_time_per_row_sec*1e6:5.2f} us/row  "
+                      f"write {writing*1000:7.0f} ms  read {reading*1000:6.0f} ms")
+
+def bench_delta_encoding(rows:int=1_000_000) -> None:
+    "Size, write and decode speed of the delta encoding against the CSV and binary formats, and of converting a CSV run offline."
+    print("="*25+"[ Delta Encoded History ]"+"="*25)
+    datas = _environment_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        frames = {}
+        for history_format in HistoryFormat:
+            file = (Path(directory) / "EnvironmentHistory").with_suffix(history_format.value)
+            start = time.perf_counter()
+            logger = _EnvironmentStateHistoryLogger(file, FlushPolicy(max_rows=10_000), writer_thread=None, history_format=history_format)
+            for data in datas:
+                logger.save(data)
+            logger.close()
+            writing = time.perf_counter() - start
+
+            start = time.perf_counter()
+            frames[history_format] = _HistFileManager.read_as_dataframe(LocalPath(file))
+            reading = time.perf_counter() - start
+            size = file.stat().st_size
+            print(f"{file.name:<26} {size/1024/1024:8.2f} MiB  {size/rows:6.2f} bytes/row  "
+                  f"write {writing*1000:6.0f} ms  decode {reading*1000:6.0f} ms ({rows/reading:,.0f} rows/sec)")
+        print(f"Lossless: {(frames[HistoryFormat.delta].values == frames[HistoryFormat.binary].values).all()}")
+
+        source = (Path(directory) / "EnvironmentHistory").with_suffix(HistoryFormat.csv.value)
+        destination = Path(directory) / "Converted.delta"
+        start = time.perf_counter()
+        convert_history_file(source, destination, HistoryFormat.delta)
+        _print_rate("Convert CSV to delta (offline)", rows, time.perf_counter() - start)
+
+@dataclass(frozen=True)
+class _LegacyEnvironmentLogData:
+    "EnvironmentLogData as it was before its timestamps were ns from LogClock: a datetime from datetime.now(), and no slots."
+    water_level             :float      = field()
+    overflowing             :bool       = field(default=False)
+    empty                   :bool       = field(default=False)
+    pump_active             :bool       = field(default=False)
+    upper_sensor_active     :bool       = field(default=False)
+    lower_sensor_active     :bool       = field(default=False)
+    timestamp               :datetime   = field(default_factory=datetime.now)
+
+def _legacy_rows(datas:list[EnvironmentLogData]) -> list[_LegacyEnvironmentLogData]:
+    return [_LegacyEnvironmentLogData(water_level=d.water_level, overflowing=d.overflowing, empty=d.empty, pump_active=d.pump_active,
+                                      upper_sensor_active=d.upper_sensor_active, lower_sensor_active=d.lower_sensor_active,
+                                      timestamp=d.timestamp) for d in datas]
+
+def _legacy_to_row(data:_LegacyEnvironmentLogData) -> list:
+    "The hand-written _HistFileManager._data_to_rows the generated codec replaced."
+    row = []
+    row.append(data.timestamp.strftime(CSV_TIME_FORMAT))
+    row.append(data.water_level)
+    row.append(data.pump_active)
+    row.append(data.upper_sensor_active)
+    row.append(data.lower_sensor_active)
+    row.append(data.overflowing)
+    row.append(data.empty)
+    return row
+
+def _legacy_from_row(row:list[str]) -> _LegacyEnvironmentLogData:
+    "The hand-written CSV row reader, including its bool('False') == True bug."
+    return _LegacyEnvironmentLogData(
+        timestamp           = datetime.strptime(row[0], CSV_TIME_FORMAT),
+        water_level         = float(row[1]),
+        pump_active         = bool(row[2]),
+        upper_sensor_active = bool(row[3]),
+        lower_sensor_active = bool(row[4]),
+        overflowing         = bool(row[5]),
+        empty               = bool(row[6])
+    )
+
+def _legacy_to_record(d:_LegacyEnvironmentLogData) -> tuple:
+    return (_datetime_to_ns(d.timestamp), d.water_level,
+            (1 if d.pump_active else 0) | (2 if d.upper_sensor_active else 0) | (4 if d.lower_sensor_active else 0) |
+            (8 if d.overflowing else 0) | (16 if d.empty else 0))
+
+def _legacy_from_record(values:tuple) -> _LegacyEnvironmentLogData:
+    time_ns, level, flags = values
+    return _LegacyEnvironmentLogData(timestamp=_ns_to_datetime(time_ns), water_level=level, pump_active=bool(flags & 1),
+                              upper_sensor_active=bool(flags & 2), lower_sensor_active=bool(flags & 4),
+                              overflowing=bool(flags & 8), empty=bool(flags & 16))
+
+def bench_row_codec(rows:int=200_000) -> None:
+    "Per-row cost of the generated row codec against the hand-written functions it replaced (on the records of the time, with datetime timestamps)."
+    print("="*25+"[ Row Codec ]"+"="*25)
+    datas = _environment_rows(rows)
+    legacy_datas = _legacy_rows(datas)
+    csv_rows = [[str(v) for v in ENVIRONMENT_CODEC.to_row(d)] for d in datas]
+    records = [ENVIRONMENT_CODEC.to_record(d) for d in datas]
+    cases = (
+        ("CSV row encode",      _legacy_to_row,      ENVIRONMENT_CODEC.to_row,      (legacy_datas, datas)),
+        ("CSV row decode",      _legacy_from_row,    ENVIRONMENT_CODEC.from_row,    (csv_rows, csv_rows)),
+        ("Binary record encode",_legacy_to_record,   ENVIRONMENT_CODEC.to_record,   (legacy_datas, datas)),
+        ("Binary record decode",_legacy_from_record, ENVIRONMENT_CODEC.from_record, (records, records)),
+    )
+    for name, legacy, generated, (legacy_inputs, inputs) in cases:
+        start = time.perf_counter()
+        for x in legacy_inputs: legacy(x)
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for x in inputs: generated(x)
+        generated_time = time.perf_counter() - start
+        print(f"{name:<24} hand-written {legacy_time/rows*1e9:7.0f} ns/row   generated {generated_time/rows*1e9:7.0f} ns/row   "
+              f"({(generated_time-legacy_time)/rows*1e9:+.0f} ns)")
+
+def _allocations(make:Callable[[int],list[Any]], rows:int) -> tuple[int,int]:
+    "The memory blocks and bytes still allocated after making `rows` records (and the list holding them)."
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    made = make(rows)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    statistics = after.compare_to(before, 'filename')
+    del made
+    return sum(s.count_diff for s in statistics), sum(s.size_diff for s in statistics)
+
+def bench_log_records(rows:int=200_000) -> None:
+    "Timestamping, making and writing (as a CSV row and a binary record) a tick's log record, before and after the records held LogClock ns."
+    print("="*25+"[ Log Records ]"+"="*25)
+    def make_legacy(count:int) -> list[Any]:
+        return [_LegacyEnvironmentLogData(water_level=1.5, pump_active=True) for _ in range(count)]
+    def make(count:int) -> list[Any]:
+        return [EnvironmentLogData(water_level=1.5, pump_active=True) for _ in range(count)]
+
+    for name, maker, to_row, to_record in (("datetime.now() (legacy)", make_legacy, _legacy_to_row, _legacy_to_record),
+                                           ("LogClock ns, slots", make, ENVIRONMENT_CODEC.to_row, ENVIRONMENT_CODEC.to_record)):
+        start = time.perf_counter()
+        datas = maker(rows)
+        making = time.perf_counter() - start
+        start = time.perf_counter()
+        for d in datas: to_row(d)
+        rowing = time.perf_counter() - start
+        start = time.perf_counter()
+        for d in datas: to_record(d)
+        recording = time.perf_counter() - start
+        blocks, size = _allocations(maker, rows)
+        print(f"{name:<24} make {making/rows*1e9:5.0f} ns   CSV row {rowing/rows*1e9:5.0f} ns   record {recording/rows*1e9:5.0f} ns   "
+              f"{blocks/rows:4.1f} allocations {size/rows:4.0f} bytes per record")
+
+    start = time.perf_counter()
+    for _ in range(rows): datetime.now()
+    wall = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(rows): now_ns()
+    monotonic = time.perf_counter() - start
+    print(f"Taking a timestamp:      datetime.now() {wall/rows*1e9:.0f} ns   now_ns() {monotonic/rows*1e9:.0f} ns")
+
+def bench_target_bitmask(rows:int=500_000) -> None:
+    "Reading and filtering the targets of controller events, as bits against the sets of target names they used to be."
+    print("="*25+"[ Target Bitmask ]"+"="*25)
+    combinations = [CtrlLogTarget.pump, CtrlLogTarget.ULS, CtrlLogTarget.LLS, CtrlLogTarget.LLS | CtrlLogTarget.pump, CtrlLogTarget.none]
+    targets = [combinations[i % len(combinations)] for i in range(rows)]
+    legacy_text = "Time,targets\n" + "".join(f"2026-01-01 00:00:00.000000,{t.to_string()}\n" for t in targets)
+    bits_text = "Time,targets\n" + "".join(f"2026-01-01 00:00:00.000000,{t.value}\n" for t in targets)
+
+    start = time.perf_counter()
+    legacy = pd.read_csv(io.StringIO(legacy_text), dtype={'targets': 'str'}, keep_default_na=False)
+    target_sets = {t: {n for n in t.split('-') if n != ""} for t in legacy['targets'].unique()}
+    legacy['targets'] = legacy['targets'].map(target_sets)
+    legacy_parse = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_mask = ["pump" in x for x in legacy['targets']]
+    legacy_filter = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bits = pd.read_csv(io.StringIO(bits_text), dtype={'targets': 'str'})
+    bits['targets'] = bits['targets'].map({t: CtrlLogTarget.parse(t).value for t in bits['targets'].unique()}).astype('u1') # As CONTROLLER_CODEC.parse_csv does.
+    bits_parse = time.perf_counter() - start
+    start = time.perf_counter()
+    bits_mask = targets_include(bits['targets'], CtrlLogTarget.pump)
+    bits_filter = time.perf_counter() - start
+    assert list(bits_mask) == legacy_mask
+
+    print(f"{'Parsing the column:':<25}sets {legacy_parse*1000:7.1f} ms   bits {bits_parse*1000:7.1f} ms")
+    print(f"{'Events towards the pump:':<25}sets {legacy_filter*1000:7.1f} ms   bits {bits_filter*1000:7.1f} ms   ({legacy_filter/bits_filter:.0f}x faster)")
+    print(f"{'Column memory:':<25}sets {legacy['targets'].memory_usage(deep=True)/1024/1024:7.1f} MiB  bits {bits['targets'].memory_usage(deep=True)/1024/1024:7.1f} MiB")
+
+def bench_results_database(runs:int=100, rows_per_run:int=20_000) -> None:
+    "Writing many runs to one results database, then finding the pump errors of the runs with a high leak rate."
+    print("="*25+"[ SQLite Results Database ]"+"="*25)
+    datas = _environment_rows(rows_per_run)
+    with tempfile.TemporaryDirectory() as directory:
+        database = Path(directory) / "Results.sqlite"
+        saving = closing = 0.0
+        for r in range(runs):
+            run = start_results_run(database, f"run {r}", {'simulation': {'leak_rate_per_sec': r / 10}})
+            environment = _EnvironmentStateHistoryLogger(Path(directory) / "EnvironmentHistory.csv", FlushPolicy(max_rows=1_000), database_run=run)
+            controller = _ControllerHistoryLogger(Path(directory) / "ControllerHistory.csv", FlushPolicy(max_rows=1_000), database_run=run)
+            start = time.perf_counter()
+            for i, data in enumerate(datas):
+                environment.save(data)
+                if i % 50 == 0:
+                    controller.save(ControllerLogData(is_modbus_error=i % 200 == 0, is_action=i % 200 != 0, time_ns=data.time_ns,
+                                                      targets=CtrlLogTarget.pump, message="Pump write failed" if i % 200 == 0 else "Pump on"))
+            saving += time.perf_counter() - start
+            start = time.perf_counter()
+            environment.close()
+            controller.close()
+            closing += time.perf_counter() - start
+        _print_rate("Saving ticks, caller side", runs*rows_per_run, saving)
+        _print_rate("Saving ticks, including the final flush", runs*rows_per_run, saving + closing)
+        print(f"Database size: {database.stat().st_size/1024/1024:.1f} MiB for {runs} runs")
+
+        results = ResultsDatabase(database)
+        start = time.perf_counter()
+        run_ids = results.run_ids_where('leak_rate_per_sec', '>', 4)
+        errors = results.controller_events(run_ids, is_modbus_error=True, target=CtrlLogTarget.pump)
+        print(f"Pump errors in runs with leak_rate_per_sec > 4: {len(errors):,} events in {len(run_ids)} runs, {(time.perf_counter()-start)*1000:.1f} ms")
+        start = time.perf_counter()
+        window = results.environment_ticks([run_ids[0]], datas[rows_per_run//2].timestamp, datas[rows_per_run//2 + 999].timestamp)
+        print(f"1,000 tick window of one run: {len(window):,} rows, {(time.perf_counter()-start)*1000:.1f} ms")
+        results.close()
+
+def _peak_memory(work:Callable[[],Any]) -> float:
+    "The peak of memory allocated while `work` runs, in MiB."
+    tracemalloc.start()
+    work()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+def bench_merge_histories(rows:int=200_000) -> None:
+    "One timeline of a run's environment and controller histories: loading both and sorting, against the streaming merge (of CSV and mapped binary files)."
+    print("="*25+"[ Merged History Timeline ]"+"="*25)
+    datas = _environment_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        files:dict[HistoryFormat,tuple[Path,Path]] = {}
+        for history_format in (HistoryFormat.csv, HistoryFormat.binary):
+            environment_file = (Path(directory) / "EnvironmentHistory").with_suffix(history_format.value)
+            controller_file = (Path(directory) / "ControllerHistory").with_suffix(history_format.value)
+            environment = _EnvironmentStateHistoryLogger(environment_file, FlushPolicy(max_rows=10_000), writer_thread=None, history_format=history_format)
+            controller = _ControllerHistoryLogger(controller_file, FlushPolicy(max_rows=10_000), writer_thread=None, history_format=history_format)
+            for i, data in enumerate(datas):
+                environment.save(data)
+                if i % 20 == 0: controller.save(ControllerLogData(is_action=True, targets=CtrlLogTarget.pump, message="Pump on", time_ns=data.time_ns))
+            environment.close()
+            controller.close()
+            files[history_format] = (environment_file, controller_file)
+        environment_file, controller_file = files[HistoryFormat.csv]
+
+        def load_and_sort() -> int:
+            environment_frame = _HistFileManager.read_as_dataframe(LocalPath(environment_file))
+            controller_frame = _CtrlFileManager.read_as_dataframe(LocalPath(controller_file))
+            return len(pd.concat([environment_frame, controller_frame]).sort_values('Time', kind='stable'))
+        def merge() -> int:
+            return sum(1 for _ in merge_histories([environment_file, controller_file]))
+        def merge_window() -> int:
+            return sum(1 for _ in merge_histories([environment_file, controller_file], datas[rows//2].timestamp, datas[rows//2 + 999].timestamp))
+        def merge_binary() -> int:
+            return sum(1 for _ in merge_histories(files[HistoryFormat.binary]))
+
+        peaks:dict[str,float] = {}
+        for name, work in (("Load both and sort", load_and_sort), ("Streaming merge", merge), ("Streaming merge, 1,000 row window", merge_window),
+                           ("Streaming merge, binary", merge_binary)):
+            start = time.perf_counter()
+            count = work()
+            seconds = time.perf_counter() - start
+            peaks[name] = _peak_memory(work)
+            print(f"{name:<36} {seconds*1000:8.1f} ms   peak memory {peaks[name]:7.2f} MiB   ({count:,} rows)")
+        assert peaks["Streaming merge, binary"] < 8, "Merging mapped histories read them whole instead of a chunk at a time."
+
+def bench_results_catalog(runs:int=10_000, rows_per_run:int=200) -> None:
+    "Summarizing a sweep of many small runs once, then listing and filtering them from the catalog's manifest."
+    print("="*25+"[ Results Catalog ]"+"="*25)
+    with tempfile.TemporaryDirectory() as directory:
+        root = Path(directory)
+        template = EnvironmentDirectories(root / "template")
+        environment = _EnvironmentStateHistoryLogger(template.history_file_path, FlushPolicy(max_rows=1_000))
+        controller = _ControllerHistoryLogger(template.controller_history_file_path, FlushPolicy(max_rows=1_000))
+        for i, data in enumerate(_environment_rows(rows_per_run)):
+            environment.save(data)
+            if i % 50 == 0: controller.save(ControllerLogData(is_action=True, targets=CtrlLogTarget.pump, message="Pump on", time_ns=data.time_ns))
+        environment.close()
+        controller.close()
+        for r in range(runs):
+            directories = EnvironmentDirectories(root / f"run_{r:05}")
+            shutil.copyfile(template.history_file_path, directories.history_file_path)
+            shutil.copyfile(template.controller_history_file_path, directories.controller_history_file_path)
+            save_to_context_file(directories.context_file_path, {'simulation': {'leak_rate_per_sec': r / 1_000}})
+        shutil.rmtree(root / "template")
+
+        start = time.perf_counter()
+        catalog = ResultsCatalog(root)
+        print(f"Summarizing {len(catalog):,} runs:{'':<11}{time.perf_counter()-start:8.2f} sec")
+        start = time.perf_counter()
+        catalog = ResultsCatalog(root, refresh=False)
+        print(f"Loading the manifest:{'':<20}{(time.perf_counter()-start)*1000:8.1f} ms")
+        start = time.perf_counter()
+        summarized = catalog.refresh()
+        print(f"Refreshing, {summarized} runs changed:{'':<14}{(time.perf_counter()-start)*1000:8.1f} ms")
+        start = time.perf_counter()
+        leaky = catalog.filter(lambda run: run.context.get('simulation.leak_rate_per_sec', 0) > 4 and run.pump_cycles > 0)
+        print(f"Filtering, {len(leaky):,} runs match:{'':<14}{(time.perf_counter()-start)*1000:8.1f} ms")
+        start = time.perf_counter()
+        table = catalog.to_dataframe(['simulation.leak_rate_per_sec'])
+        print(f"As a dataframe, {len(table):,} rows:{'':<14}{(time.perf_counter()-start)*1000:8.1f} ms")
+
+def bench_durability(rows:int=200_000) -> None:
+    "What each fsync policy costs: batches of 100 rows, synced never, on a timer, every few batches and after every batch."
+    print("="*25+"[ Durability ]"+"="*25)
+    datas = _environment_rows(rows)
+    policies = (
+        ("No fsync (OS decides)", FlushPolicy(max_rows=100)),
+        ("fsync every 10 sec", FlushPolicy(max_rows=100, fsync_interval_sec=10)),
+        ("fsync every 1 sec", FlushPolicy(max_rows=100, fsync_interval_sec=1)),
+        ("fsync every 10 batches", FlushPolicy(max_rows=100, fsync_every_flushes=10)),
+        ("fsync every batch", FlushPolicy(max_rows=100, fsync_every_flushes=1)),
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for name, policy in policies:
+            file = Path(directory) / "EnvironmentHistory.csv"
+            start = time.perf_counter()
+            logger = _EnvironmentStateHistoryLogger(file, policy, writer_thread=None)
+            for data in datas:
+                logger.save(data)
+            logger.close()
+            _print_rate(name, rows, time.perf_counter() - start)
+
+if __name__ == "__main__":
+    bench_history_writer()
+    bench_history_reader()
+    bench_time_window()
+    bench_compression()
+    bench_delta_encoding()
+    bench_row_codec()
+    bench_log_records()
+    bench_target_bitmask()
+    bench_results_database()
+    bench_merge_histories()
+    bench_durability()
+    bench_results_catalog()
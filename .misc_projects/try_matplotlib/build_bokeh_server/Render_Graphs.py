@@ -5,9 +5,10 @@ from datetime import datetime, timedelta
 import functools as ft
 from collections.abc import Callable
 from typing import Any
+import numpy as np
 import pandas as pd
 
-from Save_Results import EnvironmentDirectories, _CtrlFileManager, _HistFileManager, CtrlLogTarget
+from Save_Results import EnvironmentDirectories, _CtrlFileManager, _HistFileManager, CtrlLogTarget, targets_include, HistoryTailReader, history_tail
 from File_Management import RemotablePath, RemotablePath, SCPAddress, LocalPath, remotable_open, parse_remotable_path
 
 from bokeh.server.server import Server
@@ -50,6 +51,8 @@ class render_graph_parameters:
     "The the file relating to the history of the event"
     container: container_plot_parameters
     "Parameters needed to plot the container"
+    rollover:int|None = field(default=None)
+    "How many of the latest rows each plot keeps in the browser; older rows are dropped as new ones stream in. None keeps the whole run."
 
 @dataclass
 class parameter_header_values:
@@ -137,17 +140,19 @@ def make_document(doc:Document, parameters:render_graph_parameters):
         for cat in ctrl_categories
     }
 
-    def get_masks(data):
+    def get_masks(data:dict[str,np.ndarray])->dict[str,np.ndarray]:
         """Compute combined boolean masks from raw data columns."""
+        a, e, r = data['is_action'], data['is_modbus_error'], data['is_state_refresh']
+        p, u, l = data['target_pump'], data['target_ULS'], data['target_LLS']
         return {
-            "pump_action":          [(a and p) and not e    for a, e, p  in zip(data['is_action'],   data['is_modbus_error'], data['target_pump'], )],
-            "pump_error":           [a and p and e          for a, e, p  in zip(data['is_action'],   data['is_modbus_error'], data['target_pump'], )],
-            "pump_refresh":         [r and p and not e      for r, e, p  in zip(data['target_pump'], data['is_modbus_error'], data['is_state_refresh'])],
-            "pump_refresh_error":   [r and p and e          for r, e, p  in zip(data['target_pump'], data['is_modbus_error'], data['is_state_refresh'])],
-            "ULS_refresh":          [r and u and not e      for r, e, u  in zip(data['target_ULS'],  data['is_modbus_error'], data['is_state_refresh'])],
-            "ULS_refresh_error":    [r and u and e          for r, e, u  in zip(data['target_ULS'],  data['is_modbus_error'], data['is_state_refresh'])],
-            "LLS_refresh":          [r and l and not e      for r, e, l  in zip(data['target_LLS'],  data['is_modbus_error'], data['is_state_refresh'])],
-            "LLS_refresh_error":    [r and l and e          for r, e, l  in zip(data['target_LLS'],  data['is_modbus_error'], data['is_state_refresh'])],
+            "pump_action":          a & p & ~e,
+            "pump_error":           a & p & e,
+            "pump_refresh":         r & p & ~e,
+            "pump_refresh_error":   r & p & e,
+            "ULS_refresh":          r & u & ~e,
+            "ULS_refresh_error":    r & u & e,
+            "LLS_refresh":          r & l & ~e,
+            "LLS_refresh_error":    r & l & e,
         }
 
     # Create multiple colored bands
@@ -281,28 +286,100 @@ def make_document(doc:Document, parameters:render_graph_parameters):
     
 
 
-    def update(print_results=False):
-
-        def align_signal(signal:bool,index:int)->float:
-            SCALE_SIGNALS:float = 0.9
-            SIGNAL_OFFSET:float = 1.0
-            s = int(signal)
-            s = SCALE_SIGNALS*s + (1-SCALE_SIGNALS)/2
-            return s + SIGNAL_OFFSET*index
+    # The history files only grow while a run is going, so each update reads what was appended since the last one
+    # and streams just those rows to the browser. Everything is sent again only when a new run replaces either file,
+    # or when rows earlier than the run's first row so far turn up, since the times are relative to the start of the run.
+    envt_reader = HistoryTailReader(parameters.history_file) if parameters.history_file is not None else None
+    ctrl_reader = HistoryTailReader(parameters.controller_history_file) if parameters.controller_history_file is not None else None
+    first_time:datetime|None = None
+    "The time of the run's earliest row (environment or controller), that times are plotted relative to. None until there is one."
+
+    def earliest(tail:history_tail|None)->datetime|None:
+        return tail.rows['Time'].min() if tail is not None and len(tail.rows) > 0 else None
+
+    def align_signal(signal:np.ndarray,index:int)->np.ndarray:
+        SCALE_SIGNALS:float = 0.9
+        SIGNAL_OFFSET:float = 1.0
+        return SCALE_SIGNALS*signal.astype(float) + (1-SCALE_SIGNALS)/2 + SIGNAL_OFFSET*index
+
+    def envt_columns(envt_data:pd.DataFrame)->dict[str,Any]:
+        return dict(
+            time                = (envt_data['Time'] - first_time).dt.total_seconds().to_numpy(),
+            level               = envt_data['level'].to_numpy(),
+            is_pump_on          = align_signal(envt_data['is_pump_on'].to_numpy(),index=4),
+            is_upper_sensor_on  = align_signal(envt_data['is_upper_sensor_active'].to_numpy(),index=3),
+            is_lower_sensor_on  = align_signal(envt_data['is_lower_sensor_active'].to_numpy(),index=2),
+            is_overflowing      = align_signal(envt_data['is_overflowing'].to_numpy(),index=1),
+            is_empty            = align_signal(envt_data['is_empty'].to_numpy(),index=0)
+        )
 
-        try:
-            envt_data:pd.DataFrame|None = _HistFileManager.read_as_dataframe(parameters.history_file) if parameters.history_file is not None else None
-            ctrl_data:pd.DataFrame|None = _CtrlFileManager.read_as_dataframe(parameters.controller_history_file) if parameters.controller_history_file is not None else None
+    def ctrl_columns(ctrl_data:pd.DataFrame)->dict[str,Any]:
+        targets = ctrl_data['targets'].to_numpy()
+        return dict(
+            time                = (ctrl_data['Time'] - first_time).dt.total_seconds().to_numpy(),
+            is_action           = ctrl_data['is_action'].to_numpy(),
+            is_modbus_error     = ctrl_data['is_modbus_error'].to_numpy(),
+            is_state_refresh    = ctrl_data['is_state_refresh'].to_numpy(),
+            target_pump         = targets_include(targets, CtrlLogTarget.pump),
+            target_ULS          = targets_include(targets, CtrlLogTarget.ULS),
+            target_LLS          = targets_include(targets, CtrlLogTarget.LLS),
+            message             = ctrl_data['message'].to_numpy(dtype=object)
+        )
 
-            tmp_min = []
-            if envt_data is not None: tmp_min.append(envt_data['Time'].min())
-            if ctrl_data is not None: tmp_min.append(ctrl_data['Time'].min())
-            first_time = min(*tmp_min) if len(tmp_min) > 1 else (tmp_min[0] if len(tmp_min) == 1 else datetime.max) # If no max time, set to datetime.max
+    def category_columns(ctrl:dict[str,Any])->dict[str,dict[str,Any]]:
+        masks = get_masks(ctrl)
+        return {
+            cat: dict(
+                time    = ctrl['time'][masks[cat]],
+                y       = np.full(np.count_nonzero(masks[cat]), ctrl_y_index[i]),
+                message = ctrl['message'][masks[cat]]
+            )
+            for i, cat in enumerate(ctrl_categories)
+        }
 
-            if envt_data is not None: envt_data['rel_time'] = (envt_data['Time'] - first_time).dt.total_seconds()
-            if ctrl_data is not None: ctrl_data['rel_time'] = (ctrl_data['Time'] - first_time).dt.total_seconds()
+    def send(source:ColumnDataSource, columns:dict[str,Any], replace:bool)->None:
+        if replace:
+            if parameters.rollover is not None:
+                columns = {name: values[-parameters.rollover:] for name, values in columns.items()}
+            source.data = columns
+        elif len(columns['time']) > 0:
+            source.stream(columns, rollover=parameters.rollover)
 
-            if display_parameters.start_of_file_time is None and first_time < datetime.max: # Update display parameters first time start_of_file_time is calculated
+    def update(print_results=False):
+        nonlocal envt_reader, ctrl_reader, first_time
+        try:
+            envt_tail:history_tail|None = envt_reader.read_new() if envt_reader is not None else None
+            ctrl_tail:history_tail|None = ctrl_reader.read_new() if ctrl_reader is not None else None
+
+            # A new run replaces both files, but not at the same moment. Once either starts over, read the other from the top as well.
+            reset = (envt_tail is not None and envt_tail.reset) or (ctrl_tail is not None and ctrl_tail.reset)
+            # Rows can be flushed after later rows of the other file (the controller's batches are small and slow to fill).
+            # Rows earlier than first_time re-base the plots on them: both files are read again and everything is resent,
+            # rather than clamping those rows to the start or plotting them at a negative time.
+            rebase = not reset and first_time is not None and any(t is not None and t < first_time for t in (earliest(envt_tail), earliest(ctrl_tail)))
+            replace = reset or rebase
+            if replace:
+                if envt_tail is not None and not envt_tail.reset:
+                    envt_reader = HistoryTailReader(parameters.history_file) #type:ignore
+                    envt_tail = envt_reader.read_new()
+                if ctrl_tail is not None and not ctrl_tail.reset:
+                    ctrl_reader = HistoryTailReader(parameters.controller_history_file) #type:ignore
+                    ctrl_tail = ctrl_reader.read_new()
+                first_time = None
+
+            envt_data:pd.DataFrame|None = envt_tail.rows if envt_tail is not None and len(envt_tail.rows) > 0 else None
+            ctrl_data:pd.DataFrame|None = ctrl_tail.rows if ctrl_tail is not None and len(ctrl_tail.rows) > 0 else None
+
+            if replace: # Clear what was sent, in case a new run hasn't written anything yet.
+                for source in [envt_source, ctrl_source, *ctrl_category_sources.values()]:
+                    source.data = {name: [] for name in source.data}
+
+            if first_time is None:
+                tmp_min = [t for t in (earliest(envt_tail), earliest(ctrl_tail)) if t is not None]
+                if len(tmp_min) == 0:
+                    return
+                first_time = min(tmp_min)
+                replace = True # The first rows of the run: send them whole, whether or not the files were just reset.
                 display_parameters.start_of_file_time = first_time
                 update_display_parameters()
 
@@ -310,35 +387,12 @@ def make_document(doc:Document, parameters:render_graph_parameters):
             if print_results: print(ctrl_data)
 
             if envt_data is not None:
-                envt_source.data = dict(
-                    time                = envt_data['rel_time'],
-                    level               = envt_data['level'],
-                    is_pump_on          = [align_signal(b,index=4) for b in envt_data['is_pump_on']],
-                    is_upper_sensor_on  = [align_signal(b,index=3) for b in envt_data['is_upper_sensor_active']],
-                    is_lower_sensor_on  = [align_signal(b,index=2) for b in envt_data['is_lower_sensor_active']],
-                    is_overflowing      = [align_signal(b,index=1) for b in envt_data['is_overflowing']],
-                    is_empty            = [align_signal(b,index=0) for b in envt_data['is_empty']]
-                )
+                send(envt_source, envt_columns(envt_data), replace)
             if ctrl_data is not None:
-                ctrl_source.data = dict(
-                    time                = ctrl_data['rel_time'],
-                    is_action           = ctrl_data['is_action'],
-                    is_modbus_error     = ctrl_data['is_modbus_error'],
-                    is_state_refresh    = ctrl_data['is_state_refresh'],
-                    target_pump         = [CtrlLogTarget.pump in x for x in ctrl_data['targets']],
-                    target_ULS          = [CtrlLogTarget.ULS in x for x in ctrl_data['targets']],
-                    target_LLS          = [CtrlLogTarget.LLS in x for x in ctrl_data['targets']],
-                    message             = ctrl_data['message']
-                )
-
-            masks = get_masks(ctrl_source.data)
-            for i, cat in enumerate(ctrl_categories):
-                mask = masks[cat]
-                ctrl_category_sources[cat].data = dict(
-                    time    = [t for t, b in zip(ctrl_source.data['time'],    mask) if b],
-                    y       = [ctrl_y_index[i]] * sum(mask),
-                    message = [m for m, b in zip(ctrl_source.data['message'], mask) if b]
-                )
+                ctrl = ctrl_columns(ctrl_data)
+                send(ctrl_source, ctrl, replace)
+                for cat, columns in category_columns(ctrl).items():
+                    send(ctrl_category_sources[cat], columns, replace)
 
         except Exception as e:
             log.exception(f"Error: {e}")
@@ -401,7 +455,7 @@ if __name__ == '__main__':
 
 
     _run_bokeh_server(render_graph_parameters(
-        update_interval=1,
+        update_interval=250,
         port_used=8000,
         history_file=HIST_FILE,
         controller_history_file=CTRL_FILE,
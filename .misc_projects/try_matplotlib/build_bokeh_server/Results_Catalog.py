@@ -0,0 +1,219 @@
+# A catalog of the many run directories a parameter sweep produces, each laid out by EnvironmentDirectories.
+# Summary statistics of every run are computed once and cached in a manifest next to the runs (`ResultsCatalog.json`),
+# so listing and filtering thousands of runs doesn't open any of their history files.
+#
+# A run's cached summary is recomputed when any of its files change (their size or modification time), when the run is new,
+# and dropped when the run is deleted. ResultsCatalog.refresh() does that; reading a catalog without refreshing it
+# only reads the manifest.
+
+import dataclasses
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from Save_Results import (
+    EnvironmentDirectories, SegmentedHistory, read_history_dataframe, _flatten_context,
+)
+
+log = logging.getLogger()
+
+_MANIFEST_VERSION = 1
+MANIFEST_FILE_NAME = "ResultsCatalog.json"
+
+@dataclass
+class run_summary:
+    "Statistics of one run, computed from its files once and cached in the catalog's manifest."
+    run:str
+    "The run's directory, relative to the catalog's root."
+    rows:int = field(default=0)
+    "Environment history rows."
+    controller_events:int = field(default=0)
+    start:str|None = field(default=None)
+    "Time of the first environment row (ISO format), None if there are none."
+    end:str|None = field(default=None)
+    duration_sec:float = field(default=0)
+    min_level:float|None = field(default=None)
+    max_level:float|None = field(default=None)
+    overflow_time_sec:float = field(default=0)
+    "How long the tank was overflowing: the time from each overflowing row to the next row."
+    empty_time_sec:float = field(default=0)
+    pump_cycles:int = field(default=0)
+    "Times the pump turned on."
+    controller_actions:int = field(default=0)
+    modbus_errors:int = field(default=0)
+    context:dict[str,Any] = field(default_factory=dict)
+    "The run's context file, flattened to dotted keys (e.g. `simulation.leak_rate_per_sec`)."
+    files:dict[str,list[int]] = field(default_factory=dict)
+    "The [size, mtime_ns] of every file the summary was computed from (by their path in the run's directory, segments included), to notice them changing."
+
+def _run_files(layout:EnvironmentDirectories)->list[str]:
+    "Where each of a run's files is, relative to its out_dir: the environment history and its segment index, the controller history and its segment index, then the context."
+    return [os.path.relpath(file, layout.out_dir) for file in (
+        layout.history_file_path, layout.history_index_file_path, layout.controller_history_file_path,
+        layout.controller_history_index_file_path, layout.context_file_path)]
+
+def _file_signatures(run_directory:str, files:list[str])->dict[str,list[int]]:
+    "The size and modification time of each of the run's files that exist."
+    signatures = {}
+    for file in files:
+        try:
+            stat = os.stat(os.path.join(run_directory, file))
+        except FileNotFoundError:
+            continue
+        signatures[file] = [stat.st_size, stat.st_mtime_ns]
+    return signatures
+
+def _run_signatures(run_directory:str, files:list[str])->dict[str,list[int]]:
+    """
+    The signatures of the run's files (see _run_files), and of the segment files listed in its segment indexes.
+    The open segment grows without its index changing, so the index alone wouldn't show a segmented run changing.
+    """
+    signatures = _file_signatures(run_directory, files)
+    for index in (files[1], files[3]):
+        if index not in signatures: continue
+        try:
+            segments = SegmentedHistory(Path(run_directory, index)).segment_files()
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read the segment index {index} in {run_directory}: {e}")
+            continue
+        signatures.update(_file_signatures(run_directory, [os.path.relpath(s, run_directory) for s in segments]))
+    return signatures
+
+def _read_history(single_file:Path, index_file:Path)->pd.DataFrame|None:
+    "A run's history, whatever its format, compression and segmentation. None if the run didn't write it."
+    if index_file.exists():
+        return SegmentedHistory(index_file).read_dataframe()
+    if single_file.exists():
+        return read_history_dataframe(single_file)
+    return None
+
+def summarize_run(run:str, directories:EnvironmentDirectories)->run_summary:
+    "Computes a run's summary from its files."
+    summary = run_summary(run=run, files=_run_signatures(str(directories.out_dir), _run_files(directories)))
+
+    environment = _read_history(directories.history_file_path, directories.history_index_file_path)
+    if environment is not None and len(environment) > 0:
+        time_ns = environment['Time'].to_numpy().astype('datetime64[ns]').view('<i8')
+        lasts = np.diff(time_ns, append=time_ns[-1]) / 1e9
+        pump = environment['is_pump_on'].to_numpy()
+        level = environment['level'].to_numpy()
+        summary.rows = len(environment)
+        summary.start = environment['Time'].iloc[0].isoformat()
+        summary.end = environment['Time'].iloc[-1].isoformat()
+        summary.duration_sec = float(time_ns[-1] - time_ns[0]) / 1e9
+        summary.min_level = float(np.nanmin(level))
+        summary.max_level = float(np.nanmax(level))
+        summary.overflow_time_sec = float(lasts[environment['is_overflowing'].to_numpy()].sum())
+        summary.empty_time_sec = float(lasts[environment['is_empty'].to_numpy()].sum())
+        summary.pump_cycles = int(pump[0]) + int(np.count_nonzero(~pump[:-1] & pump[1:]))
+
+    controller = _read_history(directories.controller_history_file_path, directories.controller_history_index_file_path)
+    if controller is not None:
+        summary.controller_events = len(controller)
+        summary.controller_actions = int(controller['is_action'].sum())
+        summary.modbus_errors = int(controller['is_modbus_error'].sum())
+
+    if directories.context_file_path.exists():
+        with open(file=directories.context_file_path, mode='r') as f:
+            summary.context = dict(_flatten_context(json.load(f)))
+    return summary
+
+class ResultsCatalog:
+    """
+    The runs below `root`: every directory directly inside it that has an environment history where `layout` puts it.
+    `layout` is an EnvironmentDirectories describing how each run was saved (its out_dir is replaced by each run's directory).
+
+    Summaries are loaded from the manifest; call refresh() to pick up new, changed and deleted runs.
+    """
+    def __init__(self, root:Path, layout:EnvironmentDirectories|None=None, refresh:bool=True):
+        self.root = Path(root)
+        self.layout = layout if layout is not None else EnvironmentDirectories(self.root, create_directories=False)
+        self.manifest_file = self.root / MANIFEST_FILE_NAME
+        self._files = _run_files(self.layout)
+        self._summaries:dict[str,run_summary] = self._load_manifest()
+        if refresh:
+            self.refresh()
+
+    def directories(self, run:str)->EnvironmentDirectories:
+        "Where the run's files are."
+        return dataclasses.replace(self.layout, out_dir=self.root / run, create_directories=False)
+
+    def _load_manifest(self)->dict[str,run_summary]:
+        try:
+            with open(file=self.manifest_file, mode='r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if manifest.get('version') != _MANIFEST_VERSION:
+            log.warning(f"{self.manifest_file} is from another version of the catalog, every run will be summarized again.")
+            return {}
+        return {s['run']: run_summary(**s) for s in manifest['runs']}
+
+    def _save_manifest(self)->None:
+        temporary = self.manifest_file.with_name(self.manifest_file.name + ".tmp")
+        with open(file=temporary, mode='w') as f:
+            json.dump({'version': _MANIFEST_VERSION, 'runs': [asdict(s) for s in self._summaries.values()]}, f)
+        os.replace(temporary, self.manifest_file)
+
+    def refresh(self)->int:
+        """
+        Finds the runs, summarizes the new ones and the ones whose files changed, and forgets the deleted ones.
+        Only the runs' files are stat'ed, unless they changed. Returns how many runs were summarized.
+        """
+        found:dict[str,dict[str,list[int]]] = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    signatures = _run_signatures(entry.path, self._files)
+                    if self._files[0] in signatures or self._files[1] in signatures: # It has an environment history.
+                        found[entry.name] = signatures
+
+        summarized = 0
+        changed = len(set(self._summaries) - set(found)) > 0
+        summaries:dict[str,run_summary] = {}
+        for run, signatures in sorted(found.items()):
+            cached = self._summaries.get(run)
+            if cached is not None and cached.files == signatures:
+                summaries[run] = cached
+                continue
+            directories = self.directories(run)
+            try:
+                summaries[run] = summarize_run(run, directories)
+            except Exception:
+                log.exception(f"Could not summarize the run in {directories.base_directory}, leaving it out of the catalog.")
+                continue
+            summarized += 1
+            changed = True
+        self._summaries = summaries
+        if changed:
+            self._save_manifest()
+        return summarized
+
+    def __len__(self)->int:
+        return len(self._summaries)
+
+    def runs(self)->list[run_summary]:
+        return list(self._summaries.values())
+
+    def get(self, run:str)->run_summary|None:
+        return self._summaries.get(run)
+
+    def filter(self, predicate:Callable[[run_summary],bool])->list[run_summary]:
+        "The runs `predicate` is true for, e.g. `catalog.filter(lambda r: r.context.get('simulation.leak_rate_per_sec', 0) > 4)`."
+        return [s for s in self._summaries.values() if predicate(s)]
+
+    def to_dataframe(self, context_keys:Iterable[str]=())->pd.DataFrame:
+        "One row per run with its statistics, and a column for each of `context_keys`, to filter and sort with pandas."
+        keys = list(context_keys)
+        statistics = [f.name for f in dataclasses.fields(run_summary) if f.name not in ('context', 'files')]
+        data = pd.DataFrame([[getattr(s, f) for f in statistics] + [s.context.get(k) for k in keys] for s in self._summaries.values()],
+                            columns=statistics + keys)
+        for column in ('start', 'end'):
+            data[column] = pd.to_datetime(data[column])
+        return data
@@ -1,20 +1,36 @@
 # This file contains all Classes and objects used to save simulation results to a file.
 
+import dataclasses
 from dataclasses import dataclass, field, is_dataclass, asdict
 from pathlib import Path
-from datetime import datetime
-from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, closing
 import pandas as pd
+import numpy as np
+import asyncio
+import bz2
 import csv
+import gzip
+import heapq
+import io
+import itertools
 import json
+import lzma
+import math
 import os
+import shutil
+import sqlite3
+import zlib
+import time
+import threading
 import logging
-from enum import Enum
+from enum import Enum, IntFlag
+from collections import deque
 
-from File_Management import RemotablePath, remotable_as_local_file
+from File_Management import RemotablePath, LocalPath, remotable_as_local_file
 
-from collections.abc import Iterable, Generator, Iterator
-from typing import Any, Optional, TypeVar
+from collections.abc import Iterable, Generator, Iterator, Callable
+from typing import IO, Any, NewType, Optional, TypeVar, get_origin
 
 try:
     from _csv import _writer as CSV_Writer
@@ -33,6 +49,36 @@ log.setLevel(logging.WARNING)
 # It does all of the checks for files and directories, creating directories as needed.
 # It also decides where each file is placed in the results folder. 
 
+class HistoryFormat(Enum):
+    "How the history files are stored."
+    csv = ".csv"
+    "Text rows, readable by anything. The default."
+    binary = ".bin"
+    "Fixed-width binary records, much smaller and memory-mappable (see the Binary History Files section)."
+    delta = ".delta"
+    "Runs of repeated timestamp/level steps and unchanged flags, smallest of all (see the Delta Encoded Environment History section). The controller history is written as binary."
+
+class HistoryCompression(Enum):
+    "Whether the history files are stream-compressed as they are written, and with which stdlib codec. See the Compressed History Files section."
+    none = ""
+    gzip = ".gz"
+    "Fast, and still shrinks the repetitive rows a lot. The usual choice."
+    bz2 = ".bz2"
+    lzma = ".xz"
+    "Smallest files, most CPU per row."
+
+@dataclass(frozen=True)
+class SegmentPolicy:
+    """
+    Splits a history into segment files next to each other, rolling to a new segment when the current one reaches
+    `max_bytes` or holds more than `max_duration_sec` of history, whichever comes first (None turns that limit off).
+    Segments are only rolled between batches, so one can go over `max_bytes` by up to a batch. See the Segmented History Files section.
+    """
+    max_bytes:int|None              = field(default=64*1024*1024)
+    max_duration_sec:float|None     = field(default=None)
+    compress_closed:bool            = field(default=False)
+    "Gzip each segment once it is closed, on a thread of its own. Closing the writer waits for the last one."
+
 
 @dataclass(frozen=True)
 class EnvironmentDirectories:
@@ -46,13 +92,25 @@ class EnvironmentDirectories:
     "The name of the file describing the structure of the system. Results in a path like `out_dir/subdirectory/context_file_name`"
     controller_history_file_name:str        = field(default_factory=lambda:"ControllerHistory.csv")
     "The name of the file describing actions and events from the controller."
+    history_format:HistoryFormat            = field(default=HistoryFormat.csv)
+    "How both history files are stored. Their file names get the suffix of the format."
+    history_compression:HistoryCompression  = field(default=HistoryCompression.none)
+    "Whether both history files are compressed as they are written. Adds the codec's suffix to their names (e.g. `.csv.gz`)."
+    segment_policy:SegmentPolicy|None       = field(default=None)
+    "If set, both histories are written as segments, found through their index files rather than the history file paths."
+    results_database:Path|str|None          = field(default=None)
+    "An SQLite database shared by many runs. If set, the run's histories and context can be written there instead (see start_results_run). Automatically converts to a path with Path()."
+    create_directories:bool                 = field(default=True)
+    "Make the directories if they don't exist. Turn off to only look at runs that already exist (e.g. the Results_Catalog)."
 
 
     def __post_init__(self):
         if isinstance(self.out_dir, str):
             object.__setattr__(self, 'out_dir', Path(self.out_dir))
+        if isinstance(self.results_database, str):
+            object.__setattr__(self, 'results_database', Path(self.results_database))
         
-        if not os.path.exists(self.base_directory): # Make the directories if they don't exist.
+        if self.create_directories and not os.path.exists(self.base_directory): # Make the directories if they don't exist.
             os.makedirs(self.base_directory)
     
     @property
@@ -65,7 +123,17 @@ class EnvironmentDirectories:
     @property
     def history_file_path(self)->Path:
         "The full path of the history_file."
-        return self.base_directory / self.history_file_name
+        return (self.base_directory / self.history_file_name).with_suffix(self.history_format.value + self.history_compression.value)
+
+    @property
+    def history_index_file_path(self)->Path:
+        "The index of the history_file's segments, when the history is segmented."
+        return segment_index_file(self.history_file_path)
+
+    @property
+    def controller_history_index_file_path(self)->Path:
+        "The index of the controller_history_file's segments, when the history is segmented."
+        return segment_index_file(self.controller_history_file_path)
 
     @property
     def context_file_path(self)->Path:
@@ -75,21 +143,566 @@ class EnvironmentDirectories:
     @property
     def controller_history_file_path(self)->Path:
         "The full path of the controller_history_file."
-        return self.base_directory / self.controller_history_file_name
+        history_format = HistoryFormat.binary if self.history_format is HistoryFormat.delta else self.history_format
+        return (self.base_directory / self.controller_history_file_name).with_suffix(history_format.value + self.history_compression.value)
+
+########################################################[ Buffered History Writer ]########################################################
+# Both history files are written through these. They keep the file open and write rows in batches,
+# rather than reopening the file for every row, while keeping the file close enough to live to be viewed.
+# By default the writing is also moved off the event loop, onto a background thread (see WriterThreadPolicy).
+#
+# Every flush writes whole rows (or records, or delta blocks), so the file always ends on the boundary of a batch, unless the
+# program is killed in the middle of writing one (or the machine loses power before the OS wrote the file back).
+# Readers skip such a torn tail: CSVs are read up to the end of their last complete row (_CompleteRowsReader),
+# binary files up to their last complete record, and delta files up to their last complete block.
+# How much a power cut can lose is up to the FlushPolicy's fsync settings; a killed program loses only rows it hadn't flushed.
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    "When buffered history rows are written to the file. Whichever limit is reached first causes a flush."
+    max_rows:int            = field(default=100)
+    "Flush once this many rows are buffered."
+    max_interval_sec:float  = field(default=1.0)
+    "Flush rows once the oldest has been buffered this long. Someone viewing the file live is at most this far behind."
+    fsync_every_flushes:int|None    = field(default=None)
+    "fsync the file after this many flushes, so they survive a power cut or OS crash. None leaves it to the OS to write the file back."
+    fsync_interval_sec:float|None   = field(default=None)
+    "fsync the file at the first flush this long after the last fsync. With either fsync setting, closing the file also fsyncs it."
+
+    @property
+    def syncs(self)->bool:
+        return self.fsync_every_flushes is not None or self.fsync_interval_sec is not None
+
+    def sync_is_due(self, flushes:int, since_sync_sec:float)->bool:
+        "Whether to fsync, `flushes` flushes and `since_sync_sec` seconds after the last fsync."
+        return ((self.fsync_every_flushes is not None and flushes >= self.fsync_every_flushes) or
+                (self.fsync_interval_sec is not None and since_sync_sec >= self.fsync_interval_sec))
+
+TIME_INDEX_ROWS = 1000
+"How many rows apart the time index of a CSV history file records where a row starts (see the History Time Index section)."
+
+@dataclass(frozen=True)
+class _HistoryEncoding:
+    "How a history file is turned into bytes: a header written once, then batches of data objects."
+    header:bytes
+    encode:Callable[[list[Any]],bytes]
+    time_index_rows:int|None = field(default=None)
+    "If set, the writer keeps a time index of the file with an entry every this many rows. Not needed by formats that can be searched directly."
+
+def _csv_encoding(write_headers:Callable[[CSV_Writer],None], to_row:Callable[[Any],Iterable[Any]]) -> _HistoryEncoding: #type:ignore
+    text = io.StringIO()
+    writer = csv.writer(text)
+    write_headers(writer)
+    header = text.getvalue().encode()
+
+    def encode(datas:list[Any]) -> bytes:
+        text.seek(0)
+        text.truncate()
+        writer.writerows(map(to_row, datas))
+        return text.getvalue().encode()
+    return _HistoryEncoding(header, encode, time_index_rows=TIME_INDEX_ROWS)
+
+class _BufferedHistoryWriter:
+    "Holds a history file open, buffering data in memory until the FlushPolicy says to write it. Data is encoded when flushed."
+    def __init__(self, file:Path, encoding:_HistoryEncoding, policy:FlushPolicy, compression:HistoryCompression=HistoryCompression.none):
+        self.policy = policy
+        self.compression = compression
+        self.compression_metrics = compression_metrics()
+        self._pending:list[Any] = []
+        self._oldest_pending_time:float = 0
+        self._open_file(file, encoding)
+
+    def _open_file(self, file:Path, encoding:_HistoryEncoding) -> None:
+        self.file = file
+        self._encoding = encoding
+        if self.compression is HistoryCompression.none:
+            self._file:IO[bytes]|_CompressedFile = open(file=file, mode='wb')
+        else:
+            self._file = _CompressedFile(file, self.compression, self.compression_metrics)
+        self._file.write(encoding.header)
+        self._file.flush()
+        self._rows = 0
+        self._flushes_since_sync = 0
+        self._last_sync_time = time.monotonic()
+        self._time_index:list[tuple[int,int]] = []
+        "Time index entries not yet written to the index file."
+        indexed = encoding.time_index_rows is not None and self.compression is HistoryCompression.none # Offsets into a compressed file can't be seeked to.
+        self._time_index_file = open(file=time_index_file(file), mode='wb') if indexed else None
+
+    def _close_file(self) -> None:
+        if self.policy.syncs:
+            if isinstance(self._file, _CompressedFile): self._file.finish()
+            self._file.flush()
+            self._sync()
+        self._file.close()
+        if self._time_index_file is not None: self._time_index_file.close()
+
+    def _sync(self) -> None:
+        "fsyncs the file (and its time index), which must be flushed already."
+        os.fsync(self._file.fileno())
+        if self._time_index_file is not None: os.fsync(self._time_index_file.fileno())
+        self._flushes_since_sync = 0
+        self._last_sync_time = time.monotonic()
+
+    def write(self, data:Any) -> None:
+        if len(self._pending) == 0:
+            self._oldest_pending_time = time.monotonic()
+        self._pending.append(data)
+        if len(self._pending) >= self.policy.max_rows:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def write_many(self, datas:list[Any]) -> None:
+        if len(self._pending) == 0:
+            self._oldest_pending_time = time.monotonic()
+        self._pending.extend(datas)
+        if len(self._pending) >= self.policy.max_rows:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        "Flushes if the oldest buffered row has waited `max_interval_sec`."
+        if len(self._pending) > 0 and time.monotonic() - self._oldest_pending_time >= self.policy.max_interval_sec:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._file.closed: return
+        wrote = len(self._pending) > 0
+        if wrote:
+            self._write_batch(self._pending)
+            self.compression_metrics.rows += len(self._pending)
+            self._pending = []
+        self._file.flush()
+        if self._time_index_file is not None and len(self._time_index) > 0:
+            # After the rows they point to are flushed, so a reader never finds an entry past the end of the file.
+            self._time_index_file.write(np.array(self._time_index, dtype=TIME_INDEX_ENTRY).tobytes())
+            self._time_index_file.flush()
+            self._time_index = []
+        if wrote and self.policy.syncs:
+            self._flushes_since_sync += 1
+            if self.policy.sync_is_due(self._flushes_since_sync, time.monotonic() - self._last_sync_time):
+                self._sync()
+
+    def _write_batch(self, datas:list[Any]) -> None:
+        every = self._encoding.time_index_rows
+        if every is None or self._time_index_file is None:
+            self._file.write(self._encoding.encode(datas))
+            self._rows += len(datas)
+            return
+        # Split the batch where time index entries fall, to know where those rows start.
+        i = 0
+        while i < len(datas):
+            if self._rows % every == 0:
+                # The time the row is read back as: CSV rows keep microseconds, so that's what the index entry is checked against.
+                self._time_index.append((datas[i].time_ns // 1000 * 1000, self._file.tell()))
+            count = min(len(datas) - i, every - self._rows % every)
+            self._file.write(self._encoding.encode(datas[i:i+count]))
+            self._rows += count
+            i += count
+
+    def close(self) -> None:
+        if self._file.closed: return
+        self.flush()
+        self._close_file()
+
+class QueueFullPolicy(Enum):
+    "What saving a row does when the background writer's queue is full (the disk can't keep up)."
+    block = "block"
+    "Wait for room. Nothing is lost, but the caller (and its event loop) stalls."
+    drop_oldest = "drop_oldest"
+    "Throw away the oldest queued row to make room."
+    count_and_drop = "count_and_drop"
+    "Throw away the new row. Either way, dropped rows are counted in the metrics."
+
+@dataclass(frozen=True)
+class WriterThreadPolicy:
+    "Settings for writing a history file from a background thread."
+    max_queue_rows:int          = field(default=10_000)
+    "How many rows can wait for the writer thread before `when_full` applies."
+    when_full:QueueFullPolicy   = field(default=QueueFullPolicy.block)
+
+@dataclass
+class history_writer_metrics:
+    "What a background history writer has done so far. Read it from the logger's `metrics`."
+    rows_queued:int             = field(default=0)
+    rows_written:int            = field(default=0)
+    rows_dropped:int            = field(default=0)
+    queue_depth:int             = field(default=0)
+    "Rows waiting for the writer thread right now."
+    max_queue_depth:int         = field(default=0)
+    write_batches:int           = field(default=0)
+    write_time_total_sec:float  = field(default=0)
+    write_time_max_sec:float    = field(default=0)
+    "Longest time the thread spent writing one batch (formatting and file I/O)."
+
+    @property
+    def write_time_mean_sec(self)->float:
+        return self.write_time_total_sec / self.write_batches if self.write_batches > 0 else 0
+
+class _ThreadedHistoryWriter:
+    """
+    Hands rows to a background thread through a bounded queue, so slow disks don't stall the caller's event loop.
+    The thread owns a _BufferedHistoryWriter, so the FlushPolicy still decides when the file is written.
+    """
+    def __init__(self, writer:_BufferedHistoryWriter, thread_policy:WriterThreadPolicy):
+        self.file = writer.file
+        self.policy = writer.policy
+        self.thread_policy = thread_policy
+        self.metrics = history_writer_metrics()
+        self.compression_metrics = writer.compression_metrics
+        self._writer = writer
+        self._queue:deque[Any] = deque()
+        self._condition = threading.Condition()
+        self._flushes_requested = 0
+        self._flushes_done = 0
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name=f"Writing {self.file}", daemon=True)
+        self._thread.start()
+
+    def write(self, data:Any) -> None:
+        with self._condition:
+            if len(self._queue) >= self.thread_policy.max_queue_rows:
+                match self.thread_policy.when_full:
+                    case QueueFullPolicy.block:
+                        self._condition.wait_for(lambda: len(self._queue) < self.thread_policy.max_queue_rows or self._closing)
+                    case QueueFullPolicy.drop_oldest:
+                        self._queue.popleft()
+                        self.metrics.rows_dropped += 1
+                    case QueueFullPolicy.count_and_drop:
+                        self.metrics.rows_dropped += 1
+                        return
+            self._queue.append(data)
+            self.metrics.rows_queued += 1
+            self.metrics.queue_depth = len(self._queue)
+            if self.metrics.queue_depth > self.metrics.max_queue_depth:
+                self.metrics.max_queue_depth = self.metrics.queue_depth
+            self._condition.notify_all()
+
+    def flush_if_due(self) -> None:
+        "The writer thread checks this itself."
+        pass
+
+    def flush(self) -> None:
+        "Waits until everything saved so far has been written to the file."
+        with self._condition:
+            self._flushes_requested += 1
+            request = self._flushes_requested
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._flushes_done >= request or not self._thread.is_alive())
+
+    def close(self) -> None:
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._queue) > 0 or self._closing or self._flushes_requested > self._flushes_done,
+                                         timeout=self.policy.max_interval_sec)
+                batch = list(self._queue)
+                self._queue.clear()
+                self.metrics.queue_depth = 0
+                flush_request = self._flushes_requested
+                closing = self._closing
+                self._condition.notify_all() # Room for blocked writers
+
+            start = time.perf_counter()
+            try:
+                if len(batch) > 0: self._writer.write_many(batch)
+                if closing:                                 self._writer.close()
+                elif flush_request > self._flushes_done:    self._writer.flush()
+                else:                                       self._writer.flush_if_due()
+            except Exception:
+                log.exception(f"Background writer for {self.file} failed.")
+            elapsed = time.perf_counter() - start
+
+            with self._condition:
+                self.metrics.rows_written += len(batch)
+                if len(batch) > 0:
+                    self.metrics.write_batches += 1
+                    self.metrics.write_time_total_sec += elapsed
+                    self.metrics.write_time_max_sec = max(self.metrics.write_time_max_sec, elapsed)
+                self._flushes_done = flush_request
+                self._condition.notify_all()
+            if closing:
+                return
+
+def _make_history_writer(file:Path, encoding_for:Callable[[Path],_HistoryEncoding], flush_policy:FlushPolicy,
+                         writer_thread:WriterThreadPolicy|None, segments:SegmentPolicy|None, compression:HistoryCompression,
+                         database_table:'tuple[results_run,_ResultsTable]|None'=None) -> _BufferedHistoryWriter|_ThreadedHistoryWriter:
+    """
+    `encoding_for` gives the encoding of each file written, which is more than one when the history is segmented.
+    With `database_table`, rows are inserted into that table of a results database instead, and no file is written.
+    """
+    if database_table is not None: writer:_BufferedHistoryWriter = _SQLiteHistoryWriter(*database_table, flush_policy)
+    elif segments is None:          writer = _BufferedHistoryWriter(file, encoding_for(file), flush_policy, compression)
+    else:                           writer = _SegmentedHistoryWriter(file, encoding_for, flush_policy, segments, compression)
+    if writer_thread is None:
+        return writer
+    return _ThreadedHistoryWriter(writer, writer_thread)
+
+async def _flush_periodically(logger:'_EnvironmentStateHistoryLogger|_ControllerHistoryLogger') -> None:
+    "Makes sure rows are flushed on time even when nothing new is being saved."
+    while True:
+        await asyncio.sleep(logger.flush_policy.max_interval_sec)
+        logger.flush_if_due()
+
+def _start_flushing_periodically(logger:'_EnvironmentStateHistoryLogger|_ControllerHistoryLogger') -> asyncio.Task:
+    task = asyncio.create_task(_flush_periodically(logger))
+    task.set_name(f"Periodically flushing {logger.file}")
+    return task
+
+########################################################[ History Row Schema ]########################################################
+# The columns of the history files are declared once, on the fields of EnvironmentLogData and ControllerLogData (with history_column()).
+# make_history_codec() reads those declarations and generates the code turning a row into CSV values or a binary record and back,
+# so adding a field means changing the dataclass only. Like dataclasses' own __init__, the per-row functions are generated as
+# python source and compiled, so they do no more work per row than hand-written ones would.
+#
+# A field's type decides how it is stored:
+#   EpochNs             text in CSV_TIME_FORMAT     | `time_ns`, the same int64
+#   float               a number                    | a float64 named after the column
+#   bool                True / False                | one bit of `flags`, in the order of the columns
+#   CtrlLogTarget       its bits, like 5 (LLS|pump) | the same bits, in a byte named after the column
+#   str                 the text                    | `<column>_id`, the index of the text in the file's message table
+# Binary records hold their fields in that order: time, numbers, flags, target sets, then message ids.
+#
+# Log records are timestamped with LogClock.now_ns(), ns since 1970 as an int rather than a datetime. The clock reads the wall clock
+# once and advances it with the monotonic clock, so timestamps never jump back when the system's time changes, and taking one
+# costs a single clock read. Take one per tick and give it to every record of the tick. Timestamps become text or datetimes only
+# where they are shown: CSV rows format the date and time of day once per second (_CsvTimeFormatter), and the records' `timestamp`
+# property converts one on demand.
+
+EpochNs = NewType('EpochNs', int)
+"A timestamp in the history files: ns since 1970-01-01, of the naive (local) times the CSVs hold."
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _datetime_to_ns(timestamp:datetime)->int:
+    return (timestamp - _EPOCH) // timedelta(microseconds=1) * 1000
+
+def _ns_to_datetime(time_ns:int)->datetime:
+    return _EPOCH + timedelta(microseconds=time_ns // 1000)
+
+class LogClock:
+    "Timestamps for log records: the wall clock read when the clock starts (or is reset), advanced by the monotonic clock."
+    __slots__ = ('base_ns', 'base_monotonic_ns')
+    def __init__(self):
+        self.reset()
+
+    def reset(self)->None:
+        "Reads the wall clock again, e.g. at the start of a run, after the system's time was corrected."
+        self.base_monotonic_ns = time.monotonic_ns()
+        self.base_ns = _datetime_to_ns(datetime.now())
+
+    def now_ns(self)->EpochNs:
+        return self.base_ns + (time.monotonic_ns() - self.base_monotonic_ns) #type:ignore
+
+LOG_CLOCK = LogClock()
+"The clock the log records are timestamped with by default."
+now_ns = LOG_CLOCK.now_ns
+"The time on LOG_CLOCK."
+
+CSV_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+"How timestamps are written in both history CSVs."
+
+class _CsvTimeFormatter:
+    "Formats EpochNs in CSV_TIME_FORMAT, only formatting the date and time of day again when the second changes."
+    __slots__ = ('_second',)
+    def __init__(self):
+        self._second:tuple[int,str] = (0, _EPOCH.strftime(CSV_TIME_FORMAT[:-3]))
+        "The last second formatted and its text, replaced as one so writer threads sharing this never see a mismatched pair."
+
+    def __call__(self, time_ns:int)->str:
+        second, ns = divmod(time_ns, 1_000_000_000)
+        cached = self._second
+        if cached[0] != second:
+            cached = self._second = (second, (_EPOCH + timedelta(seconds=second)).strftime(CSV_TIME_FORMAT[:-3]))
+        return f"{cached[1]}.{ns // 1000:06}"
+
+_format_csv_time = _CsvTimeFormatter()
+
+def _parse_csv_time(text:str)->EpochNs:
+    "The EpochNs of CSV_TIME_FORMAT text (which is ISO format, so datetime's faster ISO parser reads it)."
+    return _datetime_to_ns(datetime.fromisoformat(text)) #type:ignore
+_CSV_TRUE_VALUES  = ['True', 'true', 'TRUE', '1', 'yes']
+_CSV_FALSE_VALUES = ['False', 'false', 'FALSE', '0', 'no']
+
+class _CsvBools(dict):
+    "CSV text to bool. Unlike bool(text), 'False' is False, and text that isn't a boolean is an error rather than True."
+    def __missing__(self, key:str)->bool:
+        raise ValueError(f"{key!r} is not a boolean.")
+
+_CSV_BOOLS = _CsvBools({**{t: True for t in _CSV_TRUE_VALUES}, **{f: False for f in _CSV_FALSE_VALUES}})
+
+_COLUMN_KINDS = (EpochNs, float, bool, IntFlag, str)
+"The field types a history column can have, in the order their binary fields are laid out."
+
+def history_column(name:str, position:int)->dict[str,Any]:
+    "The metadata of a dataclass field stored in the history files: `field(..., metadata=history_column('level', 1))`."
+    return {'history_column': name, 'history_position': position}
+
+@dataclass(frozen=True)
+class _HistoryColumn:
+    field:str
+    "The dataclass field."
+    name:str
+    "Its CSV header."
+    kind:type
+    "One of _COLUMN_KINDS."
+    record_field:str
+    "Where it is kept in a binary record (all booleans share `flags`)."
+
+class HistoryRowCodec:
+    """
+    Converts one of the log dataclasses to and from CSV rows and binary records. Made by make_history_codec() from the dataclass' fields.
+    to_row(), from_row(), to_record() and from_record() convert one row and are generated code; parse_csv() and records_to_dataframe() work a whole column at a time.
+    """
+    def __init__(self, cls:type, columns:list[_HistoryColumn]):
+        self.cls = cls
+        self.columns = columns
+        self.headers:list[str] = [c.name for c in columns]
+        "The CSV headers, in order."
+        bools = [c for c in columns if c.kind is bool]
+        self.bits:dict[str,int] = {c.field: 1 << i for i, c in enumerate(bools)}
+        "The bit of `flags` each boolean field is kept in."
+        if len(bools) > 8:
+            raise TypeError(f"{cls.__name__} has more booleans than fit in the flags byte.")
+
+        fields:list[tuple[str,str]] = []
+        for kind in _COLUMN_KINDS:
+            for c in columns:
+                if c.kind is kind and c.record_field not in (f for f, _ in fields):
+                    fields.append((c.record_field, {EpochNs: '<i8', float: '<f8', bool: 'u1', IntFlag: 'u1', str: '<u4'}[kind]))
+        self.record = np.dtype(fields)
+        "The binary record of one row."
+
+        namespace:dict[str,Any] = {}
+        exec(self._generate_source(), globals(), namespace) # Run with the module's globals, so the generated code sees what this file defines later too.
+        self.to_row:Callable[[Any],list[Any]] = namespace['to_row']
+        "The values of a CSV row."
+        self.from_row:Callable[[list[str]],Any] = namespace['from_row']
+        "A dataclass from the text of a CSV row."
+        self.to_record:Callable[...,tuple] = namespace['to_record']
+        "to_record(data, message_id=None): the values of a binary record. `message_id(text)` gives the index of text in the message table."
+        self.from_record:Callable[...,Any] = namespace['from_record']
+        "from_record(values, messages=None): a dataclass from the values of a binary record (one of `records.tolist()`)."
+
+    def _generate_source(self)->str:
+        to_row, from_row, to_record, from_record = [], [], {}, []
+        for i, c in enumerate(self.columns):
+            value = f"data.{c.field}"
+            if c.kind is EpochNs:
+                to_row.append(f"_format_csv_time({value})")
+                from_row.append(f"{c.field}=_parse_csv_time(row[{i}])")
+                to_record[c.record_field] = value
+                from_record.append(f"{c.field}={c.record_field}")
+            elif c.kind is float:
+                to_row.append(value)
+                from_row.append(f"{c.field}=float(row[{i}])")
+                to_record[c.record_field] = value
+                from_record.append(f"{c.field}={c.record_field}")
+            elif c.kind is bool:
+                to_row.append(value)
+                from_row.append(f"{c.field}=_CSV_BOOLS[row[{i}]]")
+                to_record.setdefault(c.record_field, [])
+                to_record[c.record_field].append(f"({self.bits[c.field]} if {value} else 0)")
+                from_record.append(f"{c.field}=bool({c.record_field} & {self.bits[c.field]})")
+            elif c.kind is IntFlag:
+                to_row.append(f"{value}.value")
+                from_row.append(f"{c.field}=CtrlLogTarget.parse(row[{i}])")
+                to_record[c.record_field] = f"{value}.value"
+                from_record.append(f"{c.field}=CtrlLogTarget({c.record_field})")
+            else:
+                to_row.append(value)
+                from_row.append(f"{c.field}=row[{i}]")
+                to_record[c.record_field] = f"message_id({value})"
+                from_record.append(f"{c.field}=messages[{c.record_field}]")
+        record_values = [" | ".join(v) if isinstance(v, list) else v for v in (to_record[f] for f in self.record.names)]
+        return "\n".join([
+            f"def to_row(data):",
+            f"    return [{', '.join(to_row)}]",
+            f"def from_row(row):",
+            f"    return {self.cls.__name__}({', '.join(from_row)})",
+            f"def to_record(data, message_id=None):",
+            f"    return ({', '.join(record_values)},)",
+            f"def from_record(values, messages=None):",
+            f"    {', '.join(self.record.names)}, = values",
+            f"    return {self.cls.__name__}({', '.join(from_record)})",
+        ])
+
+    def parse_csv(self, source:Path|IO[bytes])->pd.DataFrame:
+        """
+        Parses CSV rows (with their headers) from a file or buffer into a dataframe, a whole column at a time by pandas' C parser.
+        Targets become a column of their bits (uint8); they are parsed once per distinct value, which also reads the text older files have (like "LLS-pump").
+        """
+        dtypes = {c.name: {float: 'float64', bool: 'bool', IntFlag: 'str', str: 'str'}[c.kind] for c in self.columns if c.kind is not EpochNs}
+        has_text = any(c.kind in (IntFlag, str) for c in self.columns)
+        data = pd.read_csv(source, dtype=dtypes, true_values=_CSV_TRUE_VALUES, false_values=_CSV_FALSE_VALUES, keep_default_na=not has_text) #type:ignore
+        for c in self.columns:
+            if c.kind is EpochNs:
+                data[c.name] = pd.to_datetime(data[c.name], format=CSV_TIME_FORMAT)
+            elif c.kind is IntFlag:
+                target_bits = {t: CtrlLogTarget.parse(t).value for t in data[c.name].unique()}
+                data[c.name] = data[c.name].map(target_bits).astype('u1')
+        return data
+
+    def records_to_dataframe(self, records:np.ndarray, messages:list[str]|None=None)->pd.DataFrame:
+        "The same dataframe parse_csv gives, from binary records. `messages` is the file's message table, if the rows have text."
+        columns:dict[str,Any] = {}
+        for c in self.columns:
+            values = records[c.record_field]
+            if c.kind is EpochNs:
+                columns[c.name] = pd.to_datetime(values.view('datetime64[ns]'))
+            elif c.kind is float:
+                columns[c.name] = values
+            elif c.kind is bool:
+                columns[c.name] = (values & self.bits[c.field]) != 0
+            elif c.kind is IntFlag:
+                columns[c.name] = values
+            else:
+                columns[c.name] = [messages[m] for m in values.tolist()] #type:ignore
+        return pd.DataFrame(columns)
+
+def make_history_codec(cls:type)->HistoryRowCodec:
+    "Generates the codec of a log dataclass from the fields declared with history_column()."
+    columns:list[tuple[int,_HistoryColumn]] = []
+    for f in dataclasses.fields(cls):
+        if 'history_column' not in f.metadata:
+            continue
+        kind = get_origin(f.type) or f.type
+        if isinstance(kind, type) and issubclass(kind, IntFlag):
+            kind = IntFlag
+        if kind not in _COLUMN_KINDS:
+            raise TypeError(f"{cls.__name__}.{f.name} is a {f.type}, which can't be saved in a history file.")
+        name = f.metadata['history_column']
+        record_field = {EpochNs: 'time_ns', bool: 'flags', str: f"{name}_id"}.get(kind, name) #type:ignore
+        columns.append((f.metadata['history_position'], _HistoryColumn(f.name, name, kind, record_field))) #type:ignore
+    return HistoryRowCodec(cls, [c for _, c in sorted(columns, key=lambda p: p[0])])
 
 ########################################################[ Environment History File ]########################################################
 # These functions and objects managing writing to the Environment History File which is done while the simulation is running.
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class EnvironmentLogData:
-    "All the information for the history file recording the system state."
-    water_level             :float
-    overflowing             :bool       = field(default=False)
-    empty                   :bool       = field(default=False)
-    pump_active             :bool       = field(default=False)
-    upper_sensor_active     :bool       = field(default=False)
-    lower_sensor_active     :bool       = field(default=False)
-    timestamp               :datetime   = field(default_factory=datetime.now)
+    "All the information for the history file recording the system state. Give a tick's records the same `time_ns` (see LogClock)."
+    water_level             :float      = field(metadata=history_column('level', 1))
+    overflowing             :bool       = field(default=False, metadata=history_column('is_overflowing', 5))
+    empty                   :bool       = field(default=False, metadata=history_column('is_empty', 6))
+    pump_active             :bool       = field(default=False, metadata=history_column('is_pump_on', 2))
+    upper_sensor_active     :bool       = field(default=False, metadata=history_column('is_upper_sensor_active', 3))
+    lower_sensor_active     :bool       = field(default=False, metadata=history_column('is_lower_sensor_active', 4))
+    time_ns                 :EpochNs    = field(default_factory=now_ns, metadata=history_column('Time', 0))
+
+    @property
+    def timestamp(self)->datetime:
+        return _ns_to_datetime(self.time_ns)
+
+ENVIRONMENT_CODEC = make_history_codec(EnvironmentLogData)
+"Converts EnvironmentLogData to and from the rows of either format of the environment history file."
 
 class _HistFileManager:
     "A collection of functions to help manage writing the Environment History CSV file."
@@ -97,7 +710,7 @@ class _HistFileManager:
     @staticmethod
     def write_headers(writer:CSV_Writer): #type:ignore
         "Fill out the headers for"
-        writer.writerow(['Time', 'level','is_pump_on','is_upper_sensor_active', 'is_lower_sensor_active', 'is_overflowing','is_empty'])
+        writer.writerow(ENVIRONMENT_CODEC.headers)
 
     @staticmethod
     def _write_data(writer:CSV_Writer,rows:Iterable[Iterable[Any]]): #type:ignore
@@ -105,16 +718,7 @@ class _HistFileManager:
 
     @staticmethod
     def _data_to_rows(data:EnvironmentLogData)->Iterable[Any]:
-        row = []
-        # row.append(data.timestamp.isoformat())                        # Universally recognized
-        row.append(data.timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'))     # Excel Friendly & more readable
-        row.append(data.water_level)
-        row.append(data.pump_active)
-        row.append(data.upper_sensor_active)
-        row.append(data.lower_sensor_active)
-        row.append(data.overflowing)
-        row.append(data.empty)
-        return row
+        return ENVIRONMENT_CODEC.to_row(data)
     
     @staticmethod
     def write_data(writer:CSV_Writer,data:EnvironmentLogData): #type:ignore
@@ -125,89 +729,115 @@ class _HistFileManager:
         _HistFileManager._write_data(writer,rows=[_HistFileManager._data_to_rows(d) for d in datas])
 
     @staticmethod
-    def read_all_data(history_file:Path)-> Generator[EnvironmentLogData,None,None]:
-        "Reads from the start of the file to the end"
-        with open(file=history_file, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader) #Ignore headers
-            for row in reader:
-                yield EnvironmentLogData(
-                    timestamp           = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f'),
-                    water_level         = float(row[1]),
-                    pump_active         = bool(row[2]),
-                    upper_sensor_active = bool(row[3]),
-                    lower_sensor_active = bool(row[4]),
-                    overflowing         = bool(row[5]),
-                    empty               = bool(row[6])
-                )
+    def encoding(history_format:HistoryFormat, history_file:Path)->_HistoryEncoding:
+        "How the history loggers write this file in the given format."
+        if history_format is HistoryFormat.binary:
+            return _binary_environment_encoding()
+        if history_format is HistoryFormat.delta:
+            return _delta_environment_encoding()
+        return _csv_encoding(_HistFileManager.write_headers, ENVIRONMENT_CODEC.to_row)
+
+    @staticmethod
+    def read_all_data(history_file:Path, start:datetime|None=None, end:datetime|None=None)-> Generator[EnvironmentLogData,None,None]:
+        "Reads from the start of the file to the end, or only the rows with `start` <= timestamp <= `end`, found through the file's time index."
+        yield from map(ENVIRONMENT_CODEC.from_row, _csv_rows_between(history_file, start, end))
     
     @staticmethod
     def read_as_dataframe(history_file:RemotablePath)->pd.DataFrame:
-        "Reads as dataframe with appropriate converters."
-        def to_bool(x): return x.lower() in ('true', '1', 'yes')
-        converters = {
-            'Time': lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S.%f'),
-            'level': float,
-            'is_pump_on': to_bool,
-            'is_upper_sensor_active': to_bool,
-            'is_lower_sensor_active':to_bool,
-            'is_overflowing':to_bool,
-            'is_empty':to_bool
-        }
+        "Reads as dataframe. Everything is parsed by pandas' C parser a whole column at a time, with no per-cell python converters."
         with remotable_as_local_file(history_file) as local_history_file:
-            return pd.read_csv(local_history_file, converters=converters)
+            if is_binary_history_file(local_history_file):
+                return MappedEnvironmentHistory(local_history_file).to_dataframe()
+            with _open_history_rows(local_history_file) as f:
+                return _HistFileManager.parse_csv(f)
+
+    @staticmethod
+    def parse_csv(source:Path|IO[bytes])->pd.DataFrame:
+        "Parses CSV rows (with their headers) from a file or buffer into the dataframe read_as_dataframe returns."
+        return ENVIRONMENT_CODEC.parse_csv(source)
 
 class _EnvironmentStateHistoryLogger:
-    "This is the object held by the program provided by a context manager [update_state_history_file()]. This edits the file line by line so it can be viewed live."
-    def __init__(self,history_file:Path):
+    "This is the object held by the program provided by a context manager [update_state_history_file()]. This buffers rows and writes them in batches (see FlushPolicy), from a background thread unless `writer_thread` is None."
+    def __init__(self,history_file:Path,flush_policy:FlushPolicy=FlushPolicy(),writer_thread:WriterThreadPolicy|None=WriterThreadPolicy(),
+                 history_format:HistoryFormat=HistoryFormat.csv,segments:SegmentPolicy|None=None,compression:HistoryCompression=HistoryCompression.none,
+                 database_run:'results_run|None'=None):
         self.file = history_file
-        with open(file=self.file,mode='w') as f:
-            writer = csv.writer(f)
-            _HistFileManager.write_headers(writer)
+        self.flush_policy = flush_policy
+        self._writer = _make_history_writer(history_file, lambda file: _HistFileManager.encoding(history_format, file), flush_policy, writer_thread, segments, compression,
+                                            (database_run, ENVIRONMENT_TICKS) if database_run is not None else None)
+
+    @property
+    def metrics(self)->history_writer_metrics|None:
+        "Queue depth and write latency of the background writer thread, None if writing on the caller's thread."
+        return self._writer.metrics if isinstance(self._writer, _ThreadedHistoryWriter) else None
+
+    @property
+    def compression_metrics(self)->'compression_metrics':
+        "Compression ratio and the CPU time spent compressing, if the file is compressed."
+        return self._writer.compression_metrics
 
     def save(self,data:EnvironmentLogData):
-        with open(file=self.file, mode='a') as f:
-            writer = csv.writer(f)
-            _HistFileManager.write_data(writer,data)
+        self._writer.write(data)
+
+    def flush_if_due(self): self._writer.flush_if_due()
+    def flush(self):        self._writer.flush()
+    def close(self):        self._writer.close()
 
 @asynccontextmanager
-async def update_state_history_file(history_file:Path):
-    "use a with statement `with update_state_history_file(...) as writer` to use this."
+async def update_state_history_file(history_file:Path, flush_policy:FlushPolicy=FlushPolicy(), writer_thread:WriterThreadPolicy|None=WriterThreadPolicy(),
+                                    history_format:HistoryFormat=HistoryFormat.csv, segments:SegmentPolicy|None=None,
+                                    compression:HistoryCompression=HistoryCompression.none, database_run:'results_run|None'=None):
+    """
+    use a with statement `with update_state_history_file(...) as writer` to use this. Everything saved is written by the time the with block exits.
+    With `segments`, history_file only names the segment files and their index (see SegmentPolicy, SegmentedHistory).
+    With `compression`, the file is compressed as it is written; give history_file the codec's suffix (see Compressed History Files).
+    With `database_run`, rows are inserted into that run of a results database instead of written to history_file (see SQLite Results Database).
+    """
     try:
-        state_log = _EnvironmentStateHistoryLogger(history_file)
+        state_log = _EnvironmentStateHistoryLogger(history_file, flush_policy, writer_thread, history_format, segments, compression, database_run)
+        flush_task = _start_flushing_periodically(state_log)
         
         try:
             yield state_log
         except Exception as e:
                 raise e #Don't actually catch errors
+        finally:
+            flush_task.cancel()
+            state_log.close()
     except Exception as e:
         log.exception(f"Exception Occoured in Save_Results.")
         # Normally swallows exceptions, so at least we can see it now.
 
-def read_state_history_file(history_file:Path)->Iterable[EnvironmentLogData]:
-    "This returns an iterator from the contents of the environment log data, which can be itterated over in a for loop, reading the data as it is accessed from the iterator"
-    return _HistFileManager.read_all_data(history_file)
+def read_state_history_file(history_file:Path, start:datetime|None=None, end:datetime|None=None)->Iterable[EnvironmentLogData]:
+    """
+    This returns an iterator from the contents of the environment log data, which can be itterated over in a for loop, reading the data as it is accessed from the iterator.
+    Give `start` and/or `end` to only read the rows in that time window; the reading starts close to `start` rather than at the top of the file.
+    """
+    if is_binary_history_file(history_file):
+        return MappedEnvironmentHistory(history_file).read_all_data(start, end)
+    return _HistFileManager.read_all_data(history_file, start, end)
 
 ########################################################[ Environment Context File ]########################################################
 # These functions and objects managing writing to the Environment Context File which is done before the simulation.
 # This file explains the conditions that were set for this run, primarily involving the simulation settings.
 
-def save_to_context_file(file:Path,context:dict)->None:
-    "Saves the dictionary provided to the Environment Context File to establish to the viewer how the Environment was setup prior to run."
-
-    def context_serializer(obj:Any)->str|dict:
-        if is_dataclass(obj):
-            return asdict(obj) #type:ignore
+def _context_serializer(obj:Any)->str|dict:
+    if is_dataclass(obj):
+        return asdict(obj) #type:ignore
 
-        if isinstance(obj, Path):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        raise TypeError(f"Object of type {type(obj)} is not JSON Serializable so can't be written the Context File. Add to context_serializer if needed.")
+    if isinstance(obj, Path):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj)} is not JSON Serializable so can't be written the Context File. Add to _context_serializer if needed.")
 
+def save_to_context_file(file:Path,context:dict)->None:
+    "Saves the dictionary provided to the Environment Context File to establish to the viewer how the Environment was setup prior to run."
     try:
         with open(file=file,mode="w") as f:
-            json.dump(context,f,default=context_serializer, indent=4)
+            json.dump(context,f,default=_context_serializer, indent=4)
     except Exception as e:
         log.exception(f"Error building Context File in Save_Results.")
 
@@ -215,63 +845,91 @@ def save_to_context_file(file:Path,context:dict)->None:
 # These functions and objects managing writing to the Controller History File. 
 # This done if the Automatic_Controller is running and performs some signifigant action.
 
-class CtrlLogTarget(Enum):
-    "The things a controller can act towards."
-    lower_level_sensor = "LLS"
+class CtrlLogTarget(IntFlag):
+    """
+    The things a controller can act towards. A combination of them is one value whose bits are the targets (`CtrlLogTarget.LLS | CtrlLogTarget.pump`),
+    and reads like a set: `CtrlLogTarget.pump in targets`, `targets | CtrlLogTarget.ULS`, `for t in targets`, `len(targets)`.
+    History files and dataframes keep the bits, so a column of them is filtered with one bitwise op (see targets_include).
+    """
+    none = 0
+    lower_level_sensor = 1 << 0
     LLS = lower_level_sensor
-    upper_level_sensor = "ULS"
+    upper_level_sensor = 1 << 1
     ULS = upper_level_sensor
-    pump = "pump"
+    pump = 1 << 2
 
     @staticmethod
-    def all()->set['CtrlLogTarget']:
-        return {CtrlLogTarget.LLS,CtrlLogTarget.ULS,CtrlLogTarget.pump}
+    def all()->'CtrlLogTarget':
+        return CtrlLogTarget.LLS | CtrlLogTarget.ULS | CtrlLogTarget.pump
 
     @staticmethod
-    def set_to_string(targets:set['CtrlLogTarget'])->str:
-        return "-".join(t.value for t in targets)
-    
+    def of(targets:'CtrlLogTarget|Iterable[CtrlLogTarget]|int|None')->'CtrlLogTarget':
+        "The targets given as one target, several, their bits, or None."
+        if targets is None:             return CtrlLogTarget.none
+        if isinstance(targets, int):    return CtrlLogTarget(targets)
+        out = CtrlLogTarget.none
+        for t in targets:
+            out |= t
+        return out
+
+    def to_string(self)->str:
+        "The targets' short names joined by dashes, like `LLS-pump`."
+        return "-".join(_TARGET_NAMES[t] for t in self)
+
     @staticmethod
-    def string_to_set(target_string:str)->set['CtrlLogTarget']:
-        out=set()
-        strs = [s.strip() for s in target_string.split('-')]
-        strs = [s for s in strs if not s==""]
-        for s in strs:
-            try:
-                out.add(CtrlLogTarget(s))
-            except ValueError:
-                pass
+    def from_string(target_string:str)->'CtrlLogTarget':
+        "Parses to_string()'s text. Unknown names are ignored."
+        out = CtrlLogTarget.none
+        for s in target_string.split('-'):
+            out |= _TARGETS_BY_NAME.get(s.strip(), CtrlLogTarget.none)
         return out
 
+    @staticmethod
+    def parse(text:str)->'CtrlLogTarget':
+        "The targets column of a history CSV: their bits, or to_string()'s text in files written before they were."
+        return CtrlLogTarget(int(text)) if text.isdigit() else CtrlLogTarget.from_string(text)
 
-@dataclass(frozen=True)
+_TARGET_NAMES = {CtrlLogTarget.LLS: "LLS", CtrlLogTarget.ULS: "ULS", CtrlLogTarget.pump: "pump"}
+_TARGETS_BY_NAME = {name: t for t, name in _TARGET_NAMES.items()}
+
+def targets_include(targets:np.ndarray|pd.Series, target:CtrlLogTarget)->np.ndarray|pd.Series:
+    "Which rows of a column of target bits (from a history file or dataframe) include any of `target`."
+    return (targets & target.value) != 0
+
+
+@dataclass(frozen=True, slots=True)
 class ControllerLogData:
     "All the information for the controller history file recording the system state."
-    is_action           :bool               = field(default=False)
-    is_modbus_error     :bool               = field(default=False)
-    is_state_refresh    :bool               = field(default=False)
-    targets             :set[CtrlLogTarget] = field(default_factory=set)
-    message             :str                = field(default="")
-    timestamp           :datetime           = field(default_factory=datetime.now)
+    is_action           :bool               = field(default=False, metadata=history_column('is_action', 1))
+    is_modbus_error     :bool               = field(default=False, metadata=history_column('is_modbus_error', 2))
+    is_state_refresh    :bool               = field(default=False, metadata=history_column('is_state_refresh', 3))
+    targets             :CtrlLogTarget      = field(default=CtrlLogTarget.none, metadata=history_column('targets', 4))
+    message             :str                = field(default="", metadata=history_column('message', 5))
+    time_ns             :EpochNs            = field(default_factory=now_ns, metadata=history_column('Time', 0))
 
-    @staticmethod
-    def _parse_targets(target:set[CtrlLogTarget]|CtrlLogTarget|None)->set[CtrlLogTarget]:
-        if target is None: return set()
-        elif isinstance(target,CtrlLogTarget): return {target}
-        else: return target
+    def __post_init__(self):
+        if type(self.targets) is not CtrlLogTarget: # Also takes a set of targets, or their bits.
+            object.__setattr__(self, 'targets', CtrlLogTarget.of(self.targets))
+
+    @property
+    def timestamp(self)->datetime:
+        return _ns_to_datetime(self.time_ns)
 
     @staticmethod
-    def log_action(targets:set[CtrlLogTarget]|CtrlLogTarget|None=None,message:str="")->'ControllerLogData':
+    def log_action(targets:CtrlLogTarget|Iterable[CtrlLogTarget]|None=None,message:str="")->'ControllerLogData':
         return ControllerLogData(is_action=True,is_modbus_error=False,is_state_refresh=False,message=message,
-                                 targets=ControllerLogData._parse_targets(targets))
+                                 targets=CtrlLogTarget.of(targets))
     @staticmethod
-    def log_modbus_error(targets:set[CtrlLogTarget]|CtrlLogTarget|None=None,message:str="")->'ControllerLogData':
+    def log_modbus_error(targets:CtrlLogTarget|Iterable[CtrlLogTarget]|None=None,message:str="")->'ControllerLogData':
         return ControllerLogData(is_action=False,is_modbus_error=True,is_state_refresh=False,message=message,
-                                 targets=ControllerLogData._parse_targets(targets))
+                                 targets=CtrlLogTarget.of(targets))
     @staticmethod
-    def log_state_refresh(targets:set[CtrlLogTarget]|CtrlLogTarget|None=None,message:str="")->'ControllerLogData':
+    def log_state_refresh(targets:CtrlLogTarget|Iterable[CtrlLogTarget]|None=None,message:str="")->'ControllerLogData':
         return ControllerLogData(is_action=False,is_modbus_error=False,is_state_refresh=True,message="",
-                                 targets=ControllerLogData._parse_targets(targets))
+                                 targets=CtrlLogTarget.of(targets))
+
+CONTROLLER_CODEC = make_history_codec(ControllerLogData)
+"Converts ControllerLogData to and from the rows of either format of the controller history file."
     
 
 
@@ -280,7 +938,7 @@ class _CtrlFileManager:
     @staticmethod
     def write_headers(writer:CSV_Writer): #type:ignore
         "Fill out the headers for"
-        writer.writerow(['Time', 'is_action','is_modbus_error', 'is_state_refresh','targets','message'])
+        writer.writerow(CONTROLLER_CODEC.headers)
 
     @staticmethod
     def _write_data(writer:CSV_Writer,rows:Iterable[Iterable[Any]]): #type:ignore
@@ -288,15 +946,7 @@ class _CtrlFileManager:
 
     @staticmethod
     def _data_to_rows(data:ControllerLogData)->Iterable[Any]:
-        row = []
-        # row.append(data.timestamp.isoformat())                        # Universally recognized
-        row.append(data.timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'))     # Excel Friendly & more readable
-        row.append(data.is_action)
-        row.append(data.is_modbus_error)
-        row.append(data.is_state_refresh)
-        row.append(CtrlLogTarget.set_to_string(data.targets))
-        row.append(data.message)
-        return row
+        return CONTROLLER_CODEC.to_row(data)
     
     @staticmethod
     def write_data(writer:CSV_Writer,data:ControllerLogData): #type:ignore
@@ -305,65 +955,1418 @@ class _CtrlFileManager:
     @staticmethod
     def write_datas(writer:CSV_Writer,datas:Iterable[ControllerLogData]): #type:ignore
         _CtrlFileManager._write_data(writer,rows=[_CtrlFileManager._data_to_rows(d) for d in datas])
+
+    @staticmethod
+    def encoding(history_format:HistoryFormat, history_file:Path)->_HistoryEncoding:
+        "How the history loggers write this file in the given format. Controller events don't repeat like environment ticks, so HistoryFormat.delta writes them as binary."
+        if history_format in (HistoryFormat.binary, HistoryFormat.delta):
+            return _binary_controller_encoding(history_file)
+        return _csv_encoding(_CtrlFileManager.write_headers, CONTROLLER_CODEC.to_row)
     
     @staticmethod
-    def read_all_data(history_file:Path)-> Generator[ControllerLogData,None,None]:
-        "Reads from the start of the file to the end"
-        with open(file=history_file, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader) #Ignore headers
-            for row in reader:
-                yield ControllerLogData(
-                    timestamp           = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f'),
-                    is_action           = bool(row[1]),
-                    is_modbus_error     = bool(row[2]),
-                    is_state_refresh    = bool(row[3]),
-                    targets             = CtrlLogTarget.string_to_set(row[4]),
-                    message             = str(row[5])
-                )
+    def read_all_data(history_file:Path, start:datetime|None=None, end:datetime|None=None)-> Generator[ControllerLogData,None,None]:
+        "Reads from the start of the file to the end, or only the rows with `start` <= timestamp <= `end`, found through the file's time index."
+        yield from map(CONTROLLER_CODEC.from_row, _csv_rows_between(history_file, start, end))
     
     @staticmethod
     def read_as_dataframe(history_file:RemotablePath)->pd.DataFrame:
-        "Reads as dataframe with appropriate converters."
-        
-        def to_bool(x): return x.lower() in ('true', '1', 'yes')
-        converters = {
-            'Time': lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S.%f'),
-            'is_action': to_bool,
-            'is_modbus_error': to_bool,
-            'is_state_refresh': to_bool,
-            'targets': CtrlLogTarget.string_to_set,
-            'message': str
-        }
+        """
+        Reads as dataframe. Like _HistFileManager.read_as_dataframe, columns are parsed whole by pandas.
+        `targets` is a column of CtrlLogTarget bits, filter it with targets_include().
+        """
         with remotable_as_local_file(history_file) as local_history_file:
-            return pd.read_csv(local_history_file, converters=converters)
+            if is_binary_history_file(local_history_file):
+                return MappedControllerHistory(local_history_file).to_dataframe()
+            with _open_history_rows(local_history_file) as f:
+                return _CtrlFileManager.parse_csv(f)
+
+    @staticmethod
+    def parse_csv(source:Path|IO[bytes])->pd.DataFrame:
+        "Parses CSV rows (with their headers) from a file or buffer into the dataframe read_as_dataframe returns."
+        return CONTROLLER_CODEC.parse_csv(source)
 
 class _ControllerHistoryLogger:
-    "This is the object held by the program provided by a context manager [update_control_history_file()]. This edits the file line by line so it can be viewed live."
-    def __init__(self,history_file:Path):
+    "This is the object held by the program provided by a context manager [update_control_history_file()]. This buffers rows and writes them in batches (see FlushPolicy), from a background thread unless `writer_thread` is None."
+    def __init__(self,history_file:Path,flush_policy:FlushPolicy=FlushPolicy(),writer_thread:WriterThreadPolicy|None=WriterThreadPolicy(),
+                 history_format:HistoryFormat=HistoryFormat.csv,segments:SegmentPolicy|None=None,compression:HistoryCompression=HistoryCompression.none,
+                 database_run:'results_run|None'=None):
         self.file = history_file
-        with open(file=self.file,mode='w') as f:
-            writer = csv.writer(f)
-            _CtrlFileManager.write_headers(writer)
+        self.flush_policy = flush_policy
+        self._writer = _make_history_writer(history_file, lambda file: _CtrlFileManager.encoding(history_format, file), flush_policy, writer_thread, segments, compression,
+                                            (database_run, CONTROLLER_EVENTS) if database_run is not None else None)
+
+    @property
+    def metrics(self)->history_writer_metrics|None:
+        "Queue depth and write latency of the background writer thread, None if writing on the caller's thread."
+        return self._writer.metrics if isinstance(self._writer, _ThreadedHistoryWriter) else None
+
+    @property
+    def compression_metrics(self)->'compression_metrics':
+        "Compression ratio and the CPU time spent compressing, if the file is compressed."
+        return self._writer.compression_metrics
 
     def save(self,data:ControllerLogData):
-        with open(file=self.file, mode='a') as f:
-            writer = csv.writer(f)
-            _CtrlFileManager.write_data(writer,data)
+        self._writer.write(data)
+
+    def flush_if_due(self): self._writer.flush_if_due()
+    def flush(self):        self._writer.flush()
+    def close(self):        self._writer.close()
 
 @asynccontextmanager
-async def update_control_history_file(history_file:Path):
+async def update_control_history_file(history_file:Path, flush_policy:FlushPolicy=FlushPolicy(), writer_thread:WriterThreadPolicy|None=WriterThreadPolicy(),
+                                    history_format:HistoryFormat=HistoryFormat.csv, segments:SegmentPolicy|None=None,
+                                    compression:HistoryCompression=HistoryCompression.none, database_run:'results_run|None'=None):
+    """
+    use a with statement `with update_control_history_file(...) as writer` to use this. Everything saved is written by the time the with block exits.
+    With `segments`, history_file only names the segment files and their index (see SegmentPolicy, SegmentedHistory).
+    With `compression`, the file is compressed as it is written; give history_file the codec's suffix (see Compressed History Files).
+    With `database_run`, rows are inserted into that run of a results database instead of written to history_file (see SQLite Results Database).
+    """
     try:
-        ctrl_log = _ControllerHistoryLogger(history_file)
+        ctrl_log = _ControllerHistoryLogger(history_file, flush_policy, writer_thread, history_format, segments, compression, database_run)
+        flush_task = _start_flushing_periodically(ctrl_log)
         
         try:
             yield ctrl_log
         except Exception as e:
                 raise e #Don't actually catch errors
+        finally:
+            flush_task.cancel()
+            ctrl_log.close()
     except Exception as e:
         log.exception(f"Exception Occoured in Save_Results.")
         # Normally swallows exceptions, so at least we can see it now.
 
-def read_control_history_file(history_file:Path)->Iterable[ControllerLogData]:
-    "This returns an iterator from the contents of the controller log data, which can be itterated over in a for loop, reading the data as it is accessed from the iterator"
-    return _CtrlFileManager.read_all_data(history_file)
\ No newline at end of file
+def read_control_history_file(history_file:Path, start:datetime|None=None, end:datetime|None=None)->Iterable[ControllerLogData]:
+    """
+    This returns an iterator from the contents of the controller log data, which can be itterated over in a for loop, reading the data as it is accessed from the iterator.
+    Give `start` and/or `end` to only read the rows in that time window, like read_state_history_file.
+    """
+    if is_binary_history_file(history_file):
+        return MappedControllerHistory(history_file).read_all_data(start, end)
+    return _CtrlFileManager.read_all_data(history_file, start, end)
+
+########################################################[ Binary History Files ]########################################################
+# A compact alternative to the history CSVs (HistoryFormat.binary). After a short header, every row is a fixed-width record:
+# an int64 nanosecond timestamp, then the row's values, with its booleans packed into the bits of one byte.
+# Being fixed-width, the file can be memory-mapped and each field read as a NumPy column without parsing or copying anything.
+#
+# Timestamps are the naive datetimes the CSVs hold, counted in ns from 1970-01-01, so `time_ns.view('datetime64[ns]')` gives the same times pandas reads from a CSV.
+# Controller messages are variable length, so they live in a message table next to the file (`<file>.messages`, one JSON string per line)
+# and each record holds the index of its message in it.
+
+_BINARY_HEADER = np.dtype([('magic','S8'), ('version','<u4'), ('record_size','<u4')])
+"Written once at the start of every binary history file."
+_BINARY_VERSION = 1
+_ENVIRONMENT_MAGIC = b"ENVHIST\0"
+_CONTROLLER_MAGIC  = b"CTRLHIST"
+
+ENVIRONMENT_RECORD = ENVIRONMENT_CODEC.record
+"One EnvironmentLogData in a binary history file: [time_ns <i8, level <f8, flags u1]."
+CONTROLLER_RECORD = CONTROLLER_CODEC.record
+"One ControllerLogData in a binary history file: [time_ns <i8, flags u1, targets u1, message_id <u4]."
+
+# Bits of ENVIRONMENT_RECORD['flags']
+PUMP_ACTIVE_BIT         = ENVIRONMENT_CODEC.bits['pump_active']
+UPPER_SENSOR_ACTIVE_BIT = ENVIRONMENT_CODEC.bits['upper_sensor_active']
+LOWER_SENSOR_ACTIVE_BIT = ENVIRONMENT_CODEC.bits['lower_sensor_active']
+OVERFLOWING_BIT         = ENVIRONMENT_CODEC.bits['overflowing']
+EMPTY_BIT               = ENVIRONMENT_CODEC.bits['empty']
+
+# Bits of CONTROLLER_RECORD['flags']
+IS_ACTION_BIT           = CONTROLLER_CODEC.bits['is_action']
+IS_MODBUS_ERROR_BIT     = CONTROLLER_CODEC.bits['is_modbus_error']
+IS_STATE_REFRESH_BIT    = CONTROLLER_CODEC.bits['is_state_refresh']
+
+def _binary_header(magic:bytes, record:np.dtype)->bytes:
+    return np.array([(magic, _BINARY_VERSION, record.itemsize)], dtype=_BINARY_HEADER).tobytes()
+
+def _messages_file(history_file:Path)->Path:
+    "The message table is never compressed, and is shared by the file and its compressed copy."
+    if history_file.suffix in _COMPRESSION_SUFFIXES:
+        history_file = history_file.with_suffix("")
+    return history_file.with_name(history_file.name + ".messages")
+
+def _binary_environment_encoding()->_HistoryEncoding:
+    def encode(datas:list[EnvironmentLogData]) -> bytes:
+        return np.array(list(map(ENVIRONMENT_CODEC.to_record, datas)), dtype=ENVIRONMENT_RECORD).tobytes()
+    return _HistoryEncoding(_binary_header(_ENVIRONMENT_MAGIC, ENVIRONMENT_RECORD), encode)
+
+def _binary_controller_encoding(history_file:Path)->_HistoryEncoding:
+    "New messages are appended to the message table before the records using them are returned, so a reader never sees a record without its message."
+    messages_file = _messages_file(history_file)
+    messages_file.write_text("")
+    message_ids:dict[str,int] = {}
+
+    def message_id(message:str) -> int:
+        if message not in message_ids:
+            with open(file=messages_file, mode='a') as f:
+                f.write(json.dumps(message) + "\n")
+            message_ids[message] = len(message_ids)
+        return message_ids[message]
+
+    def encode(datas:list[ControllerLogData]) -> bytes:
+        return np.array([CONTROLLER_CODEC.to_record(d, message_id) for d in datas], dtype=CONTROLLER_RECORD).tobytes()
+    return _HistoryEncoding(_binary_header(_CONTROLLER_MAGIC, CONTROLLER_RECORD), encode)
+
+def is_binary_history_file(history_file:Path)->bool:
+    "True if the file starts with a binary (or delta encoded) history header, rather than CSV headers (once decompressed, if it is compressed)."
+    with _open_history_file(history_file) as f:
+        magic = f.read(len(_ENVIRONMENT_MAGIC))
+    return magic in (_ENVIRONMENT_MAGIC, _CONTROLLER_MAGIC, _DELTA_MAGIC)
+
+def _map_records(history_file:Path, magic:bytes, record:np.dtype)->np.ndarray:
+    """
+    Maps every complete record of the file. A record still being written at the end is left out.
+    A compressed file can't be mapped, so it is decompressed into memory instead.
+    """
+    if history_compression(history_file) is not HistoryCompression.none:
+        with _open_history_file(history_file) as f:
+            data = f.read()
+        header = np.frombuffer(data, dtype=_BINARY_HEADER, count=1 if len(data) >= _BINARY_HEADER.itemsize else 0)
+        body = data[_BINARY_HEADER.itemsize:]
+        records = np.frombuffer(body, dtype=record, count=len(body) // record.itemsize)
+    else:
+        header = np.fromfile(history_file, dtype=_BINARY_HEADER, count=1)
+        records = None
+    if len(header) == 0 or header['magic'][0] != magic.rstrip(b"\0"):
+        raise ValueError(f"{history_file} is not a binary history file of this type.")
+    if header['version'][0] != _BINARY_VERSION or header['record_size'][0] != record.itemsize:
+        raise ValueError(f"{history_file} was written by an incompatible version (version {header['version'][0]}, {header['record_size'][0]} byte records).")
+
+    if records is not None:
+        return records
+    count = (os.path.getsize(history_file) - _BINARY_HEADER.itemsize) // record.itemsize
+    if count == 0:
+        return np.empty(0, dtype=record)
+    return np.memmap(history_file, dtype=record, mode='r', offset=_BINARY_HEADER.itemsize, shape=(count,))
+
+def _environment_records_to_dataframe(records:np.ndarray)->pd.DataFrame:
+    return ENVIRONMENT_CODEC.records_to_dataframe(records)
+
+def _controller_records_to_dataframe(records:np.ndarray, messages:list[str])->pd.DataFrame:
+    return CONTROLLER_CODEC.records_to_dataframe(records, messages)
+
+def _read_messages(messages_file:Path)->list[str]:
+    "Reads a controller message table. A message still being written at the end is left out."
+    with open(file=messages_file, mode='r') as f:
+        return [json.loads(line) for line in f if line.endswith("\n")]
+
+def _records_between(time_ns:np.ndarray, start:datetime|None, end:datetime|None)->slice:
+    first = int(np.searchsorted(time_ns, _datetime_to_ns(start), side='left'))  if start is not None else 0
+    last  = int(np.searchsorted(time_ns, _datetime_to_ns(end), side='right'))   if end is not None else len(time_ns)
+    return slice(first, max(first, last))
+
+READ_CHUNK_RECORDS = 10_000
+"Records of a mapped history turned into python values at a time when it is iterated, so iterating doesn't read the whole file into memory."
+
+def _record_values(records:np.ndarray, rows:slice)->Generator[tuple,None,None]:
+    "The values of each of `records[rows]`, a chunk at a time."
+    for first in range(rows.start, rows.stop, READ_CHUNK_RECORDS):
+        yield from records[first:min(first + READ_CHUNK_RECORDS, rows.stop)].tolist()
+
+class MappedEnvironmentHistory:
+    """
+    A binary environment history file, memory-mapped. `time_ns`, `level` and `flags` are views into the file, so nothing is read until used.
+    The boolean columns unpack one bit of `flags` each, which does make a (one byte per row) array.
+    A delta encoded file can't be mapped, it is decoded into the same records in memory.
+    """
+    def __init__(self, history_file:Path):
+        self.file = history_file
+        if is_delta_history_file(history_file):
+            self.records = _read_delta_records(history_file)
+        else:
+            self.records = _map_records(history_file, _ENVIRONMENT_MAGIC, ENVIRONMENT_RECORD)
+
+    def __len__(self)->int:             return len(self.records)
+    @property
+    def time_ns(self)->np.ndarray:      return self.records['time_ns']
+    @property
+    def timestamps(self)->np.ndarray:   return self.records['time_ns'].view('datetime64[ns]')
+    @property
+    def level(self)->np.ndarray:        return self.records['level']
+    @property
+    def flags(self)->np.ndarray:        return self.records['flags']
+
+    @property
+    def pump_active(self)->np.ndarray:          return (self.flags & PUMP_ACTIVE_BIT) != 0
+    @property
+    def upper_sensor_active(self)->np.ndarray:  return (self.flags & UPPER_SENSOR_ACTIVE_BIT) != 0
+    @property
+    def lower_sensor_active(self)->np.ndarray:  return (self.flags & LOWER_SENSOR_ACTIVE_BIT) != 0
+    @property
+    def overflowing(self)->np.ndarray:          return (self.flags & OVERFLOWING_BIT) != 0
+    @property
+    def empty(self)->np.ndarray:                return (self.flags & EMPTY_BIT) != 0
+
+    def to_dataframe(self)->pd.DataFrame:
+        "The same columns as _HistFileManager.read_as_dataframe gives for the CSV."
+        return _environment_records_to_dataframe(self.records)
+
+    def between(self, start:datetime|None=None, end:datetime|None=None)->slice:
+        "The rows with `start` <= timestamp <= `end`, found by binary search."
+        return _records_between(self.time_ns, start, end)
+
+    def read_all_data(self, start:datetime|None=None, end:datetime|None=None)->Generator[EnvironmentLogData,None,None]:
+        yield from map(ENVIRONMENT_CODEC.from_record, _record_values(self.records, self.between(start, end)))
+
+class MappedControllerHistory:
+    "A binary controller history file, memory-mapped, with its message table loaded. Works like MappedEnvironmentHistory."
+    def __init__(self, history_file:Path):
+        self.file = history_file
+        self.records = _map_records(history_file, _CONTROLLER_MAGIC, CONTROLLER_RECORD)
+        self.messages:list[str] = _read_messages(_messages_file(history_file))
+        missing = np.flatnonzero(self.records['message_id'] >= len(self.messages))
+        if len(missing) > 0: # Written after their message was, but the message didn't reach the disk: a torn tail.
+            self.records = self.records[:missing[0]]
+
+    def __len__(self)->int:             return len(self.records)
+    @property
+    def time_ns(self)->np.ndarray:      return self.records['time_ns']
+    @property
+    def timestamps(self)->np.ndarray:   return self.records['time_ns'].view('datetime64[ns]')
+    @property
+    def flags(self)->np.ndarray:        return self.records['flags']
+    @property
+    def targets(self)->np.ndarray:      return self.records['targets']
+    @property
+    def message_id(self)->np.ndarray:   return self.records['message_id']
+
+    @property
+    def is_action(self)->np.ndarray:        return (self.flags & IS_ACTION_BIT) != 0
+    @property
+    def is_modbus_error(self)->np.ndarray:  return (self.flags & IS_MODBUS_ERROR_BIT) != 0
+    @property
+    def is_state_refresh(self)->np.ndarray: return (self.flags & IS_STATE_REFRESH_BIT) != 0
+
+    def targets_include(self, target:CtrlLogTarget)->np.ndarray:
+        return targets_include(self.targets, target)
+
+
+    def to_dataframe(self)->pd.DataFrame:
+        "The same columns as _CtrlFileManager.read_as_dataframe gives for the CSV."
+        return _controller_records_to_dataframe(self.records, self.messages)
+
+    def between(self, start:datetime|None=None, end:datetime|None=None)->slice:
+        "The rows with `start` <= timestamp <= `end`, found by binary search."
+        return _records_between(self.time_ns, start, end)
+
+    def read_all_data(self, start:datetime|None=None, end:datetime|None=None)->Generator[ControllerLogData,None,None]:
+        for values in _record_values(self.records, self.between(start, end)):
+            yield CONTROLLER_CODEC.from_record(values, self.messages)
+
+CONVERT_BATCH_ROWS = 10_000
+"Rows per batch (and per block, for the delta encoding) when converting a history file."
+
+def convert_history_file(source:Path, destination:Path, history_format:HistoryFormat|None=None)->None:
+    """
+    Converts a history file to `history_format`; by default between CSV and binary (or delta), whichever it isn't already.
+    Works for both environment and controller histories (a controller history converted to delta is written as binary).
+    Lets the CSV tooling keep working on binary runs, lets old CSV runs be mapped, and lets finished runs be delta encoded.
+    A compressed source is decompressed as it is read, but `destination` is always written uncompressed, even if its name ends in `.gz` etc.
+    """
+    if is_binary_history_file(source):
+        with _open_history_file(source) as f:
+            magic = f.read(len(_ENVIRONMENT_MAGIC))
+        if magic in (_ENVIRONMENT_MAGIC, _DELTA_MAGIC):
+            if history_format is HistoryFormat.delta:
+                return _write_delta_file(destination, MappedEnvironmentHistory(source).records)
+            datas:Iterable[Any] = MappedEnvironmentHistory(source).read_all_data()
+            encoding = _HistFileManager.encoding(history_format or HistoryFormat.csv, destination)
+        else:
+            datas = MappedControllerHistory(source).read_all_data()
+            encoding = _CtrlFileManager.encoding(history_format or HistoryFormat.csv, destination)
+    else:
+        with _open_history_rows(source) as f:
+            headers = next(csv.reader(io.TextIOWrapper(f, newline='')))
+        if headers[1] == 'level':
+            frame = _HistFileManager.read_as_dataframe(LocalPath(source))
+            if history_format is HistoryFormat.delta:
+                return _write_delta_file(destination, _environment_dataframe_to_records(frame))
+            datas = (EnvironmentLogData(time_ns=r.Time.as_unit('ns').value, water_level=r.level, pump_active=r.is_pump_on,
+                                        upper_sensor_active=r.is_upper_sensor_active, lower_sensor_active=r.is_lower_sensor_active,
+                                        overflowing=r.is_overflowing, empty=r.is_empty)
+                     for r in frame.itertuples())
+            encoding = _HistFileManager.encoding(history_format or HistoryFormat.binary, destination)
+        else:
+            datas = (ControllerLogData(time_ns=r.Time.as_unit('ns').value, is_action=r.is_action, is_modbus_error=r.is_modbus_error,
+                                       is_state_refresh=r.is_state_refresh, targets=r.targets, message=r.message)
+                     for r in _CtrlFileManager.read_as_dataframe(LocalPath(source)).itertuples())
+            encoding = _CtrlFileManager.encoding(history_format or HistoryFormat.binary, destination)
+
+    with open(file=destination, mode='wb') as f:
+        f.write(encoding.header)
+        batch:list[Any] = []
+        for data in datas:
+            batch.append(data)
+            if len(batch) >= CONVERT_BATCH_ROWS:
+                f.write(encoding.encode(batch))
+                batch = []
+        if len(batch) > 0:
+            f.write(encoding.encode(batch))
+
+########################################################[ Delta Encoded Environment History ]########################################################
+# The most compact environment history (HistoryFormat.delta). A run's ticks are evenly spaced, its level moves by the same step
+# (the pump or leak rate) tick after tick, and its flags stay the same for hundreds of ticks; so each column is stored as runs:
+#   - time_ns and level as (start, step, count) runs, row k of a run being exactly `start + k*step`,
+#   - flags as (flags, count) runs, i.e. only their transitions.
+# A level only joins a run if `start + k*step` reproduces it bit for bit, so decoding is lossless; rows that don't fit start a new run.
+#
+# After the usual binary header (with a record size of 0), the file is a sequence of self-contained blocks, one per batch the writer flushes:
+# a _DELTA_BLOCK header, then its time, level and flag runs. A reader following the file decodes every complete block.
+# Runs never cross blocks, so the encoding pays off with big batches; with one row per flush it is bigger than the binary format.
+
+_DELTA_MAGIC = b"ENVDELTA"
+_DELTA_VERSION = 1
+_DELTA_BLOCK = np.dtype([('size','<u4'), ('rows','<u4'), ('time_runs','<u4'), ('level_runs','<u4'), ('flag_runs','<u4')])
+"Starts every block. `size` is the bytes of runs after it."
+_DELTA_TIME_RUN  = np.dtype([('start','<i8'), ('step','<i8'), ('count','<u4')])
+_DELTA_LEVEL_RUN = np.dtype([('start','<f8'), ('step','<f8'), ('count','<u4')])
+_DELTA_FLAG_RUN  = np.dtype([('flags','u1'), ('count','<u4')])
+
+def _same_float(a:float, b:float)->bool:
+    "Bit for bit, so -0.0 isn't taken for 0.0."
+    return a == b and math.copysign(1, a) == math.copysign(1, b)
+
+def _step_runs(values:list[Any], same:Callable[[Any,Any],bool])->list[tuple[Any,Any,int]]:
+    "Splits values into (start, step, count) runs, greedily making each as long as `start + k*step` keeps giving the next value."
+    runs = []
+    i = 0
+    while i < len(values):
+        start = values[i]
+        step = values[i+1] - start if i+1 < len(values) else start - start
+        count = 1
+        while i+count < len(values) and same(start + count*step, values[i+count]):
+            count += 1
+        runs.append((start, step, count))
+        i += count
+    return runs
+
+def _flag_runs(flags:list[int])->list[tuple[int,int]]:
+    runs:list[tuple[int,int]] = []
+    for f in flags:
+        if len(runs) > 0 and runs[-1][0] == f:
+            runs[-1] = (f, runs[-1][1] + 1)
+        else:
+            runs.append((f, 1))
+    return runs
+
+def _encode_delta_block(time_ns:list[int], levels:list[float], flags:list[int])->bytes:
+    time_runs   = np.array(_step_runs(time_ns, int.__eq__), dtype=_DELTA_TIME_RUN).tobytes()
+    level_runs  = np.array(_step_runs(levels, _same_float), dtype=_DELTA_LEVEL_RUN).tobytes()
+    flag_runs   = np.array(_flag_runs(flags), dtype=_DELTA_FLAG_RUN).tobytes()
+    header = np.array([(len(time_runs) + len(level_runs) + len(flag_runs), len(time_ns),
+                        len(time_runs) // _DELTA_TIME_RUN.itemsize, len(level_runs) // _DELTA_LEVEL_RUN.itemsize,
+                        len(flag_runs) // _DELTA_FLAG_RUN.itemsize)], dtype=_DELTA_BLOCK)
+    return header.tobytes() + time_runs + level_runs + flag_runs
+
+def _delta_environment_encoding()->_HistoryEncoding:
+    def encode(datas:list[EnvironmentLogData]) -> bytes:
+        if len(datas) == 0:
+            return b""
+        time_ns, levels, flags = zip(*map(ENVIRONMENT_CODEC.to_record, datas))
+        return _encode_delta_block(list(time_ns), [float(l) for l in levels], list(flags))
+    header = np.array([(_DELTA_MAGIC, _DELTA_VERSION, 0)], dtype=_BINARY_HEADER).tobytes()
+    return _HistoryEncoding(header, encode)
+
+def _expand_step_runs(runs:np.ndarray)->np.ndarray:
+    "The values of (start, step, count) runs, `start + k*step` computed the same way the encoder checked them."
+    counts = runs['count'].astype(np.int64)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(runs['start'], counts)
+    with np.errstate(invalid='ignore', over='ignore'): # e.g. 0*inf, only ever at k == 0, which isn't used.
+        return np.where(k == 0, starts, starts + k.astype(runs['step'].dtype) * np.repeat(runs['step'], counts))
+
+def _decode_delta_blocks(data:bytes)->tuple[np.ndarray,int]:
+    "Decodes every complete block at the start of data into ENVIRONMENT_RECORDs, and returns them with how many bytes that used."
+    blocks = []
+    offset = 0
+    while offset + _DELTA_BLOCK.itemsize <= len(data):
+        block = np.frombuffer(data, dtype=_DELTA_BLOCK, count=1, offset=offset)[0]
+        end = offset + _DELTA_BLOCK.itemsize + int(block['size'])
+        if end > len(data):
+            break
+        runs = offset + _DELTA_BLOCK.itemsize
+        time_runs = np.frombuffer(data, dtype=_DELTA_TIME_RUN, count=int(block['time_runs']), offset=runs)
+        runs += time_runs.nbytes
+        level_runs = np.frombuffer(data, dtype=_DELTA_LEVEL_RUN, count=int(block['level_runs']), offset=runs)
+        runs += level_runs.nbytes
+        flag_runs = np.frombuffer(data, dtype=_DELTA_FLAG_RUN, count=int(block['flag_runs']), offset=runs)
+
+        records = np.empty(int(block['rows']), dtype=ENVIRONMENT_RECORD)
+        records['time_ns'] = _expand_step_runs(time_runs)
+        records['level'] = _expand_step_runs(level_runs)
+        records['flags'] = np.repeat(flag_runs['flags'], flag_runs['count'].astype(np.int64))
+        blocks.append(records)
+        offset = end
+    if len(blocks) == 0:
+        return np.empty(0, dtype=ENVIRONMENT_RECORD), offset
+    return np.concatenate(blocks), offset
+
+def _environment_dataframe_to_records(frame:pd.DataFrame)->np.ndarray:
+    "The ENVIRONMENT_RECORDs of a dataframe read from an environment history."
+    records = np.empty(len(frame), dtype=ENVIRONMENT_RECORD)
+    records['time_ns'] = frame['Time'].to_numpy().astype('datetime64[ns]').view('<i8')
+    records['level'] = frame['level'].to_numpy()
+    records['flags'] = (np.where(frame['is_pump_on'], PUMP_ACTIVE_BIT, 0) |
+                        np.where(frame['is_upper_sensor_active'], UPPER_SENSOR_ACTIVE_BIT, 0) |
+                        np.where(frame['is_lower_sensor_active'], LOWER_SENSOR_ACTIVE_BIT, 0) |
+                        np.where(frame['is_overflowing'], OVERFLOWING_BIT, 0) |
+                        np.where(frame['is_empty'], EMPTY_BIT, 0))
+    return records
+
+def _write_delta_file(destination:Path, records:np.ndarray)->None:
+    "Delta encodes whole records, CONVERT_BATCH_ROWS to a block, without making an EnvironmentLogData of each."
+    encoding = _delta_environment_encoding()
+    with open(file=destination, mode='wb') as f:
+        f.write(encoding.header)
+        for i in range(0, len(records), CONVERT_BATCH_ROWS):
+            batch = records[i:i+CONVERT_BATCH_ROWS]
+            f.write(_encode_delta_block(batch['time_ns'].tolist(), batch['level'].tolist(), batch['flags'].tolist()))
+
+def is_delta_history_file(history_file:Path)->bool:
+    with _open_history_file(history_file) as f:
+        return f.read(len(_DELTA_MAGIC)) == _DELTA_MAGIC
+
+def _read_delta_records(history_file:Path)->np.ndarray:
+    "Decodes a whole delta encoded file. A block still being written at the end is left out."
+    with _open_history_file(history_file) as f:
+        data = f.read()
+    header = np.frombuffer(data, dtype=_BINARY_HEADER, count=1)
+    if header['version'][0] != _DELTA_VERSION:
+        raise ValueError(f"{history_file} was written by an incompatible version (version {header['version'][0]}).")
+    records, _ = _decode_delta_blocks(data[_BINARY_HEADER.itemsize:])
+    return records
+
+########################################################[ Incremental History Reading ]########################################################
+# For watching a history file while a run is still writing it (e.g. Render_Graphs' periodic update), without rereading the whole file each time.
+
+@dataclass
+class history_tail:
+    "What a HistoryTailReader found since its last read."
+    rows:pd.DataFrame
+    "The new rows, with the same columns read_as_dataframe gives."
+    reset:bool
+    "True if `rows` start at the beginning of the file: on the first read, and after the file was truncated or replaced (a new run started). Throw away anything read before."
+
+    def columns(self)->dict[str,np.ndarray]:
+        "The new rows as one NumPy array per column."
+        return {name: self.rows[name].to_numpy() for name in self.rows.columns}
+
+class HistoryTailReader:
+    """
+    Reads a growing history file (environment or controller, CSV or binary) incrementally.
+    Each read_new() parses only what was appended since the previous call. It remembers how far into the file it has read
+    and holds on to a partial last line (or record) until the rest of it is written.
+
+    A new run truncating or replacing the file is noticed by the file's inode, its size shrinking,
+    or its first bytes (header and first rows) changing; reading then starts again from the top.
+    A compressed file is decompressed as it is read, up to the last frame its writer flushed.
+    CSV rows are split at line ends, so a message containing a newline would be split too (the controller never writes one).
+    """
+    _PREFIX_BYTES = 256
+    "How much of the start of the file is remembered to notice it being replaced."
+
+    def __init__(self, history_file:RemotablePath|Path):
+        self.file:RemotablePath = LocalPath(history_file) if isinstance(history_file, Path) else history_file
+        self._restart()
+
+    def _restart(self)->None:
+        self._inode:int|None = None
+        self._offset = 0
+        "Bytes of the file read so far, including the partial line."
+        self._prefix = b""
+        self._header = b""
+        self._partial = b""
+        self._binary_magic:bytes|None = None
+        self._record:np.dtype|None = None
+        self._parse_csv:Callable[[IO[bytes]],pd.DataFrame]|None = None
+        self._delta = False
+        self._decoder:_FrameDecoder|None = None
+        self._undecoded = b""
+        "The first bytes of the file, kept until there are enough to tell if it is compressed."
+
+    def read_new(self)->history_tail:
+        with remotable_as_local_file(self.file) as local_file:
+            with open(file=local_file, mode='rb') as f:
+                stat = os.fstat(f.fileno())
+                reset = self._offset == 0
+                if not reset and (stat.st_ino != self._inode or stat.st_size < self._offset or f.read(len(self._prefix)) != self._prefix):
+                    self._restart()
+                    reset = True
+                self._inode = stat.st_ino
+                f.seek(self._offset)
+                new = f.read()
+                self._offset += len(new)
+                if len(self._prefix) < self._PREFIX_BYTES:
+                    f.seek(0)
+                    self._prefix = f.read(min(self._offset, self._PREFIX_BYTES))
+
+            data = self._partial + self._decompress(new)
+            if not self._knows_kind:
+                data = self._read_header(data)
+                if not self._knows_kind:
+                    self._partial = data
+                    return history_tail(pd.DataFrame(), reset)
+            if self._delta:
+                return history_tail(self._parse_blocks(data), reset)
+            if self._record is not None:
+                return history_tail(self._parse_records(local_file, data), reset)
+            return history_tail(self._parse_lines(data), reset)
+
+    @property
+    def _knows_kind(self)->bool:
+        return self._parse_csv is not None or self._record is not None or self._delta
+
+    def _decompress(self, new:bytes)->bytes:
+        if self._decoder is None:
+            self._undecoded += new
+            if len(self._undecoded) < _COMPRESSION_MAGIC_BYTES:
+                return b""
+            new, self._undecoded = self._undecoded, b""
+            self._decoder = _FrameDecoder(_compression_of(new))
+        return self._decoder.decompress(new)
+
+    def _read_header(self, data:bytes)->bytes:
+        "Works out what kind of file this is from its header and returns the data after the header. Waits (keeping the data) until the header is complete."
+        if data[:len(_DELTA_MAGIC)] == _DELTA_MAGIC:
+            if len(data) < _BINARY_HEADER.itemsize:
+                return data
+            self._delta = True
+            return data[_BINARY_HEADER.itemsize:]
+        if data[:len(_ENVIRONMENT_MAGIC)] in (_ENVIRONMENT_MAGIC, _CONTROLLER_MAGIC):
+            if len(data) < _BINARY_HEADER.itemsize:
+                return data
+            self._binary_magic = data[:len(_ENVIRONMENT_MAGIC)]
+            self._record = ENVIRONMENT_RECORD if self._binary_magic == _ENVIRONMENT_MAGIC else CONTROLLER_RECORD
+            return data[_BINARY_HEADER.itemsize:]
+
+        end = data.find(b"\n")
+        if end < 0:
+            return data
+        self._header = data[:end+1]
+        headers = next(csv.reader([self._header.decode()]))
+        self._parse_csv = _HistFileManager.parse_csv if headers[1] == 'level' else _CtrlFileManager.parse_csv
+        return data[end+1:]
+
+    def _parse_lines(self, data:bytes)->pd.DataFrame:
+        parse_csv:Callable[[IO[bytes]],pd.DataFrame] = self._parse_csv #type:ignore
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        return parse_csv(io.BytesIO(self._header + data[:end]))
+
+    def _parse_blocks(self, data:bytes)->pd.DataFrame:
+        records, end = _decode_delta_blocks(data)
+        self._partial = data[end:]
+        return _environment_records_to_dataframe(records)
+
+    def _parse_records(self, local_file:Path, data:bytes)->pd.DataFrame:
+        record:np.dtype = self._record #type:ignore
+        end = len(data) - len(data) % record.itemsize
+        self._partial = data[end:]
+        records = np.frombuffer(data[:end], dtype=record)
+        if self._binary_magic == _ENVIRONMENT_MAGIC:
+            return _environment_records_to_dataframe(records)
+        return _controller_records_to_dataframe(records, _read_messages(_messages_file(local_file)) if len(records) > 0 else [])
+
+########################################################[ Segmented History Files ]########################################################
+# With a SegmentPolicy, a history is written as numbered segment files next to where the single file would have been
+# (`EnvironmentHistory.000001.csv`, `EnvironmentHistory.000002.csv`, ...), plus an index (`EnvironmentHistory.index.json`)
+# recording each segment's time range and row count. A reader asked for a time window only opens the segments that overlap it.
+#
+# The index is rewritten (atomically) whenever a segment is opened, closed or compressed. The open segment's entry isn't kept up to date
+# in between, so readers treat it as running to the end of time. A compressed segment's plain file is only removed once the index
+# points at its `.gz`, and a reader holding an older index falls back to the `.gz` when the plain file is gone.
+
+_SEGMENT_INDEX_VERSION = 1
+
+def _split_history_name(history_file:Path)->tuple[str,str]:
+    "Splits a history file's name into its stem and its suffixes, keeping `.csv.gz` together."
+    compressed = history_file.suffix in _COMPRESSION_SUFFIXES
+    name = history_file.with_suffix("") if compressed else history_file
+    return name.stem, name.suffix + (history_file.suffix if compressed else "")
+
+def segment_index_file(history_file:Path)->Path:
+    "Where the index of a segmented history is written, for the history file path given to the writer."
+    stem, _ = _split_history_name(history_file)
+    return history_file.with_name(f"{stem}.index.json")
+
+def _segment_file(history_file:Path, number:int)->Path:
+    stem, suffixes = _split_history_name(history_file)
+    return history_file.with_name(f"{stem}.{number:06}{suffixes}")
+
+@dataclass
+class history_segment:
+    "One segment file's entry in a segmented history's index."
+    file_name:str
+    "The segment's file name, in the directory of the index."
+    rows:int                = field(default=0)
+    size_bytes:int          = field(default=0)
+    start_ns:int|None       = field(default=None)
+    "Timestamp of the first row (ns since 1970-01-01, like the binary format), None if no rows yet."
+    end_ns:int|None         = field(default=None)
+    "Timestamp of the last row."
+    closed:bool             = field(default=False)
+    "False for the segment still being written; its rows and end_ns are only up to date once it closes."
+    compressed:bool         = field(default=False)
+
+    def overlaps(self, start_ns:int|None, end_ns:int|None)->bool:
+        if self.start_ns is None:
+            return not self.closed # An open segment may get rows in the window.
+        if end_ns is not None and self.start_ns > end_ns:
+            return False
+        if start_ns is not None and self.closed and self.end_ns is not None and self.end_ns < start_ns:
+            return False
+        return True
+
+def _write_segment_index(index_file:Path, segments:list[history_segment])->None:
+    temporary = index_file.with_name(index_file.name + ".tmp")
+    with open(file=temporary, mode='w') as f:
+        json.dump({'version': _SEGMENT_INDEX_VERSION, 'segments': [asdict(s) for s in segments]}, f, indent=4)
+    os.replace(temporary, index_file)
+
+def _compress_file(file:Path)->Path:
+    "Gzips a file into `<file>.gz`, leaving the file itself for the caller to remove once nothing points at it."
+    compressed = file.with_name(file.name + ".gz")
+    with open(file=file, mode='rb') as source, gzip.open(compressed, mode='wb') as destination:
+        shutil.copyfileobj(source, destination, length=1024*1024)
+    return compressed
+
+class _SegmentedHistoryWriter(_BufferedHistoryWriter):
+    "A _BufferedHistoryWriter that rolls to a new segment file when the SegmentPolicy says, keeping the segment index up to date."
+    def __init__(self, history_file:Path, encoding_for:Callable[[Path],_HistoryEncoding], policy:FlushPolicy, segments:SegmentPolicy,
+                 compression:HistoryCompression=HistoryCompression.none):
+        self.history_file = history_file
+        self.segments = segments
+        self.index_file = segment_index_file(history_file)
+        self._encoding_for = encoding_for
+        self._index:list[history_segment] = []
+        self._index_lock = threading.Lock()
+        "The index is written by the writer and by the thread compressing closed segments."
+        self._compressing:threading.Thread|None = None
+        segment = _segment_file(history_file, 1)
+        super().__init__(segment, encoding_for(segment), policy, compression)
+        self._start_segment()
+
+    @property
+    def _segment(self)->history_segment:
+        return self._index[-1]
+
+    def _start_segment(self)->None:
+        with self._index_lock:
+            self._index.append(history_segment(file_name=self.file.name, size_bytes=len(self._encoding.header)))
+            _write_segment_index(self.index_file, self._index)
+
+    def _segment_is_full(self, next_time_ns:int)->bool:
+        segment = self._segment
+        if segment.rows == 0:
+            return False
+        if self.segments.max_bytes is not None and segment.size_bytes >= self.segments.max_bytes:
+            return True
+        if self.segments.max_duration_sec is not None and next_time_ns - segment.start_ns >= self.segments.max_duration_sec * 1e9: #type:ignore
+            return True
+        return False
+
+    def _close_segment(self)->None:
+        self._close_file()
+        segment = self._segment
+        segment.closed = True
+        if self.segments.compress_closed and self.compression is HistoryCompression.none:
+            # On a thread of its own, so gzipping a whole segment doesn't hold up the writer (or the event loop, without a writer thread).
+            # One segment is compressed at a time; the writer only waits if the next segment fills before the last one is compressed.
+            if self._compressing is not None: self._compressing.join()
+            self._compressing = threading.Thread(target=self._compress_segment, args=(segment, self.file), name=f"Compressing {self.file.name}")
+            self._compressing.start()
+
+    def _compress_segment(self, segment:history_segment, file:Path)->None:
+        "Gzips a closed segment. The index points at the `.gz` before the plain file is removed, so a reader never finds neither."
+        try:
+            _compress_file(file)
+            with self._index_lock:
+                segment.compressed = True
+                _write_segment_index(self.index_file, self._index)
+            os.remove(file)
+            if time_index_file(file).exists(): os.remove(time_index_file(file)) # Its offsets are into the uncompressed file.
+        except OSError:
+            log.exception(f"Could not compress the segment {file}, leaving it uncompressed.")
+
+    def _write_batch(self, datas:list[Any]) -> None:
+        "Writes `max_rows` of the FlushPolicy at a time, so a large batch (e.g. from the writer thread) still rolls on time."
+        for i in range(0, len(datas), self.policy.max_rows):
+            self._write_segment_batch(datas[i:i+self.policy.max_rows])
+
+    def _write_segment_batch(self, datas:list[Any]) -> None:
+        first_ns = datas[0].time_ns
+        if self._segment_is_full(first_ns):
+            self._close_segment()
+            segment_file = _segment_file(self.history_file, len(self._index) + 1)
+            self._open_file(segment_file, self._encoding_for(segment_file))
+            self._start_segment()
+
+        start = self._file.tell()
+        super()._write_batch(datas)
+        segment = self._segment
+        if segment.start_ns is None: segment.start_ns = first_ns
+        segment.end_ns = datas[-1].time_ns
+        segment.rows += len(datas)
+        segment.size_bytes += self._file.tell() - start
+
+    def close(self) -> None:
+        if self._file.closed: return
+        self.flush()
+        self._close_segment()
+        if self._compressing is not None: self._compressing.join()
+        with self._index_lock:
+            _write_segment_index(self.index_file, self._index)
+
+def _is_environment_history(history_file:Path)->bool:
+    "True for an environment history, False for a controller history, whatever its format and compression."
+    with _open_history_file(history_file) as f:
+        start = f.read(len(_ENVIRONMENT_MAGIC))
+        if start in (_ENVIRONMENT_MAGIC, _DELTA_MAGIC): return True
+        if start == _CONTROLLER_MAGIC:                  return False
+        headers = next(csv.reader([(start + f.readline()).decode()]))
+    return headers[1] == 'level'
+
+def read_history_dataframe(history_file:Path)->pd.DataFrame:
+    "Reads any single history file, environment or controller, CSV or binary, compressed or not, into the dataframe its read_as_dataframe gives."
+    environment = _is_environment_history(history_file)
+    if is_binary_history_file(history_file):
+        return (MappedEnvironmentHistory if environment else MappedControllerHistory)(history_file).to_dataframe()
+    with _open_history_rows(history_file) as f:
+        return (_HistFileManager if environment else _CtrlFileManager).parse_csv(f)
+
+def read_history_records(history_file:Path, start:datetime|None=None, end:datetime|None=None)->Iterable[EnvironmentLogData|ControllerLogData]:
+    "Reads any single history file as its records, like read_state_history_file or read_control_history_file, whichever it is."
+    if _is_environment_history(history_file):
+        return read_state_history_file(history_file, start, end)
+    return read_control_history_file(history_file, start, end)
+
+def _started(records:Iterable[Any])->Iterator[Any]:
+    "Starts iterating `records`, so their file is opened now, and returns an iterator over all of them."
+    records = iter(records)
+    for first in records:
+        return itertools.chain((first,), records)
+    return iter(())
+
+class SegmentedHistory:
+    "Reads a segmented history through its index, opening only the segments a time window needs."
+    def __init__(self, index_file:Path):
+        self.index_file = index_file
+        self.segments:list[history_segment] = []
+        self.refresh()
+
+    def refresh(self)->None:
+        "Rereads the index, to see segments added since this was made."
+        with open(file=self.index_file, mode='r') as f:
+            index = json.load(f)
+        if index['version'] != _SEGMENT_INDEX_VERSION:
+            raise ValueError(f"{self.index_file} is a segment index of an unknown version ({index['version']}).")
+        self.segments = [history_segment(**s) for s in index['segments']]
+
+    @property
+    def rows(self)->int:
+        "Rows in closed segments (the open segment's count isn't known until it closes)."
+        return sum(s.rows for s in self.segments if s.closed)
+
+    def _segment_path(self, segment:history_segment)->Path:
+        path = self.index_file.with_name(segment.file_name)
+        return path.with_name(path.name + ".gz") if segment.compressed else path
+
+    def _read_segment(self, segment:history_segment, read:Callable[[Path],Any])->Any:
+        "Reads a segment with `read`, from its `.gz` if it was compressed (and its plain file removed) since the index was read."
+        try:
+            return read(self._segment_path(segment))
+        except FileNotFoundError:
+            if segment.compressed or not self._segment_path(dataclasses.replace(segment, compressed=True)).exists():
+                raise
+            segment.compressed = True
+            return read(self._segment_path(segment))
+
+    def segment_files(self)->list[Path]:
+        "Every segment's file, in order."
+        return [self._segment_path(s) for s in self.segments]
+
+    def segments_between(self, start:datetime|None=None, end:datetime|None=None)->list[history_segment]:
+        start_ns = _datetime_to_ns(start) if start is not None else None
+        end_ns   = _datetime_to_ns(end) if end is not None else None
+        return [s for s in self.segments if s.overlaps(start_ns, end_ns)]
+
+    def read_dataframe(self, start:datetime|None=None, end:datetime|None=None)->pd.DataFrame:
+        "Rows with `start` <= Time <= `end` (either bound can be left out), from the segments overlapping that window."
+        frames = [self._read_segment(s, read_history_dataframe) for s in self.segments_between(start, end)]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        data = pd.concat(frames, ignore_index=True)
+        if start is not None or end is not None:
+            in_window = pd.Series(True, index=data.index)
+            if start is not None:   in_window &= data['Time'] >= start
+            if end is not None:     in_window &= data['Time'] <= end
+            data = data[in_window].reset_index(drop=True)
+        return data
+
+    def read_all_data(self, start:datetime|None=None, end:datetime|None=None)->Generator[EnvironmentLogData|ControllerLogData,None,None]:
+        "The records with `start` <= timestamp <= `end`, reading the segments overlapping that window one at a time."
+        for segment in self.segments_between(start, end):
+            yield from self._read_segment(segment, lambda file: _started(read_history_records(file, start, end)))
+
+########################################################[ Merged History Timeline ]########################################################
+# merge_histories() interleaves any number of histories (the environment and controller histories of a run, or of several runs)
+# into one timeline of their records, in timestamp order. It is a k-way merge: it holds only the next record of each source,
+# and reads each source lazily (a CSV row by row, from its time index when given a start; a binary file through its memory map;
+# a segmented history one segment at a time), so its memory doesn't grow with the length of the histories.
+# Records with the same timestamp come in the order their sources were given.
+
+HistorySource = Path | RemotablePath
+"A history file, the index of a segmented history, or a RemotablePath to a history file."
+
+def _source_records(source:HistorySource, start:datetime|None, end:datetime|None)->Generator[EnvironmentLogData|ControllerLogData,None,None]:
+    with remotable_as_local_file(LocalPath(source) if isinstance(source, Path) else source) as file:
+        if file.name.endswith(".index.json"):
+            yield from SegmentedHistory(file).read_all_data(start, end)
+        else:
+            yield from read_history_records(file, start, end)
+
+def _record_time_ns(numbered:tuple[int,EnvironmentLogData|ControllerLogData])->int:
+    return numbered[1].time_ns
+
+def merge_histories(sources:Iterable[HistorySource], start:datetime|None=None, end:datetime|None=None)->Iterator[tuple[int,EnvironmentLogData|ControllerLogData]]:
+    """
+    Every record of `sources` with `start` <= timestamp <= `end` (either bound optional), in timestamp order, as (index of its source, record).
+    `for i, data in merge_histories([directories.history_file_path, directories.controller_history_file_path]): ...`
+    Each source is opened when the merge starts, and closed once it is read to the end (or the merge is garbage collected).
+    Memory stays about constant however long the sources are, except for compressed binary and delta encoded files, which are decoded whole.
+    """
+    streams = [zip(itertools.repeat(i), _source_records(source, start, end)) for i, source in enumerate(sources)]
+    return heapq.merge(*streams, key=_record_time_ns)
+
+########################################################[ SQLite Results Database ]########################################################
+# An alternative to loose files per run: one SQLite database holding many runs, so runs can be compared with indexed queries
+# instead of loading every run's files into pandas (e.g. "pump errors in runs where leak_rate_per_sec > 4").
+#   runs                run_id, name, directory, when it started, and its whole context as JSON.
+#   run_context         the context flattened to one row per value (`key` is the dotted path, `name` its last part), indexed by name and value.
+#   environment_ticks   run_id + the columns of ENVIRONMENT_RECORD, indexed by (run_id, time_ns).
+#   controller_events   run_id + the columns of CONTROLLER_RECORD with the message text instead of its id, indexed by (run_id, time_ns).
+# The tick and event columns come from the row codecs, so they follow the log dataclasses like the files do.
+#
+# start_results_run() adds a run and gives the results_run to pass to the history loggers (`database_run=`). The loggers then insert
+# each flushed batch in one transaction, from their writer thread, so the tick loop never waits on the database.
+# The database is in WAL mode, so it can be queried (ResultsDatabase) while runs are being written.
+
+_RESULTS_DATABASE_VERSION = 1
+_RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id      INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL,
+    directory   TEXT,
+    started_ns  INTEGER NOT NULL,
+    context     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS run_context (
+    run_id  INTEGER NOT NULL REFERENCES runs(run_id),
+    key     TEXT NOT NULL,
+    name    TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS run_context_by_name  ON run_context (name, value);
+CREATE INDEX IF NOT EXISTS run_context_by_key   ON run_context (key, value);
+CREATE INDEX IF NOT EXISTS run_context_by_run   ON run_context (run_id);
+"""
+_SQL_TYPES = {'i': 'INTEGER', 'u': 'INTEGER', 'f': 'REAL'}
+_CONTEXT_OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+
+class _ResultsTable:
+    "A table of log rows in the results database, with the columns of the codec's binary record (text instead of message ids)."
+    def __init__(self, name:str, codec:HistoryRowCodec):
+        self.name = name
+        self.codec = codec
+        text_columns = {c.record_field: c.name for c in codec.columns if c.kind is str}
+        self.columns:list[tuple[str,str]] = [(text_columns[f], 'TEXT') if f in text_columns else (f, _SQL_TYPES[codec.record[f].kind])
+                                             for f in codec.record.names]
+        names = ", ".join(n for n, _ in self.columns)
+        self.schema = (f"CREATE TABLE IF NOT EXISTS {name} (run_id INTEGER NOT NULL, "
+                       + ", ".join(f"{n} {t} NOT NULL" for n, t in self.columns) + ");\n"
+                       f"CREATE INDEX IF NOT EXISTS {name}_by_run_time ON {name} (run_id, time_ns);")
+        self.insert = f"INSERT INTO {name} (run_id, {names}) VALUES (?, {', '.join('?' for _ in self.columns)})"
+        self.select = f"SELECT run_id, {names} FROM {name}"
+
+    def rows(self, run_id:int, datas:list[Any])->list[tuple]:
+        to_record = self.codec.to_record
+        return [(run_id, *to_record(d, str)) for d in datas] # str as the message table keeps the text itself.
+
+    def to_dataframe(self, frame:pd.DataFrame)->pd.DataFrame:
+        "The selected rows as the columns read_as_dataframe gives, after a run_id column."
+        columns:dict[str,Any] = {'run_id': frame['run_id'].to_numpy()}
+        for c in self.codec.columns:
+            values = frame[c.name if c.kind is str else c.record_field]
+            if c.kind is EpochNs:
+                columns[c.name] = pd.to_datetime(values.to_numpy(dtype='<i8').view('datetime64[ns]'))
+            elif c.kind is float:
+                columns[c.name] = values.to_numpy(dtype='<f8')
+            elif c.kind is bool:
+                columns[c.name] = (values.to_numpy(dtype='<i8') & self.codec.bits[c.field]) != 0
+            elif c.kind is IntFlag:
+                columns[c.name] = values.to_numpy(dtype='u1')
+            else:
+                columns[c.name] = values.to_numpy()
+        return pd.DataFrame(columns)
+
+ENVIRONMENT_TICKS = _ResultsTable('environment_ticks', ENVIRONMENT_CODEC)
+CONTROLLER_EVENTS = _ResultsTable('controller_events', CONTROLLER_CODEC)
+
+def _connect_results_database(database_file:Path, check_same_thread:bool=True)->sqlite3.Connection:
+    "Opens the database, creating its tables if they aren't there yet."
+    connection = sqlite3.connect(database_file, timeout=30, check_same_thread=check_same_thread)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL") # Safe in WAL mode; a power cut can lose the last transactions, never corrupt the file.
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0:
+        connection.executescript(_RESULTS_SCHEMA + ENVIRONMENT_TICKS.schema + CONTROLLER_EVENTS.schema + f"PRAGMA user_version={_RESULTS_DATABASE_VERSION};")
+    elif version != _RESULTS_DATABASE_VERSION:
+        connection.close()
+        raise ValueError(f"{database_file} is a results database of an unknown version ({version}).")
+    return connection
+
+def _flatten_context(context:Any, key:str="")->Generator[tuple[str,Any],None,None]:
+    "(dotted key, value) for every value in a JSON-like context. Lists are indexed by position (`a.0`), booleans stored as 0/1."
+    if isinstance(context, dict):
+        for k, v in context.items():
+            yield from _flatten_context(v, f"{key}.{k}" if key != "" else str(k))
+    elif isinstance(context, list):
+        for i, v in enumerate(context):
+            yield from _flatten_context(v, f"{key}.{i}" if key != "" else str(i))
+    else:
+        yield key, int(context) if isinstance(context, bool) else context
+
+@dataclass(frozen=True)
+class results_run:
+    "A run in a results database. Pass it to the history loggers (`database_run=`) to write the run's rows there."
+    database_file:Path
+    run_id:int
+
+def start_results_run(database_file:Path, name:str, context:dict, directory:Path|None=None)->results_run:
+    "Adds a run and its context (what would be saved to the context file) to the database, creating the database if needed."
+    context_json = json.loads(json.dumps(context, default=_context_serializer))
+    with closing(_connect_results_database(database_file)) as connection, connection:
+        run_id:int = connection.execute("INSERT INTO runs (name, directory, started_ns, context) VALUES (?, ?, ?, ?)",
+                                        (name, str(directory) if directory is not None else None, time.time_ns(), json.dumps(context_json))).lastrowid #type:ignore
+        connection.executemany("INSERT INTO run_context (run_id, key, name, value) VALUES (?, ?, ?, ?)",
+                               [(run_id, key, key.rsplit(".", 1)[-1], value) for key, value in _flatten_context(context_json)])
+    return results_run(database_file, run_id)
+
+class _SQLiteHistoryWriter(_BufferedHistoryWriter):
+    "A _BufferedHistoryWriter inserting each flushed batch into a table of the results database, in one transaction."
+    def __init__(self, run:results_run, table:_ResultsTable, policy:FlushPolicy):
+        self.run = run
+        self.table = table
+        super().__init__(run.database_file, _HistoryEncoding(b"", lambda datas: b""), policy)
+
+    def _open_file(self, file:Path, encoding:_HistoryEncoding) -> None:
+        self.file = file
+        self._encoding = encoding
+        # Made here and used by the writer thread, never by both at once.
+        self._connection:sqlite3.Connection|None = _connect_results_database(file, check_same_thread=False)
+
+    def flush(self) -> None:
+        if self._connection is None: return
+        if len(self._pending) > 0:
+            with self._connection:
+                self._connection.executemany(self.table.insert, self.table.rows(self.run.run_id, self._pending))
+            self.compression_metrics.rows += len(self._pending)
+            self._pending = []
+
+    def close(self) -> None:
+        if self._connection is None: return
+        self.flush()
+        self._connection.close()
+        self._connection = None
+
+class ResultsDatabase:
+    "Queries a results database. Every query can be limited to some runs (`run_ids`) and a time window, which the indexes make fast."
+    def __init__(self, database_file:Path):
+        self.file = database_file
+        self.connection = _connect_results_database(database_file)
+
+    def close(self)->None:
+        self.connection.close()
+
+    def query(self, sql:str, parameters:Iterable[Any]=())->pd.DataFrame:
+        "Any SQL query, as a dataframe."
+        return pd.read_sql_query(sql, self.connection, params=list(parameters)) #type:ignore
+
+    def runs(self)->pd.DataFrame:
+        return self.query("SELECT run_id, name, directory, started_ns, context FROM runs ORDER BY run_id")
+
+    def run_context(self, run_id:int)->dict:
+        "A run's context as it was given to start_results_run (after JSON serialization)."
+        return json.loads(self.connection.execute("SELECT context FROM runs WHERE run_id = ?", (run_id,)).fetchone()[0])
+
+    def run_ids_where(self, name:str, operator:str, value:Any)->list[int]:
+        """
+        The runs with a context value called `name` (the last part of its key, or the whole dotted key) that compares to `value`,
+        e.g. `run_ids_where('leak_rate_per_sec', '>', 4)`.
+        """
+        if operator not in _CONTEXT_OPERATORS:
+            raise ValueError(f"{operator!r} is not one of {_CONTEXT_OPERATORS}.")
+        column = 'key' if "." in name else 'name'
+        rows = self.connection.execute(f"SELECT DISTINCT run_id FROM run_context WHERE {column} = ? AND value {operator} ? ORDER BY run_id", (name, value))
+        return [r[0] for r in rows]
+
+    def _select(self, table:_ResultsTable, run_ids:Iterable[int]|None, start:datetime|None, end:datetime|None,
+                conditions:list[str], parameters:list[Any])->pd.DataFrame:
+        if run_ids is not None:
+            run_ids = list(run_ids)
+            conditions = [f"run_id IN ({', '.join('?' for _ in run_ids)})", *conditions]
+            parameters = [*run_ids, *parameters]
+        if start is not None:
+            conditions.append("time_ns >= ?")
+            parameters.append(_datetime_to_ns(start))
+        if end is not None:
+            conditions.append("time_ns <= ?")
+            parameters.append(_datetime_to_ns(end))
+        where = f" WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+        return table.to_dataframe(self.query(f"{table.select}{where} ORDER BY run_id, time_ns", parameters))
+
+    def environment_ticks(self, run_ids:Iterable[int]|None=None, start:datetime|None=None, end:datetime|None=None)->pd.DataFrame:
+        return self._select(ENVIRONMENT_TICKS, run_ids, start, end, [], [])
+
+    def controller_events(self, run_ids:Iterable[int]|None=None, start:datetime|None=None, end:datetime|None=None,
+                          is_action:bool|None=None, is_modbus_error:bool|None=None, is_state_refresh:bool|None=None,
+                          target:CtrlLogTarget|None=None)->pd.DataFrame:
+        "Controller events, optionally only those of one kind and/or towards `target`, e.g. the pump errors of some runs."
+        conditions:list[str] = []
+        parameters:list[Any] = []
+        for name, wanted in (('is_action', is_action), ('is_modbus_error', is_modbus_error), ('is_state_refresh', is_state_refresh)):
+            if wanted is not None:
+                conditions.append("(flags & ?) = ?")
+                parameters += [CONTROLLER_CODEC.bits[name], CONTROLLER_CODEC.bits[name] if wanted else 0]
+        if target is not None:
+            conditions.append("(targets & ?) != 0")
+            parameters.append(target.value)
+        return self._select(CONTROLLER_EVENTS, run_ids, start, end, conditions, parameters)
+
+########################################################[ Compressed History Files ]########################################################
+# With a HistoryCompression other than `none`, the writers compress the history as they write it, with a stdlib codec.
+# Every flush of the writer ends a frame that can be decompressed on its own terms, so a reader following the file
+# (HistoryTailReader, Render_Graphs) sees every row up to the last flush, not only what fills a whole compression block:
+#   - gzip is one stream, sync-flushed (Z_SYNC_FLUSH) on every flush. It only loses a little ratio on each flush.
+#   - bz2 and lzma can't be flushed mid-stream, so every flush writes a complete stream, and the file is a run of streams
+#     (which their command line tools and python's bz2/lzma modules read as one). Flush them in big batches (see FlushPolicy).
+# Readers tell a compressed file by its first bytes, not its name, and decompress it transparently. A compressed CSV can't be
+# seeked into, so it has no time index and time windows are read from the top.
+
+_COMPRESSION_SUFFIXES = {c.value for c in HistoryCompression if c is not HistoryCompression.none}
+_COMPRESSION_MAGIC = {
+    HistoryCompression.gzip: b"\x1f\x8b",
+    HistoryCompression.bz2:  b"BZh",
+    HistoryCompression.lzma: b"\xfd7zXZ\x00",
+}
+_COMPRESSION_MAGIC_BYTES = max(len(m) for m in _COMPRESSION_MAGIC.values())
+
+@dataclass
+class compression_metrics:
+    "How well a compressed history file compresses, and what it costs the writer."
+    rows:int = field(default=0)
+    bytes_in:int = field(default=0)
+    "Bytes given to the compressor (the file's uncompressed size)."
+    bytes_out:int = field(default=0)
+    "Bytes written to the file."
+    compress_time_sec:float = field(default=0)
+    "CPU time of the writing thread spent compressing."
+
+    @property
+    def ratio(self)->float:
+        "Uncompressed size / compressed size."
+        return self.bytes_in / self.bytes_out if self.bytes_out > 0 else 0
+
+    @property
+    def compress_time_per_row_sec(self)->float:
+        return self.compress_time_sec / self.rows if self.rows > 0 else 0
+
+def _compression_of(start:bytes)->HistoryCompression:
+    "Which codec a file starting with these bytes is compressed with."
+    for compression, magic in _COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+            return compression
+    return HistoryCompression.none
+
+def history_compression(history_file:Path)->HistoryCompression:
+    "Which codec the history file was compressed with, read from its first bytes."
+    with open(file=history_file, mode='rb') as f:
+        return _compression_of(f.read(_COMPRESSION_MAGIC_BYTES))
+
+class _CompressedFile:
+    "The file a _BufferedHistoryWriter writes to when the history is compressed. Every flush() ends a frame (see above)."
+    def __init__(self, file:Path, compression:HistoryCompression, metrics:compression_metrics):
+        self.compression = compression
+        self.metrics = metrics
+        self._file = open(file=file, mode='wb')
+        self._unflushed:list[bytes] = []
+        "Data written since the last frame, for the codecs that compress a frame at once."
+        self._frame_bytes = 0
+        self._gzip = zlib.compressobj(wbits=31) if compression is HistoryCompression.gzip else None
+
+    @property
+    def closed(self)->bool:
+        return self._file.closed
+
+    def tell(self)->int:
+        "Compressed bytes written so far."
+        return self._file.tell()
+
+    def fileno(self)->int:
+        return self._file.fileno()
+
+    def write(self, data:bytes)->None:
+        self.metrics.bytes_in += len(data)
+        self._frame_bytes += len(data)
+        if self._gzip is None:
+            self._unflushed.append(data)
+            return
+        start = time.thread_time()
+        compressed = self._gzip.compress(data)
+        self.metrics.compress_time_sec += time.thread_time() - start
+        self._write_compressed(compressed)
+
+    def _write_compressed(self, compressed:bytes)->None:
+        self.metrics.bytes_out += len(compressed)
+        self._file.write(compressed)
+
+    def _end_frame(self, mode:int)->None:
+        start = time.thread_time()
+        if self._gzip is not None:
+            compressed = self._gzip.flush(mode)
+        elif self.compression is HistoryCompression.bz2:
+            compressed = bz2.compress(b"".join(self._unflushed))
+        else:
+            compressed = lzma.compress(b"".join(self._unflushed), format=lzma.FORMAT_XZ)
+        self.metrics.compress_time_sec += time.thread_time() - start
+        self._unflushed = []
+        self._frame_bytes = 0
+        self._write_compressed(compressed)
+
+    def flush(self)->None:
+        if self._frame_bytes > 0:
+            self._end_frame(zlib.Z_SYNC_FLUSH)
+        self._file.flush()
+
+    def finish(self)->None:
+        "Ends the last frame (and the gzip stream) without closing the file, so it can be synced. Nothing can be written after."
+        if self._gzip is not None or self._frame_bytes > 0:
+            self._end_frame(zlib.Z_FINISH)
+        self._gzip = None
+        self._file.flush()
+
+    def close(self)->None:
+        if self._file.closed: return
+        self.finish()
+        self._file.close()
+
+class _FrameDecoder:
+    """
+    Decompresses a compressed history as its bytes arrive, including a run of complete streams (bz2, lzma).
+    Returns what can be decompressed so far and keeps an incomplete frame at the end until the rest of it arrives.
+    """
+    def __init__(self, compression:HistoryCompression):
+        self.compression = compression
+        self._decompressor = self._new_decompressor()
+
+    def _new_decompressor(self)->Any:
+        if self.compression is HistoryCompression.gzip: return zlib.decompressobj(wbits=31)
+        if self.compression is HistoryCompression.bz2:  return bz2.BZ2Decompressor()
+        if self.compression is HistoryCompression.lzma: return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        return None
+
+    def decompress(self, data:bytes)->bytes:
+        if self._decompressor is None:
+            return data
+        out = []
+        while len(data) > 0:
+            if self._decompressor.eof:
+                self._decompressor = self._new_decompressor()
+            out.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data if self._decompressor.eof else b""
+        return b"".join(out)
+
+class _DecompressingReader(io.RawIOBase):
+    "A file decompressed as it is read. The end of the file is wherever the writer last flushed."
+    def __init__(self, file:IO[bytes], compression:HistoryCompression):
+        self._file = file
+        self._decoder = _FrameDecoder(compression)
+        self._decoded = b""
+
+    def readable(self)->bool:
+        return True
+
+    def readinto(self, buffer:Any)->int:
+        while len(self._decoded) == 0:
+            data = self._file.read(1024*1024)
+            if len(data) == 0:
+                return 0
+            self._decoded = self._decoder.decompress(data)
+        count = min(len(buffer), len(self._decoded))
+        buffer[:count] = self._decoded[:count]
+        self._decoded = self._decoded[count:]
+        return count
+
+    def close(self)->None:
+        self._file.close()
+        super().close()
+
+def _open_history_file(history_file:Path)->IO[bytes]:
+    "Opens a history file for reading, decompressing it if it is compressed. Only a file that isn't compressed can seek past the start."
+    compression = history_compression(history_file)
+    if compression is HistoryCompression.none:
+        return open(file=history_file, mode='rb')
+    return io.BufferedReader(_DecompressingReader(open(file=history_file, mode='rb'), compression), buffer_size=1024*1024)
+
+def _last_row_end(f:IO[bytes])->int:
+    "The offset just past the last newline of a file, 0 if it has none."
+    position = f.seek(0, io.SEEK_END)
+    while position > 0:
+        start = max(0, position - 64*1024)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b"\n")
+        if newline >= 0:
+            position = start + newline + 1
+            break
+        position = start
+    f.seek(0)
+    return position
+
+class _CompleteRowsReader(io.RawIOBase):
+    """
+    A CSV history, read only up to the end of its last complete row. A row torn by its writer dying mid-write is left out.
+    Over a file that can seek, that end is found when this is opened (rows written after aren't read) and this can seek too.
+    Otherwise (a compressed file) what follows the last newline read is held back until more arrives, and dropped at the end of the file.
+    """
+    def __init__(self, file:IO[bytes]):
+        self._file = file
+        self._end = _last_row_end(file) if file.seekable() else None
+        self._ready = memoryview(b"")
+        self._held = b""
+
+    def readable(self)->bool:
+        return True
+
+    def seekable(self)->bool:
+        return self._end is not None
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET)->int:
+        if self._end is None:
+            raise io.UnsupportedOperation("A compressed history can't seek.")
+        if whence == io.SEEK_END:
+            return self._file.seek(self._end + offset)
+        return self._file.seek(offset, whence)
+
+    def readinto(self, buffer:Any)->int:
+        if self._end is not None:
+            count = min(len(buffer), self._end - self._file.tell())
+            return self._file.readinto(memoryview(buffer)[:count]) if count > 0 else 0 #type:ignore
+        while len(self._ready) == 0:
+            data = self._file.read(1024*1024)
+            if len(data) == 0:
+                return 0
+            data = self._held + data
+            end = data.rfind(b"\n") + 1
+            self._ready, self._held = memoryview(data)[:end], data[end:]
+        count = min(len(buffer), len(self._ready))
+        buffer[:count] = self._ready[:count]
+        self._ready = self._ready[count:]
+        return count
+
+    def close(self)->None:
+        self._file.close()
+        super().close()
+
+def _open_history_rows(history_file:Path)->IO[bytes]:
+    "Opens a CSV history for reading up to its last complete row (see _CompleteRowsReader), decompressing it if it is compressed."
+    return io.BufferedReader(_CompleteRowsReader(_open_history_file(history_file)), buffer_size=1024*1024)
+
+########################################################[ History Time Index ]########################################################
+# A sparse index of a CSV history file, kept next to it (`<file>.tidx`): the timestamp and byte offset of every TIME_INDEX_ROWS'th row.
+# It lets a time window be read by seeking close to its start instead of parsing the file from the top, so reading a window
+# takes about the same time wherever it falls in the file. Binary history files don't need one, their timestamps are binary searched.
+#
+# The writers build the index as they write. For a file without one (e.g. written before the index existed) it is built on first read,
+# by one scan of the file. Index entries are checked against the row they point to before use, and a stale index is rebuilt.
+
+TIME_INDEX_ENTRY = np.dtype([('time_ns','<i8'), ('offset','<i8')])
+
+def time_index_file(history_file:Path)->Path:
+    return history_file.with_name(history_file.name + ".tidx")
+
+def _row_time_ns(line:bytes)->int:
+    return _parse_csv_time(line[:line.index(b",")].decode())
+
+def _build_time_index(history_file:Path, every:int=TIME_INDEX_ROWS)->np.ndarray:
+    "Scans the file for the start of every `every`'th row and saves the index next to it (if the directory is writable)."
+    entries:list[tuple[int,int]] = []
+    with open(file=history_file, mode='rb') as f:
+        offset = len(f.readline())
+        for row, line in enumerate(f):
+            if row % every == 0 and line.endswith(b"\n"):
+                entries.append((_row_time_ns(line), offset))
+            offset += len(line)
+    index = np.array(entries, dtype=TIME_INDEX_ENTRY)
+    try:
+        index.tofile(time_index_file(history_file))
+    except OSError:
+        log.warning(f"Could not save the time index of {history_file}, it will be rebuilt on every read.")
+    return index
+
+def _load_time_index(history_file:Path)->np.ndarray:
+    index_file = time_index_file(history_file)
+    if not index_file.exists():
+        return _build_time_index(history_file)
+    size = os.path.getsize(index_file)
+    return np.fromfile(index_file, dtype=TIME_INDEX_ENTRY, count=size // TIME_INDEX_ENTRY.itemsize)
+
+def _index_entry_is_valid(f:IO[bytes], time_ns:int, offset:int)->bool:
+    f.seek(offset)
+    line = f.readline()
+    try:
+        return line.endswith(b"\n") and _row_time_ns(line) == time_ns
+    except ValueError:
+        return False
+
+def _start_offset(f:IO[bytes], history_file:Path, start:datetime|None)->int:
+    "Where to start reading so that no row at or after `start` is skipped: the last indexed row before `start`, or the first row."
+    f.seek(0)
+    first_row = len(f.readline())
+    if start is None:
+        return first_row
+    for attempt in range(2):
+        index = _load_time_index(history_file) if attempt == 0 else _build_time_index(history_file)
+        i = int(np.searchsorted(index['time_ns'], _datetime_to_ns(start), side='left')) - 1
+        if i < 0:
+            return first_row
+        if _index_entry_is_valid(f, int(index['time_ns'][i]), int(index['offset'][i])):
+            return int(index['offset'][i])
+        log.warning(f"The time index of {history_file} doesn't match the file, rebuilding it.")
+    return first_row
+
+def _csv_rows_between(history_file:Path, start:datetime|None, end:datetime|None)->Generator[list[str],None,None]:
+    """
+    The CSV rows (without headers) with `start` <= time <= `end`, either bound optional.
+    Times in CSV_TIME_FORMAT sort the same as text, so rows are compared to the bounds without parsing them.
+    A compressed file has no time index and is read from the top.
+    """
+    start_text = start.strftime(CSV_TIME_FORMAT) if start is not None else None
+    end_text   = end.strftime(CSV_TIME_FORMAT) if end is not None else None
+    if history_compression(history_file) is not HistoryCompression.none:
+        with _open_history_rows(history_file) as f:
+            f.readline() # Headers
+            yield from _rows_in_window(io.TextIOWrapper(f, newline=''), start_text, end_text)
+        return
+    with _open_history_rows(history_file) as f:
+        f.seek(_start_offset(f, history_file, start))
+        yield from _rows_in_window(io.TextIOWrapper(f, newline=''), start_text, end_text)
+
+def _rows_in_window(lines:IO[str], start_text:str|None, end_text:str|None)->Generator[list[str],None,None]:
+    for row in csv.reader(lines):
+        if start_text is not None and row[0] < start_text:
+            continue
+        if end_text is not None and row[0] > end_text:
+            return
+        yield row
@@ -4,6 +4,9 @@ import logging
 import sys
 from enum import Enum,IntEnum
 from dataclasses import dataclass, field
+from pathlib import Path
+
+from latency_trace import LatencyTracer, SENSOR, COIL
 
 try: 
     from pymodbus.datastore import (
@@ -33,6 +36,9 @@ logging.basicConfig()
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+TRACE_FILE: Path|None = None
+"Set to a path to record sensor flips and pump coil changes for latency_trace.py. Saved when the server stops."
+
 @dataclass(frozen=True)
 class SimulationParameters:
     "The parameters required to run the simulation. Uses an abstract 'level' to represent the volume of the liquid (e.g. Liters, Gallons, etc)."
@@ -147,15 +153,18 @@ def log_sim_events(sim:Simulation):
     if sim.is_overflowing():
         log.info("Simulated Tank Is Overflowing")
 
-async def simulate(context, sim:Simulation):
+async def simulate(context, sim:Simulation, tracer:LatencyTracer|None=None):
     """
     Proforms the provided simulation asyncronously, 
     and applies it to the current values in the modbus server. 
+    If a tracer is provided, sensor flips are recorded to it.
     """
     delay = sim.get_timestep_length_in_seconds()
 
 
     context.setValues(mb_func_code.Read_D_Coils, address=0, values=[sim.is_pump_active()])
+    last_upper_sensor_reading:bool|None = None
+    last_lower_sensor_reading:bool|None = None
 
     while True:
         upper_sensor_reading:bool = sim.is_upper_sensor_active()
@@ -164,6 +173,12 @@ async def simulate(context, sim:Simulation):
         lower_sensor_reading:bool = sim.is_lower_sensor_active()
         context.setValues(mb_func_code.Read_D_Contacts, address=1, values=[lower_sensor_reading])
 
+        if tracer is not None:
+            if upper_sensor_reading != last_upper_sensor_reading: tracer.record(SENSOR, "ULS", upper_sensor_reading)
+            if lower_sensor_reading != last_lower_sensor_reading: tracer.record(SENSOR, "LLS", lower_sensor_reading)
+        last_upper_sensor_reading = upper_sensor_reading
+        last_lower_sensor_reading = lower_sensor_reading
+
         await asyncio.sleep(delay)
 
         sim.set_leak(True) # Always True For us
@@ -212,20 +227,36 @@ async def updating_task(context):
         log.debug(txt)
 
 
-def setup_updating_server():
-    """Run server setup."""
+class TracedDeviceContext(ModbusDeviceContext):
+    "A device context that records when the pump coil changes value, however it was written."
+    def __init__(self, tracer:LatencyTracer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tracer = tracer
+
+    def setValues(self, func_code, address, values):
+        pump_coil_written = func_code in (mb_func_code.Read_D_Coils, mb_func_code.WriteOne_D_Coils, mb_func_code.WriteMany_D_Coils) \
+                            and address <= 0 < address + len(values)
+        was_active = self.getValues(func_code, 0, count=1)[0] if pump_coil_written else None
+        result = super().setValues(func_code, address, values)
+        if pump_coil_written and bool(values[-address]) != bool(was_active):
+            self._tracer.record(COIL, "pump", bool(values[-address]))
+        return result
+
+def setup_updating_server(tracer:LatencyTracer|None=None):
+    """Run server setup. If a tracer is provided, pump coil changes are recorded to it."""
     # The datastores only respond to the addresses that are initialized
     # If you initialize a DataBlock to addresses of 0x00 to 0xFF, a request to
     # 0x100 will respond with an invalid address exception.
     # This is because many devices exhibit this kind of behavior (but not all)
     
     # Continuing, use a sequential block without gaps.
-    device_context = ModbusDeviceContext(
+    datablocks = dict(
         hr=ModbusSequentialDataBlock(0, [17]    * 100), # Holding registers (address 0-99)
         di=ModbusSequentialDataBlock(0, [False] * 100), # Discrete inputs (address 0-99)
         co=ModbusSequentialDataBlock(0, [True]  * 100), # Coils (address 0-99)
         ir=ModbusSequentialDataBlock(0, [20]    * 100)  # Input registers (address 0-99)
     )
+    device_context = ModbusDeviceContext(**datablocks) if tracer is None else TracedDeviceContext(tracer, **datablocks)
     context = ModbusServerContext(devices=device_context, single=True)
     identity = ModbusDeviceIdentification(
         info_name={
@@ -255,7 +286,7 @@ async def prepare_simulation(context, timestep_length_sec:float=0.5):
 
 
 
-async def run_server(modbus_server, context):
+async def run_server(modbus_server, context, tracer:LatencyTracer|None=None):
     """Start updating_task concurrently with the current task."""
 
 
@@ -273,7 +304,7 @@ async def run_server(modbus_server, context):
                      pump_active=False,
                      leak_active=True
                      )
-    sim_task = asyncio.create_task(simulate(context,sim))
+    sim_task = asyncio.create_task(simulate(context,sim,tracer))
     sim_task.set_name("Task Simulating Real Environment")
 
     # task = asyncio.create_task(updating_task(context)) # Run the updating task
@@ -288,8 +319,14 @@ async def run_server(modbus_server, context):
 
 async def main():
     """Combine setup and run."""
-    modbus_server, context = setup_updating_server()
-    await run_server(modbus_server, context)
+    tracer = LatencyTracer() if TRACE_FILE is not None else None
+    modbus_server, context = setup_updating_server(tracer)
+    try:
+        await run_server(modbus_server, context, tracer)
+    finally:
+        if tracer is not None and TRACE_FILE is not None:
+            tracer.save(TRACE_FILE)
+            log.info(f"Saved {len(tracer)} trace events to {TRACE_FILE}")
 
 def run_environment():
     "This is how you can run the environment from an external server"
@@ -1,15 +1,18 @@
 # modbus_client.py
 import asyncio
 import logging
-from returns.result import Result, Success, Failure
+import time
 from returns.maybe import Maybe, Some, Nothing
-from returns.future import Future
 
-from pymodbus.pdu import ModbusPDU
 from pymodbus.client import AsyncModbusTcpClient
 from contextlib import asynccontextmanager
 from enum import Enum, auto
 from dataclasses import dataclass, field
+from pathlib import Path
+
+from modbus_connection import ResilientModbusConnection
+from plc_points import ModbusTransactionError, read_upper_sensor, read_lower_sensor, read_sensors, read_pump, write_pump
+from latency_trace import LatencyTracer, DETECT
 
 logging.basicConfig()
 log = logging.getLogger()
@@ -18,18 +21,17 @@ log.setLevel(logging.ERROR)
 SERVER_IP = "172.16.141.129" # Connect to server
 SERVER_PORT = 5020
 
+TRACE_FILE: Path|None = None
+"Set to a path to record when the PLC detects a sensor flip it must act on, for latency_trace.py. Saved when the client stops."
+
 @asynccontextmanager
-async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT):
+async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT, warm_standby:bool=False):
+    "Yields a connection that reconnects by itself (see ResilientModbusConnection) and can be used like an AsyncModbusTcpClient."
     
-    client = AsyncModbusTcpClient(server_ip, port=server_port)
+    client = ResilientModbusConnection(server_ip, server_port, warm_standby=warm_standby)
     log.info(f"Connecting to Modbus server at {server_ip}:{server_port}")
-    await client.connect()
-
-    if not client.connected:
-        log.error("Failed to connect to the Modbus server.")
-        return
-    else:
-        log.info("Successfully connected to the server.")
+    await client.connect() # Keeps retrying until the server is reachable
+    log.info("Successfully connected to the server.")
     
     try:
         yield client
@@ -41,131 +43,274 @@ async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT):
         #raise e
     finally:
         log.info("Closing connection.")
+        if client.metrics.disconnects > 0:
+            print(f"CONNECTION: {client.metrics.summary()}")
         client.close()
 
-def _find_errors(result:ModbusPDU) -> Result[ModbusPDU,ModbusPDU]:
-    if result.isError():
-        return Failure(result)
-    return Success(result)
-
-def _log_errors(result:Result[ModbusPDU,ModbusPDU]) -> Maybe[ModbusPDU]:
-    match result:
-        case Success(pdu):
-            log.debug(f"Modbus Transaction Success: {result}")
-            return Some(pdu)
-        case Failure(pdu):
-            log.error(f"Modbus Transaction Error: {result}")
-            return Nothing
-        
-def handle_errors(result:ModbusPDU) -> Maybe[ModbusPDU]:
-    return _log_errors(_find_errors(result))
+#---------------------------------------------[ Maybe API ]---------------------------------------------#
 
 async def upper_sensor_is_triggered(client:AsyncModbusTcpClient) -> Maybe[bool]:
     log.debug("Reading Status of upper water sensor")
-    return handle_errors(await client.read_discrete_inputs(address=0, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_upper_sensor(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 async def lower_sensor_is_triggered(client:AsyncModbusTcpClient) -> Maybe[bool]:
     log.debug("Reading Status of lower water sensor")
-    return handle_errors(await client.read_discrete_inputs(address=1, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_lower_sensor(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 async def set_pump(client:AsyncModbusTcpClient,activate:bool) -> bool:
     "Lets you set the water pump to be active or deactivated. Return True if successfully, False if error."
-    log.debug(f"Turning Pump {'ON' if activate else 'OFF'}")
-    return handle_errors(await client.write_coil(address=0, value=activate)).bind(
-        lambda pdu: Some(True) #Get rid of pdu because not useful
-    ).value_or(False)
+    log.debug("Turning Pump %s", 'ON' if activate else 'OFF')
+    try:
+        await write_pump(client, activate)
+        return True
+    except ModbusTransactionError as e:
+        log.error(e)
+        return False
 
 async def pump_is_active(client:AsyncModbusTcpClient) -> Maybe[bool]:
     "Returns true if the water pump is active"
     log.debug("Reading Status of Pump")
-    return handle_errors(await client.read_coils(address=0, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_pump(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 
+@dataclass
+class pump_command_stats:
+    "Counts what happened to the pump commands given to a PumpCommander."
+    writes_sent: int = field(default=0)
+    writes_failed: int = field(default=0)
+    writes_suppressed: int = field(default=0)
+    "Commands that would have been written (they changed the coil state known when given) but matched it by the end of the scan."
+    writes_coalesced: int = field(default=0)
+    "Commands replaced by an opposing command later in the same scan."
+    commands_unchanged: int = field(default=0)
+    "Commands that matched the known coil state when given, so weren't queued. Nothing would have been written for these before either."
+    confirm_reads: int = field(default=0)
+
+    @property
+    def writes_avoided(self) -> int:
+        "Writes that sending every command that changed the known coil state would have made, but weren't sent."
+        return self.writes_suppressed + self.writes_coalesced
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def summary(self) -> str:
+        return (f"sent={self.writes_sent} failed={self.writes_failed} suppressed={self.writes_suppressed} "
+                f"coalesced={self.writes_coalesced} avoided={self.writes_avoided} unchanged={self.commands_unchanged} confirm_reads={self.confirm_reads}")
+
+class PumpCommander:
+    """
+    Sits between the control logic and write_pump.
+
+    Commands given during a scan with `request()` are only queued; `flush()` at the end of the scan sends at most one write:
+    the last command wins (earlier opposing commands are coalesced away), and it is not sent at all if it matches
+    the coil state the PLC knows about (`environment_state.pump_is_active`).
+    A command that already matches the known state when given (e.g. the lower sensor being dry while the pump is on) isn't queued,
+    unless it replaces an opposing one, so `writes_avoided` only counts writes that would really have been sent without this.
+
+    With `confirm`, the coil is read back before deciding (unless it was read or written in the last `confirm_max_age_ms`),
+    so a pump changed by someone else is noticed instead of trusting a cache that's only refreshed every ~30 s.
+    Modbus can't read coils and discrete inputs (or write and read a coil) in one request, so this costs one extra read,
+    and only in scans that have a command pending.
+    """
+    def __init__(self, confirm:bool=False, confirm_max_age_ms:float=0):
+        self.confirm = confirm
+        self.confirm_max_age_ms = confirm_max_age_ms
+        self.stats = pump_command_stats()
+        self._pending: bool|None = None
+        self._pending_reason: str = ""
+
+    def request(self, state:'environment_state', activate:bool, reason:str) -> bool:
+        "Queues a command for this scan. Returns True if it would change the pump (as far as the PLC knows)."
+        if self._pending is None and activate == state.pump_is_active:
+            self.stats.commands_unchanged += 1
+            return False
+        if self._pending is not None and self._pending != activate:
+            self.stats.writes_coalesced += 1
+        self._pending = activate
+        self._pending_reason = reason
+        return activate != state.pump_is_active
+
+    async def flush(self, client:AsyncModbusTcpClient, state:'environment_state') -> None:
+        "Sends this scan's command if it changes the pump."
+        activate, reason = self._pending, self._pending_reason
+        if activate is None:
+            return
+        self._pending = None
+
+        if self.confirm and state.age_ms(PUMP) > self.confirm_max_age_ms:
+            await refresh_stale(client, state, self.confirm_max_age_ms, (PUMP,))
+            self.stats.confirm_reads += 1
+
+        if activate == state.pump_is_active:
+            self.stats.writes_suppressed += 1
+            return
+
+        try:
+            await write_pump(client, activate)
+        except ModbusTransactionError as e:
+            log.error(e)
+            self.stats.writes_failed += 1
+            print(f"FAILED: MODBUS couldn't turn {'on' if activate else 'off'} pump.")
+        else:
+            self.stats.writes_sent += 1
+            print(f"SUCCESS: Turned {'ON' if activate else 'OFF'} pump by {reason}")
+            state.record(PUMP, activate) # The write was acknowledged, so this is as good as a read.
+
+CONFIRM_PUMP_WRITES = False
+"Read the pump coil back before each pump command (see PumpCommander)."
+
+PUMP = "pump_is_active"
+UPPER_SENSOR = "upper_sensor_is_triggered"
+LOWER_SENSOR = "lower_sensor_is_triggered"
+ALL_POINTS = (PUMP, UPPER_SENSOR, LOWER_SENSOR)
+"The points cached in environment_state, named after its fields."
+
 @dataclass
 class environment_state():
+    """
+    The PLC's cached view of the environment.
+    Each point remembers when it was last read (or written), so callers can ask for values no older than some age; see refresh_stale().
+    Set values with `record()` so their timestamps are kept.
+    """
     pump_is_active: bool = field(default=False)
     lower_sensor_is_triggered: bool = field(default=False)
     upper_sensor_is_triggered: bool = field(default=False)
+    pump_commands: PumpCommander = field(default_factory=lambda: PumpCommander(confirm=CONFIRM_PUMP_WRITES), repr=False)
+    read_at_ns: dict[str,int] = field(default_factory=dict, repr=False)
+    "time.monotonic_ns() at which each point's request was sent. Missing points have never been read."
 
-async def update_state(client:AsyncModbusTcpClient, state:environment_state) -> None:
-    match await pump_is_active(client):
-        case Maybe.empty:
-            print("UPDATE:FAILED: MODBUS Couldn't get pump status")
-        case Some(reading):
-            state.pump_is_active = reading
-    
-    match await upper_sensor_is_triggered(client):
-        case Maybe.empty:
-            print("UPDATE:FAILED: MODBUS Couldn't get upper sensor status")
-        case Some(reading):
-            state.upper_sensor_is_triggered = reading
-    
-    match await lower_sensor_is_triggered(client):
-        case Maybe.empty:
-            print("UPDATE:FAILED: MODBUS Couldn't get lower sensor status")
-        case Some(reading):
-            state.lower_sensor_is_triggered = reading
+    def record(self, point:str, value:bool, read_at_ns:int|None=None) -> None:
+        setattr(self, point, value)
+        self.read_at_ns[point] = time.monotonic_ns() if read_at_ns is None else read_at_ns
+
+    def age_ms(self, point:str) -> float:
+        "How old the cached value is, infinite if it has never been read."
+        if point not in self.read_at_ns:
+            return float('inf')
+        return (time.monotonic_ns() - self.read_at_ns[point]) / 1e6
+
+    def stale_points(self, max_age_ms:float, points:tuple[str,...]=ALL_POINTS) -> list[str]:
+        return [p for p in points if self.age_ms(p) > max_age_ms]
+
+async def refresh_stale(client:AsyncModbusTcpClient, state:environment_state, max_age_ms:float=0, points:tuple[str,...]=ALL_POINTS) -> list[str]:
+    """
+    Re-reads the given points that are older than `max_age_ms` (0 re-reads all of them) and returns the ones that failed.
+    Both sensors come from one discrete input read and the pump from one coil read, sent together,
+    so this is at most two requests whatever is stale.
+    """
+    stale = state.stale_points(max_age_ms, points)
+    if len(stale) == 0:
+        return []
+
+    requests = []
+    if UPPER_SENSOR in stale or LOWER_SENSOR in stale: requests.append(read_sensors(client))
+    if PUMP in stale:                                  requests.append(read_pump(client))
+
+    sent_at = time.monotonic_ns()
+    if len(requests) == 1: # Skip gather's overhead in the common case, a scan only reads the sensors.
+        try:
+            replies = [await requests[0]]
+        except ModbusTransactionError as e:
+            replies = [e]
+    else:
+        replies = list(await asyncio.gather(*requests, return_exceptions=True))
+
+    failed = []
+    if UPPER_SENSOR in stale or LOWER_SENSOR in stale:
+        reply = replies.pop(0)
+        if isinstance(reply, ModbusTransactionError):
+            log.error(reply)
+            failed += [p for p in (UPPER_SENSOR, LOWER_SENSOR) if p in stale]
+        elif isinstance(reply, BaseException):
+            raise reply
+        else:
+            # Both sensors arrived, so refresh both even if only one was asked for.
+            state.record(UPPER_SENSOR, reply[0], sent_at)
+            state.record(LOWER_SENSOR, reply[1], sent_at)
+    if PUMP in stale:
+        reply = replies.pop(0)
+        if isinstance(reply, ModbusTransactionError):
+            log.error(reply)
+            failed.append(PUMP)
+        elif isinstance(reply, BaseException):
+            raise reply
+        else:
+            state.record(PUMP, reply, sent_at)
+    return failed
+
+_UPDATE_FAILED_MESSAGES = {
+    PUMP:           "UPDATE:FAILED: MODBUS Couldn't get pump status",
+    UPPER_SENSOR:   "UPDATE:FAILED: MODBUS Couldn't get upper sensor status",
+    LOWER_SENSOR:   "UPDATE:FAILED: MODBUS Couldn't get lower sensor status",
+}
+
+async def update_state(client:AsyncModbusTcpClient, state:environment_state, max_age_ms:float=0) -> None:
+    "Refreshes the cached state. With max_age_ms, points read more recently than that (e.g. by the scan) are not re-read."
+    for point in await refresh_stale(client, state, max_age_ms):
+        print(_UPDATE_FAILED_MESSAGES[point])
 
     print("UPDATE: Updated sensor state cache.")
 
-async def flip_pump_if_pass_trigger(client:AsyncModbusTcpClient, state:environment_state) -> None:
-
-    async def flip_pump_if_lower(lower_triggered:bool):
-        # Turn on pump if the lower sensor is not triggered and the pump is off
-        if (not lower_triggered) and (not state.pump_is_active):
-            success = await set_pump(client, activate=True)
-            if success:
-                print("SUCCESS: Turned ON pump by LLS")
-                state.pump_is_active = True
-            else:
-                print("FAILED: MODBUS couldn't turn on pump.")
-
-    async def flip_pump_if_upper(upper_triggered:bool):
-        # Turn off pump if the upper sensor is triggered and the pump is on
-        if upper_triggered and state.pump_is_active:
-            success = await set_pump(client, activate=False)
-            if success:
-                print("SUCCESS: Turned OFF pump by ULS")
-                state.pump_is_active = False
-            else:
-                print("FAILED: MODBUS couldn't turn off pump.")
-        
+async def flip_pump_if_pass_trigger(client:AsyncModbusTcpClient, state:environment_state, tracer:LatencyTracer|None=None) -> None:
+    """
+    One scan of the controller. Uses the fast-path helpers since this runs continuously. If a tracer is provided, detected sensor flips are recorded to it.
+    Both sensors are read in one request, and pump commands go through state.pump_commands, so at most one write is sent per scan and only when it changes the pump.
+    """
+
+    failed = await refresh_stale(client, state, 0, (LOWER_SENSOR, UPPER_SENSOR))
 
-    match await lower_sensor_is_triggered(client):
-        case Maybe.empty:
-            print("FAILED: MODBUS couldn't read lower sensor.")
-        case Some(reading):
-            await flip_pump_if_lower(reading)
-            state.lower_sensor_is_triggered = reading
+    if LOWER_SENSOR in failed:
+        print("FAILED: MODBUS couldn't read lower sensor.")
+    # Turn on pump if the lower sensor is not triggered
+    elif not state.lower_sensor_is_triggered:
+        if state.pump_commands.request(state, True, "LLS") and tracer is not None:
+            tracer.record(DETECT, "LLS", False)
 
-    match await upper_sensor_is_triggered(client):
-        case Maybe.empty:
-            print("FAILED: MODBUS couldn't read upper sensor.")
-        case Some(reading):
-            await flip_pump_if_upper(reading)
-            state.upper_sensor_is_triggered = reading
+    if UPPER_SENSOR in failed:
+        print("FAILED: MODBUS couldn't read upper sensor.")
+    # Turn off pump if the upper sensor is triggered
+    elif state.upper_sensor_is_triggered:
+        if state.pump_commands.request(state, False, "ULS") and tracer is not None:
+            tracer.record(DETECT, "ULS", True)
+
+    await state.pump_commands.flush(client, state)
 
 
 async def run_client():
-    DELAY_SEC = 30
-    DELAY_UNTIL_UPDATE = range(DELAY_SEC*167) #167 was a coefficient experimentally determined to correspont to ~1sec
+    DELAY_SEC = 30 # Time between refreshes of the cached state, kept by the clock so it doesn't depend on how long a scan takes.
+
+    tracer = LatencyTracer() if TRACE_FILE is not None else None
 
     async with modbus_client(SERVER_IP,SERVER_PORT) as client:
         
         state = environment_state()
         await update_state(client,state)
+        next_refresh = time.monotonic() + DELAY_SEC
 
-        while True:
-            for _ in DELAY_UNTIL_UPDATE:
-                await flip_pump_if_pass_trigger(client,state)
-                #print(f"__ {_}")
-            await update_state(client,state)
+        try:
+            while True:
+                await flip_pump_if_pass_trigger(client,state,tracer)
+                if time.monotonic() >= next_refresh:
+                    await update_state(client,state,max_age_ms=DELAY_SEC*1000) # Only re-reads what the scans haven't
+                    next_refresh = time.monotonic() + DELAY_SEC
+        finally:
+            print(f"COMMANDS: {state.pump_commands.stats.summary()}")
+            if tracer is not None and TRACE_FILE is not None:
+                tracer.save(TRACE_FILE)
+                log.info(f"Saved {len(tracer)} trace events to {TRACE_FILE}")
 
             
 
@@ -0,0 +1,92 @@
+# bench_plc.py
+# Microbenchmarks for the client-side overhead of the PLC helpers. No server is needed, replies come from a fake client.
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+from returns.result import Result, Success, Failure
+from returns.maybe import Maybe, Some, Nothing
+from pymodbus.pdu import ModbusPDU
+from pymodbus.pdu.bit_message import ReadCoilsResponse, ReadDiscreteInputsResponse, WriteSingleCoilResponse
+
+import auto_plc
+import plc_points
+
+log = logging.getLogger()
+
+class _FakeClient:
+    "Answers every request immediately with a canned reply, so only the helpers' own work is timed."
+    def __init__(self):
+        self._coils = ReadCoilsResponse(bits=[True]+[False]*7)
+        self._inputs = ReadDiscreteInputsResponse(bits=[True]+[False]*7)
+        self._write = WriteSingleCoilResponse(address=0, bits=[True])
+
+    async def read_coils(self, address:int, count:int=1, **kwargs):
+        return self._coils
+
+    async def read_discrete_inputs(self, address:int, count:int=1, **kwargs):
+        return self._inputs
+
+    async def write_coil(self, address:int, value:bool, **kwargs):
+        return self._write
+
+def _legacy_find_errors(result:ModbusPDU) -> Result[ModbusPDU,ModbusPDU]:
+    if result.isError():
+        return Failure(result)
+    return Success(result)
+
+def _legacy_handle_errors(result:ModbusPDU) -> Maybe[ModbusPDU]:
+    match _legacy_find_errors(result):
+        case Success(pdu):
+            log.debug(f"Modbus Transaction Success: {pdu}")
+            return Some(pdu)
+        case Failure(pdu):
+            log.error(f"Modbus Transaction Error: {pdu}")
+            return Nothing
+
+async def _legacy_upper_sensor_is_triggered(client) -> Maybe[bool]:
+    "The original Result/Maybe implementation, kept here so it can be compared against."
+    return _legacy_handle_errors(await client.read_discrete_inputs(address=0, count=1)).bind(
+        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
+    )
+
+async def _legacy_read(client) -> bool|None:
+    match await _legacy_upper_sensor_is_triggered(client):
+        case Maybe.empty:
+            return None
+        case Some(reading):
+            return reading
+
+async def _maybe_read(client) -> bool|None:
+    match await auto_plc.upper_sensor_is_triggered(client):
+        case Maybe.empty:
+            return None
+        case Some(reading):
+            return reading
+
+async def _fast_read(client) -> bool|None:
+    try:
+        return await plc_points.read_upper_sensor(client)
+    except plc_points.ModbusTransactionError:
+        return None
+
+async def _time_per_call(read:Callable[[_FakeClient], Awaitable[bool|None]], calls:int) -> float:
+    client = _FakeClient()
+    start = time.perf_counter()
+    for _ in range(calls):
+        await read(client)
+    return (time.perf_counter() - start) / calls
+
+async def bench_result_handling(calls:int=200_000) -> None:
+    "Per-call cost of reading a sensor through the legacy Result/Maybe chain, the Maybe wrapper and the fast path."
+    print("="*25+"[ Result Handling ]"+"="*25)
+    legacy = await _time_per_call(_legacy_read, calls)
+    maybe  = await _time_per_call(_maybe_read, calls)
+    fast   = await _time_per_call(_fast_read, calls)
+    print(f"Legacy Result/Maybe chain: {legacy*1e6:7.3f} us/call")
+    print(f"Maybe wrapper:             {maybe*1e6:7.3f} us/call")
+    print(f"Fast path:                 {fast*1e6:7.3f} us/call  ({legacy/fast:.1f}x faster than legacy)")
+
+if __name__ == "__main__":
+    asyncio.run(bench_result_handling())
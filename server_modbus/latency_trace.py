@@ -0,0 +1,132 @@
+# latency_trace.py
+# Measures how long the control loop takes to react: from a level sensor flipping in the Environment simulation,
+# to the PLC noticing it, to the PLC's pump write landing in the server's datastore.
+#
+# The Environment and the PLC each keep their own LatencyTracer and save it to a file when they stop.
+# Run this file on the two trace files to join them into a latency histogram:
+#   poetry run ./server_modbus/latency_trace.py EnvironmentTrace.csv PlcTrace.csv
+import csv
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+SENSOR = "sensor"
+"Trace point: a level sensor changed value in the simulation (recorded by Environment.simulate)."
+DETECT = "detect"
+"Trace point: the PLC read a sensor value that makes it act on the pump (recorded by auto_plc.flip_pump_if_pass_trigger)."
+COIL = "coil"
+"Trace point: the pump coil changed value in the server's datastore (recorded by Environment.TracedDeviceContext)."
+
+PUMP_COMMAND_FOR = {("LLS", False): True, ("ULS", True): False}
+"The (sensor, reading) pairs the controller acts on, and the pump value it writes in response."
+
+class LatencyTracer:
+    """
+    Keeps the last `capacity` trace events in memory, so tracing a long run costs a bounded, small amount of memory.
+
+    Timestamps are wall-clock nanoseconds (time.time_ns) so traces from the Environment and the PLC can be joined;
+    they need to run on the same host, or on hosts with synchronized clocks.
+    """
+    def __init__(self, capacity:int=100_000):
+        self._events: deque[tuple[int,str,str,bool]] = deque(maxlen=capacity)
+
+    def record(self, point:str, signal:str, value:bool) -> None:
+        self._events.append((time.time_ns(), point, signal, value))
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def save(self, file:Path) -> None:
+        with open(file=file, mode='w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time_ns', 'point', 'signal', 'value'])
+            writer.writerows(self._events)
+
+    @staticmethod
+    def load(file:Path) -> list[tuple[int,str,str,bool]]:
+        with open(file=file, mode='r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader) #Ignore headers
+            return [(int(row[0]), row[1], row[2], row[3] == 'True') for row in reader]
+
+@dataclass
+class control_latencies:
+    "Latencies (in seconds) of each sensor transition the controller had to act on."
+    sensor_to_detect: list[float] = field(default_factory=list)
+    detect_to_coil: list[float] = field(default_factory=list)
+    sensor_to_coil: list[float] = field(default_factory=list)
+    unanswered: int = field(default=0)
+    "Transitions with no pump write before the sensor changed again (e.g. the pump was already in the right state)."
+
+def join_traces(*traces:list[tuple[int,str,str,bool]]) -> control_latencies:
+    "Matches each actionable sensor transition with the first detection and coil change that answer it."
+    events = sorted(e for trace in traces for e in trace)
+    out = control_latencies()
+
+    for i, (t_sensor, point, signal, value) in enumerate(events):
+        if point != SENSOR or (signal, value) not in PUMP_COMMAND_FOR:
+            continue
+        pump_value = PUMP_COMMAND_FOR[(signal, value)]
+
+        t_detect: int|None = None
+        t_coil: int|None = None
+        for j in range(i+1, len(events)):
+            t, p, s, v = events[j]
+            if p == SENSOR and s == signal:
+                break # The sensor changed again before the controller answered.
+            if p == DETECT and s == signal and v == value and t_detect is None:
+                t_detect = t
+            if p == COIL and v == pump_value:
+                t_coil = t
+                break
+
+        if t_coil is None:
+            out.unanswered += 1
+            continue
+        out.sensor_to_coil.append((t_coil - t_sensor) / 1e9)
+        if t_detect is not None:
+            out.sensor_to_detect.append((t_detect - t_sensor) / 1e9)
+            out.detect_to_coil.append((t_coil - t_detect) / 1e9)
+    return out
+
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def latency_histogram(latencies_sec:list[float], buckets_ms:list[float]=HISTOGRAM_BUCKETS_MS) -> list[tuple[str,int]]:
+    "Counts latencies into buckets with the given upper bounds (ms), plus one overflow bucket."
+    counts = [0] * (len(buckets_ms) + 1)
+    for latency in latencies_sec:
+        ms = latency * 1000
+        for b, bound in enumerate(buckets_ms):
+            if ms <= bound:
+                counts[b] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f"<= {b} ms" for b in buckets_ms] + [f"> {buckets_ms[-1]} ms"]
+    return list(zip(labels, counts))
+
+def print_histogram(title:str, latencies_sec:list[float], width:int=40) -> None:
+    print("="*25+f"[ {title} ]"+"="*25)
+    if len(latencies_sec) == 0:
+        print("No samples.")
+        return
+    ordered = sorted(latencies_sec)
+    print(f"samples={len(ordered)} min={ordered[0]*1000:.2f}ms median={ordered[len(ordered)//2]*1000:.2f}ms max={ordered[-1]*1000:.2f}ms")
+    histogram = latency_histogram(latencies_sec)
+    most = max(c for _, c in histogram)
+    for label, count in histogram:
+        print(f"{label:>12} | {'#' * round(width * count / most):<{width}} {count}")
+
+def print_report(latencies:control_latencies) -> None:
+    print_histogram("Sensor Flip -> Pump Coil Changed", latencies.sensor_to_coil)
+    print_histogram("Sensor Flip -> PLC Detected", latencies.sensor_to_detect)
+    print_histogram("PLC Detected -> Pump Coil Changed", latencies.detect_to_coil)
+    print(f"Unanswered transitions: {latencies.unanswered}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <trace file> [<trace file> ...]")
+        sys.exit(1)
+    print_report(join_traces(*(LatencyTracer.load(Path(f)) for f in sys.argv[1:])))
@@ -1,14 +1,25 @@
 # modbus_client.py
+import argparse
 import asyncio
+import contextvars
+import csv
 import logging
-from returns.result import Result, Success, Failure
+import sys
+import threading
+import time
+import yaml
 from returns.maybe import Maybe, Some, Nothing
-from returns.future import Future
 
 from pymodbus.pdu import ModbusPDU
 from pymodbus.client import AsyncModbusTcpClient
 from contextlib import asynccontextmanager
 from enum import Enum, auto
+from dataclasses import dataclass, field
+from pathlib import Path
+from collections.abc import Callable
+
+from modbus_connection import ResilientModbusConnection
+from plc_points import ModbusTransactionError, read_upper_sensor, read_lower_sensor, read_sensors, read_pump, write_pump
 
 logging.basicConfig()
 log = logging.getLogger()
@@ -17,18 +28,17 @@ log.setLevel(logging.ERROR)
 SERVER_IP = "127.0.0.1" # Connect to localhost
 SERVER_PORT = 5020
 
+STATUS_REFRESH_SEC: float|None = 2.0
+"How often statuses are reprinted in the background while waiting for commands. None only prints them after each command."
+
 @asynccontextmanager
-async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT):
+async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT, warm_standby:bool=False, trace_pdu:Callable[[bool,ModbusPDU],ModbusPDU]|None=None):
+    "Yields a connection that reconnects by itself (see ResilientModbusConnection) and can be used like an AsyncModbusTcpClient."
     
-    client = AsyncModbusTcpClient(server_ip, port=server_port)
+    client = ResilientModbusConnection(server_ip, server_port, warm_standby=warm_standby, trace_pdu=trace_pdu)
     log.info(f"Connecting to Modbus server at {server_ip}:{server_port}")
-    await client.connect()
-
-    if not client.connected:
-        log.error("Failed to connect to the Modbus server.")
-        return
-    else:
-        log.info("Successfully connected to the server.")
+    await client.connect() # Keeps retrying until the server is reachable
+    log.info("Successfully connected to the server.")
     
     try:
         yield client
@@ -40,50 +50,46 @@ async def modbus_client(server_ip:str=SERVER_IP, server_port:int=SERVER_PORT):
         #raise e
     finally:
         log.info("Closing connection.")
+        if client.metrics.disconnects > 0:
+            print(f"CONNECTION: {client.metrics.summary()}")
         client.close()
 
-def _find_errors(result:ModbusPDU) -> Result[ModbusPDU,ModbusPDU]:
-    if result.isError():
-        return Failure(result)
-    return Success(result)
-
-def _log_errors(result:Result[ModbusPDU,ModbusPDU]) -> Maybe[ModbusPDU]:
-    match result:
-        case Success(pdu):
-            log.debug(f"Modbus Transaction Success: {result}")
-            return Some(pdu)
-        case Failure(pdu):
-            log.error(f"Modbus Transaction Error: {result}")
-            return Nothing
-        
-def handle_errors(result:ModbusPDU) -> Maybe[ModbusPDU]:
-    return _log_errors(_find_errors(result))
+#---------------------------------------------[ Maybe API ]---------------------------------------------#
 
 async def upper_sensor_is_triggered(client:AsyncModbusTcpClient) -> Maybe[bool]:
     log.debug("Reading Status of upper water sensor")
-    return handle_errors(await client.read_discrete_inputs(address=0, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_upper_sensor(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 async def lower_sensor_is_triggered(client:AsyncModbusTcpClient) -> Maybe[bool]:
     log.debug("Reading Status of lower water sensor")
-    return handle_errors(await client.read_discrete_inputs(address=1, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_lower_sensor(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 async def set_pump(client:AsyncModbusTcpClient,activate:bool) -> bool:
     "Lets you set the water pump to be active or deactivated. Return True if successfully, False if error."
-    log.debug(f"Turning Pump {'ON' if activate else 'OFF'}")
-    return handle_errors(await client.write_coil(address=0, value=activate)).bind(
-        lambda pdu: Some(True) #Get rid of pdu because not useful
-    ).value_or(False)
+    log.debug("Turning Pump %s", 'ON' if activate else 'OFF')
+    try:
+        await write_pump(client, activate)
+        return True
+    except ModbusTransactionError as e:
+        log.error(e)
+        return False
 
 async def pump_is_active(client:AsyncModbusTcpClient) -> Maybe[bool]:
     "Returns true if the water pump is active"
     log.debug("Reading Status of Pump")
-    return handle_errors(await client.read_coils(address=0, count=1)).bind(
-        lambda pdu: Some(pdu.bits[0]) if len(pdu.bits) >= 1 else Nothing
-    )
+    try:
+        return Some(await read_pump(client))
+    except ModbusTransactionError as e:
+        log.error(e)
+        return Nothing
 
 def boolean_to_text(reading:Maybe[bool])->str:
     match reading:
@@ -101,14 +107,61 @@ def string_to_boolean(string:str)->Maybe[bool]:
         case _:
             return Nothing
 
+class _StdinReader:
+    """
+    Reads stdin on a daemon thread and hands the lines to the event loop, so waiting for the operator doesn't freeze it.
+    A daemon thread (rather than asyncio.to_thread) so a pending read never keeps the program from exiting.
+    """
+    _instance: '_StdinReader|None' = None
+
+    def __init__(self, loop:asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._lines: asyncio.Queue[str] = asyncio.Queue()
+        threading.Thread(target=self._read_lines, name="stdin reader", daemon=True).start()
+
+    def _read_lines(self) -> None:
+        for line in sys.stdin:
+            self._loop.call_soon_threadsafe(self._lines.put_nowait, line)
+        self._loop.call_soon_threadsafe(self._lines.put_nowait, "") # EOF
+
+    @classmethod
+    def get(cls) -> '_StdinReader':
+        loop = asyncio.get_running_loop()
+        if cls._instance is None or cls._instance._loop is not loop:
+            cls._instance = _StdinReader(loop)
+        return cls._instance
+
+    async def readline(self) -> str:
+        return await self._lines.get()
+
+async def async_input(prompt:str="") -> str:
+    "Like input(), but lets the event loop keep running while the operator types."
+    print(prompt, end="", flush=True)
+    line = await _StdinReader.get().readline()
+    if line == "":
+        raise EOFError("stdin was closed.")
+    return line.rstrip("\n")
+
 async def print_statuses(client:AsyncModbusTcpClient) -> None:
     log.info("Rendering a status page.")
-    print(  f"Upper Water Level: {boolean_to_text(await upper_sensor_is_triggered(client))}\n"
-          + f"Lower Water Level: {boolean_to_text(await lower_sensor_is_triggered(client))}\n"
-          + f"Water Pump:        {boolean_to_text(await pump_is_active(client))}")
+    upper, lower, pump = await asyncio.gather(
+        upper_sensor_is_triggered(client),
+        lower_sensor_is_triggered(client),
+        pump_is_active(client),
+    )
+    print(  f"Upper Water Level: {boolean_to_text(upper)}\n"
+          + f"Lower Water Level: {boolean_to_text(lower)}\n"
+          + f"Water Pump:        {boolean_to_text(pump)}")
+
+async def keep_printing_statuses(client:AsyncModbusTcpClient, refresh_sec:float) -> None:
+    "Reprints the statuses every `refresh_sec` until cancelled."
+    while True:
+        await asyncio.sleep(refresh_sec)
+        print() # Leave the prompt's line alone
+        await print_statuses(client)
 
 async def request_and_perform_user_input(client:AsyncModbusTcpClient) -> None:
-    request = input(
+    request = await async_input(
         "="*25+"[ Commands Available ]"+"="*25+"\n"
         +"Update Status: [Enter]"+"\n"
         +"Water Pump:    p[Enter]"+"\n"
@@ -116,7 +169,7 @@ async def request_and_perform_user_input(client:AsyncModbusTcpClient) -> None:
     )
     match request.lower():
         case "p" | "pump":
-            request = input("Decide whether to activate or deactivate the pump. \n[1] to activate [0] to deactivate\n> ")
+            request = await async_input("Decide whether to activate or deactivate the pump. \n[1] to activate [0] to deactivate\n> ")
             match string_to_boolean(request):
                 case Maybe.empty:
                     print(f"Could not understand request ({request}). Canceling.")
@@ -127,6 +180,142 @@ async def request_and_perform_user_input(client:AsyncModbusTcpClient) -> None:
         case _:
             return
 
+#---------------------------------------------[ Scripted Commands ]---------------------------------------------#
+# Drives the pump from a YAML script instead of the keyboard, for repeatable tests. A script looks like:
+#
+#   commands:               # `at` is seconds from the start of the script
+#     - {at: 0.000, pump: true}
+#     - {at: 0.005, read: pump}           # read one of: pump, upper_sensor, lower_sensor
+#     - {at: 0.010, pump: false}
+#   repeat: 10              # optional, run the commands this many times
+#   period: 0.020           # optional, seconds between repeats (default: each repeat starts SCRIPT_REPEAT_GAP_SEC after the last command)
+
+SCRIPT_REPEAT_GAP_SEC = 0.001
+"Without a `period`, how long after the last command of a repeat the next repeat's first command is sent."
+
+SPIN_BEFORE_SEC = 0.002
+"The scheduler sleeps until this long before each command, then yields to the event loop until it's due, for sub-millisecond timing."
+
+_SCRIPT_READS = {
+    "pump": pump_is_active,
+    "upper_sensor": upper_sensor_is_triggered,
+    "lower_sensor": lower_sensor_is_triggered,
+}
+
+@dataclass(frozen=True)
+class script_command:
+    at_sec: float
+    "When to send the command, in seconds since the script started."
+    action: str
+    "`write_pump` to write the pump, or the name of the value to read."
+    value: bool|None = field(default=None)
+    "The value written to the pump."
+
+@dataclass
+class script_result:
+    command: script_command
+    issued_sec: float
+    "When the command was handed to the connection, in seconds since the script started."
+    sent_sec: float
+    "When its request was written to the socket (its last attempt, if it was retried)."
+    latency_sec: float
+    "Round trip: from the request being written to the socket to getting its reply."
+    result: str
+
+    @property
+    def lateness_sec(self) -> float:
+        "How late the scheduler issued the command."
+        return self.issued_sec - self.command.at_sec
+
+    @property
+    def queued_sec(self) -> float:
+        "Time spent waiting behind earlier commands, since a connection only has one request in flight."
+        return self.sent_sec - self.issued_sec
+
+def load_command_script(file:Path) -> list[script_command]:
+    "Reads a YAML command script (see above) into a list of commands ordered by time."
+    with open(file=file, mode='r') as f:
+        script = yaml.safe_load(f)
+
+    commands = []
+    for entry in script["commands"]:
+        if "pump" in entry:
+            commands.append(script_command(at_sec=float(entry["at"]), action="write_pump", value=bool(entry["pump"])))
+        elif entry.get("read") in _SCRIPT_READS:
+            commands.append(script_command(at_sec=float(entry["at"]), action=entry["read"]))
+        else:
+            raise ValueError(f"Could not understand script command {entry}. Use `pump: true|false` or `read: {'|'.join(_SCRIPT_READS)}`.")
+    commands.sort(key=lambda c: c.at_sec)
+
+    repeat = int(script.get("repeat", 1))
+    period = float(script.get("period", commands[-1].at_sec - commands[0].at_sec + SCRIPT_REPEAT_GAP_SEC if len(commands) > 0 else 0))
+    return [script_command(c.at_sec + i*period, c.action, c.value) for i in range(repeat) for c in commands]
+
+async def _sleep_until(deadline:float) -> None:
+    "Waits until time.perf_counter() reaches deadline, more precisely than asyncio.sleep() alone."
+    coarse = deadline - time.perf_counter() - SPIN_BEFORE_SEC
+    if coarse > 0:
+        await asyncio.sleep(coarse)
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0)
+
+_send_times: contextvars.ContextVar[list[float]] = contextvars.ContextVar("_send_times")
+"Set by each script command's task, so trace_send_time can tell it when its request went on the wire."
+
+def trace_send_time(sending:bool, pdu:ModbusPDU) -> ModbusPDU:
+    """
+    A `trace_pdu` hook for the connection. pymodbus calls it from the task making the request as the request is written
+    to the socket (after waiting its turn on the connection), so it records that time for the script command running in that task.
+    """
+    if sending:
+        send_times = _send_times.get(None)
+        if send_times is not None: send_times.append(time.perf_counter())
+    return pdu
+
+async def _perform_script_command(client:AsyncModbusTcpClient, command:script_command, start:float) -> script_result:
+    send_times:list[float] = []
+    _send_times.set(send_times) # Each task runs in its own copy of the context.
+    issued = time.perf_counter()
+    if command.action == "write_pump":
+        result = "OK" if await set_pump(client, activate=bool(command.value)) else "ERROR"
+    else:
+        result = boolean_to_text(await _SCRIPT_READS[command.action](client))
+    replied = time.perf_counter()
+    sent = send_times[-1] if len(send_times) > 0 else issued # Without the hook, queueing can't be told apart from the round trip.
+    return script_result(command, issued_sec=issued - start, sent_sec=sent - start, latency_sec=replied - sent, result=result)
+
+async def run_command_script(client:AsyncModbusTcpClient, commands:list[script_command]) -> list[script_result]:
+    """
+    Issues each command at its offset, without waiting for earlier replies.
+    pymodbus still only has one request in flight per connection, so commands issued faster than the round trip queue up
+    behind each other and the sustained command rate is limited by the round trip. That wait is reported apart from each
+    command's round trip when the connection was made with `trace_pdu=trace_send_time`.
+    """
+    start = time.perf_counter()
+    tasks = []
+    for command in commands:
+        await _sleep_until(start + command.at_sec)
+        tasks.append(asyncio.create_task(_perform_script_command(client, command, start)))
+    return list(await asyncio.gather(*tasks))
+
+def print_script_results(results:list[script_result]) -> None:
+    print("="*25+"[ Script Results ]"+"="*25)
+    for r in results:
+        target = f"pump <- {'ON' if r.command.value else 'OFF'}" if r.command.action == "write_pump" else f"read {r.command.action}"
+        print(f"{r.command.at_sec*1000:10.3f} ms  {target:<20} late {r.lateness_sec*1000:7.3f} ms  queued {r.queued_sec*1000:7.3f} ms  "
+              f"latency {r.latency_sec*1000:7.3f} ms  {r.result}")
+    if len(results) > 0:
+        latencies = sorted(r.latency_sec for r in results)
+        print(f"commands={len(results)} rate={len(results)/max(results[-1].sent_sec, 1e-9):.0f}/s "
+              f"latency min/median/max={latencies[0]*1000:.3f}/{latencies[len(latencies)//2]*1000:.3f}/{latencies[-1]*1000:.3f} ms "
+              f"max queued={max(r.queued_sec for r in results)*1000:.3f} ms max lateness={max(r.lateness_sec for r in results)*1000:.3f} ms")
+
+def save_script_results(file:Path, results:list[script_result]) -> None:
+    with open(file=file, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scheduled_sec', 'issued_sec', 'sent_sec', 'queued_sec', 'latency_sec', 'action', 'value', 'result'])
+        writer.writerows([r.command.at_sec, r.issued_sec, r.sent_sec, r.queued_sec, r.latency_sec, r.command.action, r.command.value, r.result] for r in results)
+
 async def initial_test_script(client):
     "A Script used to verify that the modbus protocol worked by printint to the screen. To be used durrins assorted debugging."
 
@@ -182,17 +371,35 @@ async def initial_test_script(client):
         log.info(f"Read Input Registers (5-7): {rr_ir.registers}")
         log.info(f"Read bits: {rr_ir.bits}")
 
-async def run_client():
+async def run_client(status_refresh_sec:float|None=STATUS_REFRESH_SEC, command_script:Path|None=None, script_results:Path|None=None):
 
-    async with modbus_client(SERVER_IP,SERVER_PORT) as client:
+    async with modbus_client(SERVER_IP,SERVER_PORT, trace_pdu=trace_send_time) as client:
 
         if False: # Set True for testing
             initial_test_script(client)
             return
+
+        if command_script is not None:
+            results = await run_command_script(client, load_command_script(command_script))
+            print_script_results(results)
+            if script_results is not None:
+                save_script_results(script_results, results)
+            return
         
-        while True:
-            await print_statuses(client)
-            await request_and_perform_user_input(client)
+        status_task = None
+        if status_refresh_sec is not None:
+            status_task = asyncio.create_task(keep_printing_statuses(client, status_refresh_sec))
+            status_task.set_name("Background status printer")
+
+        try:
+            while True:
+                await print_statuses(client)
+                await request_and_perform_user_input(client)
+        except EOFError:
+            log.info("Input closed.")
+        finally:
+            if status_task is not None:
+                status_task.cancel()
 
         
         
@@ -200,7 +407,11 @@ async def run_client():
     
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control the pump by hand, or from a command script.")
+    parser.add_argument("--script", type=Path, default=None, help="YAML command script to run instead of reading the keyboard.")
+    parser.add_argument("--results", type=Path, default=None, help="CSV file to save the script's per-command latencies to.")
+    args = parser.parse_args()
     try:
-        asyncio.run(run_client())
+        asyncio.run(run_client(command_script=args.script, script_results=args.results))
     except KeyboardInterrupt:
         log.info(f"Program stopped by user. [ctrl+C]")
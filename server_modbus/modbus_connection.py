@@ -0,0 +1,207 @@
+# modbus_connection.py
+# A modbus connection that survives the server going away, used in place of a bare AsyncModbusTcpClient by the PLC scripts.
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from collections.abc import Callable, Iterator
+
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.pdu import ModbusPDU
+
+log = logging.getLogger()
+
+@dataclass
+class connection_metrics:
+    "How often a ResilientModbusConnection lost its server and how long it took to get it back."
+    connects: int = field(default=0)
+    "Successful connections opened (primary and standby)."
+    failed_attempts: int = field(default=0)
+    "Connection attempts that failed."
+    disconnects: int = field(default=0)
+    "Times a request failed because the active connection was lost."
+    failovers: int = field(default=0)
+    "Times a warm standby connection was promoted instead of reconnecting."
+    recover_times_sec: list[float] = field(default_factory=list)
+    "Time from the start of the request that found the connection lost to a working connection being in place."
+
+    @property
+    def last_recover_time_sec(self) -> float|None:
+        return self.recover_times_sec[-1] if len(self.recover_times_sec) > 0 else None
+
+    @property
+    def mean_recover_time_sec(self) -> float|None:
+        return sum(self.recover_times_sec)/len(self.recover_times_sec) if len(self.recover_times_sec) > 0 else None
+
+    @property
+    def max_recover_time_sec(self) -> float|None:
+        return max(self.recover_times_sec) if len(self.recover_times_sec) > 0 else None
+
+    def summary(self) -> str:
+        text = f"connects={self.connects} failed_attempts={self.failed_attempts} disconnects={self.disconnects} failovers={self.failovers}"
+        if len(self.recover_times_sec) > 0:
+            text += (f" time_to_recover(last/mean/max)="
+                     f"{self.last_recover_time_sec*1000:.1f}/{self.mean_recover_time_sec*1000:.1f}/{self.max_recover_time_sec*1000:.1f} ms") #type:ignore
+        return text
+
+class ResilientModbusConnection:
+    """
+    Wraps AsyncModbusTcpClient so requests survive the server going away.
+
+    A request that fails because the connection was lost waits for the connection to be recovered and is then retried,
+    so a control loop simply stalls during an outage and carries on with its next request once the server is back.
+    Reconnects use exponential backoff with jitter, capped at `backoff_max_sec`; keep that at or below one scan period
+    so a loop resumes within a scan of the server coming back.
+
+    With `warm_standby` a second connection is kept open (and probed every `standby_probe_sec`) and is promoted immediately
+    when the primary fails, which hides outages that only affect one connection (e.g. a dropped socket).
+
+    A request in flight when the server dies is only noticed after `timeout_sec` * (`retries` + 1), so keep those small too.
+    """
+    def __init__(self, server_ip:str, server_port:int,
+                 warm_standby:bool=False,
+                 backoff_initial_sec:float=0.05,
+                 backoff_max_sec:float=1.0,
+                 backoff_jitter:float=0.5,
+                 standby_probe_sec:float=5.0,
+                 timeout_sec:float=1.0,
+                 retries:int=1,
+                 trace_pdu:Callable[[bool,ModbusPDU],ModbusPDU]|None=None):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.warm_standby = warm_standby
+        self.backoff_initial_sec = backoff_initial_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.backoff_jitter = backoff_jitter
+        "Fraction of each backoff delay that is randomized, so many clients don't reconnect in lockstep."
+        self.standby_probe_sec = standby_probe_sec
+        self.timeout_sec = timeout_sec
+        self.retries = retries
+        self.trace_pdu = trace_pdu
+        "Passed to every AsyncModbusTcpClient made: called with (True, request) as each request is written to the socket, and (False, reply) for replies."
+
+        self.metrics = connection_metrics()
+        self._primary: AsyncModbusTcpClient|None = None
+        self._standby: AsyncModbusTcpClient|None = None
+        self._standby_task: asyncio.Task|None = None
+        self._recover_lock = asyncio.Lock()
+        self._closed = False
+
+    @property
+    def connected(self) -> bool:
+        return self._primary is not None and self._primary.connected
+
+    def _backoff_delays(self) -> Iterator[float]:
+        delay = self.backoff_initial_sec
+        while True:
+            yield delay * (1 - self.backoff_jitter * random.random())
+            delay = min(delay * 2, self.backoff_max_sec)
+
+    async def _open_client(self, purpose:str) -> AsyncModbusTcpClient:
+        "Keeps trying to connect, backing off between attempts, until a connection is made. Raises ConnectionException once close() is called."
+        for attempt, delay in enumerate(self._backoff_delays()):
+            if self._closed:
+                raise ConnectionException("Connection was closed.")
+            # reconnect_delay=0 turns off pymodbus' own reconnecting, this class does it instead.
+            client = AsyncModbusTcpClient(self.server_ip, port=self.server_port, reconnect_delay=0,
+                                          timeout=self.timeout_sec, retries=self.retries, trace_pdu=self.trace_pdu)
+            connected = await client.connect()
+            if connected and not self._closed:
+                self.metrics.connects += 1
+                log.info(f"Connected {purpose} connection to {self.server_ip}:{self.server_port}")
+                return client
+            client.close() # Also when close() was called while connecting, so nothing is left open.
+            if not connected:
+                self.metrics.failed_attempts += 1
+                if attempt == 0:
+                    log.error(f"Failed to connect {purpose} connection to {self.server_ip}:{self.server_port}, retrying.")
+                await asyncio.sleep(delay)
+
+    async def connect(self) -> None:
+        "Waits until the primary connection is open, then starts keeping the standby warm if requested."
+        self._closed = False
+        self._primary = await self._open_client("primary")
+        if self.warm_standby and self._standby_task is None:
+            self._standby_task = asyncio.create_task(self._keep_standby_warm())
+            self._standby_task.set_name(f"Warm standby for {self.server_ip}:{self.server_port}")
+
+    async def _keep_standby_warm(self) -> None:
+        while not self._closed:
+            if self._standby is None or not self._standby.connected:
+                if self._standby is not None: self._standby.close()
+                self._standby = await self._open_client("standby")
+                continue
+            await asyncio.sleep(self.standby_probe_sec)
+            standby = self._standby
+            if standby is None: continue # Promoted to primary while we slept.
+            try:
+                await standby.read_coils(0, count=1)
+            except (ConnectionException, ModbusIOException) as e:
+                log.warning(f"Standby connection failed its probe: {e}")
+                if self._standby is standby:
+                    standby.close()
+                    self._standby = None
+
+    async def _recover(self, failed:AsyncModbusTcpClient|None, failed_at:float) -> None:
+        "Replaces the failed primary connection. Callers that failed on the same connection share one recovery."
+        async with self._recover_lock:
+            if self._primary is not failed:
+                return # Another request already recovered this connection.
+            self.metrics.disconnects += 1
+            if failed is not None: failed.close()
+            self._primary = None
+
+            if self._standby is not None and self._standby.connected:
+                self._primary, self._standby = self._standby, None
+                self.metrics.failovers += 1
+                log.error(f"Lost connection to {self.server_ip}:{self.server_port}, failed over to standby.")
+            else:
+                log.error(f"Lost connection to {self.server_ip}:{self.server_port}, reconnecting.")
+                self._primary = await self._open_client("primary")
+
+            self.metrics.recover_times_sec.append(time.monotonic() - failed_at)
+
+    async def _execute(self, request:str, *args, **kwargs) -> ModbusPDU:
+        while True:
+            if self._closed:
+                raise ConnectionException("Connection was closed.")
+            client = self._primary
+            started = time.monotonic()
+            try:
+                if client is None: raise ConnectionException("Not connected.")
+                return await getattr(client, request)(*args, **kwargs)
+            except (ConnectionException, ModbusIOException) as e:
+                if isinstance(e.__cause__, asyncio.CancelledError):
+                    raise asyncio.CancelledError() from e # pymodbus reports our own cancellation as an IO error.
+                log.debug(f"Modbus {request} failed: {e}")
+                await self._recover(client, started)
+
+    def read_coils(self, address:int, **kwargs):
+        return self._execute("read_coils", address, **kwargs)
+
+    def read_discrete_inputs(self, address:int, **kwargs):
+        return self._execute("read_discrete_inputs", address, **kwargs)
+
+    def read_holding_registers(self, address:int, **kwargs):
+        return self._execute("read_holding_registers", address, **kwargs)
+
+    def read_input_registers(self, address:int, **kwargs):
+        return self._execute("read_input_registers", address, **kwargs)
+
+    def write_coil(self, address:int, value:bool, **kwargs):
+        return self._execute("write_coil", address, value, **kwargs)
+
+    def write_register(self, address:int, value:int, **kwargs):
+        return self._execute("write_register", address, value, **kwargs)
+
+    def close(self) -> None:
+        self._closed = True
+        if self._standby_task is not None:
+            self._standby_task.cancel()
+            self._standby_task = None
+        for client in (self._primary, self._standby):
+            if client is not None: client.close()
+        self._primary = None
+        self._standby = None
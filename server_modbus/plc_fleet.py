@@ -0,0 +1,282 @@
+# plc_fleet.py
+# Runs many independent auto_plc controllers (one per tank) inside a single event loop.
+import asyncio
+import gc
+import logging
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from modbus_connection import ResilientModbusConnection, connection_metrics
+
+from auto_plc import (
+    SERVER_IP,
+    SERVER_PORT,
+    environment_state,
+    update_state,
+    flip_pump_if_pass_trigger,
+)
+
+log = logging.getLogger()
+
+DEFAULT_DEVICE_ID = 1
+"pymodbus' default device (unit) id, used by the single-tank scripts."
+STOP_TIMEOUT_SEC = 5
+"How long controllers get to finish their current scan when the fleet stops before they are cancelled."
+
+@dataclass(frozen=True)
+class tank_config:
+    "Where to find the modbus device that controls one tank."
+    name: str
+    server_ip: str = field(default=SERVER_IP)
+    server_port: int = field(default=SERVER_PORT)
+    device_id: int = field(default=DEFAULT_DEVICE_ID)
+    "The modbus unit id of the tank on its server."
+
+@dataclass
+class tank_stats:
+    "Counters kept for a single tank's controller."
+    scans: int = field(default=0)
+    refreshes: int = field(default=0)
+    pump_turned_on: int = field(default=0)
+    pump_turned_off: int = field(default=0)
+    scan_time_total_sec: float = field(default=0)
+    scan_time_max_sec: float = field(default=0)
+    pump_writes_avoided: int = field(default=0)
+
+    def record_scan(self, duration_sec:float) -> None:
+        self.scans += 1
+        self.scan_time_total_sec += duration_sec
+        if duration_sec > self.scan_time_max_sec:
+            self.scan_time_max_sec = duration_sec
+
+    def reset(self) -> None:
+        self.__init__()
+
+class _DeviceClient:
+    """
+    Binds a device id to a shared client, so the auto_plc helpers (which never pass a device id)
+    can be used unchanged against a pooled connection.
+    """
+    __slots__ = ("client", "device_id")
+
+    def __init__(self, client:ResilientModbusConnection, device_id:int):
+        self.client = client
+        self.device_id = device_id
+
+    def read_coils(self, address:int, count:int=1):
+        return self.client.read_coils(address, count=count, device_id=self.device_id)
+
+    def read_discrete_inputs(self, address:int, count:int=1):
+        return self.client.read_discrete_inputs(address, count=count, device_id=self.device_id)
+
+    def write_coil(self, address:int, value:bool):
+        return self.client.write_coil(address, value, device_id=self.device_id)
+
+class ConnectionPool:
+    """
+    Shares TCP connections between tanks.
+
+    Each server gets up to `connections_per_server` connections and tanks are spread over them round-robin, one tank at a time
+    (tanks on the same unit id too, as when a test server serves every unit id from one device).
+    pymodbus serializes requests on a single connection, so more connections per server means more requests in flight.
+    Tanks given the same connection and unit id share the same bound client.
+    Pooled connections reconnect by themselves, so an outage stalls the tanks on that server until it comes back.
+    """
+    def __init__(self, connections_per_server:int=1, warm_standby:bool=False):
+        self._connections_per_server = connections_per_server
+        self._warm_standby = warm_standby
+        self._connections: dict[tuple[str,int], list[ResilientModbusConnection]] = {}
+        self._next_connection: dict[tuple[str,int], int] = {}
+        self._device_clients: dict[tuple[int,int], _DeviceClient] = {}
+        "Bound clients by (id() of their connection, unit id)."
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(c) for c in self._connections.values())
+
+    @property
+    def metrics(self) -> list[connection_metrics]:
+        return [c.metrics for clients in self._connections.values() for c in clients]
+
+    async def _connect_server(self, server:tuple[str,int]) -> list[ResilientModbusConnection]:
+        clients = [ResilientModbusConnection(server[0], server[1], warm_standby=self._warm_standby) for _ in range(self._connections_per_server)]
+        log.info(f"Opening {len(clients)} connection(s) to Modbus server at {server[0]}:{server[1]}")
+        await asyncio.gather(*(c.connect() for c in clients)) # Keeps retrying until the server is reachable
+        return clients
+
+    async def get(self, tank:tank_config) -> _DeviceClient:
+        "Get the client a tank's controller should use, connecting to its server if this is the first tank on it."
+        server = (tank.server_ip, tank.server_port)
+        if server not in self._connections:
+            self._connections[server] = await self._connect_server(server)
+            self._next_connection[server] = 0
+
+        clients = self._connections[server]
+        index = self._next_connection[server]
+        self._next_connection[server] = (index + 1) % len(clients)
+
+        key = (id(clients[index]), tank.device_id)
+        if key not in self._device_clients:
+            self._device_clients[key] = _DeviceClient(clients[index], tank.device_id)
+        return self._device_clients[key]
+
+    def close(self) -> None:
+        log.info("Closing pooled connections.")
+        for clients in self._connections.values():
+            for c in clients:
+                c.close()
+        self._connections.clear()
+        self._next_connection.clear()
+        self._device_clients.clear()
+
+class _TankController:
+    "One tank's controller: the same scan loop as auto_plc.run_client, with its own environment_state."
+    def __init__(self, tank:tank_config, client:_DeviceClient, refresh_period_sec:float):
+        self.tank = tank
+        self.client = client
+        self.refresh_period_sec = refresh_period_sec
+        self.state = environment_state()
+        self.stats = tank_stats()
+
+    async def run(self, stop:asyncio.Event) -> None:
+        "Scans until `stop` is set. Stopping between scans avoids cancelling a request pymodbus has in flight."
+        await update_state(self.client, self.state) #type:ignore
+        self.stats.refreshes += 1
+        next_refresh = time.monotonic() + self.refresh_period_sec
+
+        while not stop.is_set():
+            pump_was_active = self.state.pump_is_active
+            start = time.perf_counter()
+            await flip_pump_if_pass_trigger(self.client, self.state) #type:ignore
+            self.stats.record_scan(time.perf_counter() - start)
+
+            if self.state.pump_is_active != pump_was_active:
+                if self.state.pump_is_active: self.stats.pump_turned_on += 1
+                else:                         self.stats.pump_turned_off += 1
+
+            self.stats.pump_writes_avoided = self.state.pump_commands.stats.writes_avoided
+
+            if time.monotonic() >= next_refresh:
+                await update_state(self.client, self.state, max_age_ms=self.refresh_period_sec*1000) #type:ignore
+                self.stats.refreshes += 1
+                next_refresh = time.monotonic() + self.refresh_period_sec
+
+@dataclass
+class fleet_report:
+    "The aggregated results of a fleet run."
+    tank_count: int
+    connection_count: int
+    duration_sec: float
+    memory_per_tank_bytes: float
+    per_tank: dict[str, tank_stats]
+    connections: list[connection_metrics]
+
+    @property
+    def total_scans(self) -> int:
+        return sum(s.scans for s in self.per_tank.values())
+
+    @property
+    def scans_per_sec(self) -> float:
+        return self.total_scans / self.duration_sec if self.duration_sec > 0 else 0
+
+    @property
+    def mean_scan_time_sec(self) -> float:
+        return sum(s.scan_time_total_sec for s in self.per_tank.values()) / self.total_scans if self.total_scans > 0 else 0
+
+    def print(self, show_tanks:bool=False) -> None:
+        print("="*25+"[ Fleet Report ]"+"="*25)
+        print(f"Tanks:                {self.tank_count}")
+        print(f"Connections:          {self.connection_count}")
+        print(f"Run Time:             {self.duration_sec:.2f} sec")
+        print(f"Total Scans:          {self.total_scans}")
+        print(f"Scans/sec (fleet):    {self.scans_per_sec:.1f}")
+        print(f"Scans/sec (per tank): {self.scans_per_sec/max(self.tank_count,1):.2f}")
+        print(f"Mean Scan Time:       {self.mean_scan_time_sec*1000:.2f} ms")
+        print(f"Memory per Tank:      {self.memory_per_tank_bytes/1024:.1f} KiB")
+        print(f"Pump ON / OFF:        {sum(s.pump_turned_on for s in self.per_tank.values())} / {sum(s.pump_turned_off for s in self.per_tank.values())}")
+        print(f"Pump Writes Avoided:  {sum(s.pump_writes_avoided for s in self.per_tank.values())}")
+        print(f"Disconnects:          {sum(m.disconnects for m in self.connections)}")
+        for i, m in enumerate(self.connections):
+            if m.disconnects > 0: print(f"  connection {i}: {m.summary()}")
+        if show_tanks:
+            for name, s in self.per_tank.items():
+                print(f"  {name}: scans={s.scans} refreshes={s.refreshes} on={s.pump_turned_on} off={s.pump_turned_off} max_scan={s.scan_time_max_sec*1000:.2f}ms")
+
+def _traced_snapshot() -> tracemalloc.Snapshot:
+    "A tracemalloc snapshot without tracemalloc's own allocations, such as the earlier snapshot being compared against."
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+async def run_fleet(tanks:list[tank_config], duration_sec:float, connections_per_server:int=1, refresh_period_sec:float=30, warmup_sec:float=1, warm_standby:bool=False) -> fleet_report:
+    """
+    Runs one controller per tank in this event loop for `duration_sec` and reports on them.
+
+    Memory per tank is the growth traced by tracemalloc from creating the controllers through `warmup_sec` of running, taken
+    between two snapshots after garbage collection. The pooled connections are opened before tracing starts, so they aren't counted,
+    and tracing is stopped before the measured run so it doesn't slow it down.
+    """
+    pool = ConnectionPool(connections_per_server, warm_standby=warm_standby)
+    stop = asyncio.Event()
+    tasks: list[asyncio.Task] = []
+    try:
+        clients = [await pool.get(t) for t in tanks]
+
+        gc.collect()
+        tracemalloc.start()
+        before = _traced_snapshot()
+
+        controllers = [_TankController(t, client, refresh_period_sec) for t, client in zip(tanks, clients)]
+        for c in controllers:
+            task = asyncio.create_task(c.run(stop))
+            task.set_name(f"Controller for {c.tank.name}")
+            tasks.append(task)
+        await asyncio.sleep(warmup_sec)
+
+        gc.collect()
+        after = _traced_snapshot()
+        tracemalloc.stop()
+        growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        memory_per_tank = growth / max(len(controllers), 1)
+
+        for c in controllers:
+            c.stats.reset()
+            c.state.pump_commands.stats.reset()
+        start = time.perf_counter()
+        await asyncio.sleep(duration_sec)
+        duration = time.perf_counter() - start
+
+        for task in tasks:
+            if task.done() and task.exception() is not None:
+                log.error(f"{task.get_name()} stopped: {task.exception()}")
+
+        return fleet_report(
+            tank_count=len(controllers),
+            connection_count=pool.connection_count,
+            duration_sec=duration,
+            memory_per_tank_bytes=memory_per_tank,
+            per_tank={c.tank.name: c.stats for c in controllers},
+            connections=pool.metrics,
+        )
+    finally:
+        if tracemalloc.is_tracing(): tracemalloc.stop()
+        stop.set()
+        if len(tasks) > 0:
+            _, still_running = await asyncio.wait(tasks, timeout=STOP_TIMEOUT_SEC)
+            for task in still_running: task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+        pool.close()
+
+
+if __name__ == "__main__":
+    FLEET_SIZE = 100
+    CONNECTIONS_PER_SERVER = 4
+    RUN_TIME_SEC = 60
+
+    # Environment.py serves a single device, so every unit id maps to the same tank there.
+    TANKS = [tank_config(name=f"tank_{i:03}") for i in range(FLEET_SIZE)]
+
+    try:
+        report = asyncio.run(run_fleet(TANKS, duration_sec=RUN_TIME_SEC, connections_per_server=CONNECTIONS_PER_SERVER))
+        report.print(show_tanks=FLEET_SIZE <= 20)
+    except KeyboardInterrupt:
+        log.info(f"Program stopped by user. [ctrl+C]")
@@ -0,0 +1,42 @@
+# plc_points.py
+# The tank's modbus points (water sensors and pump), read and written as plain values. Shared by auto_plc.py and manual_plc.py.
+# These raise ModbusTransactionError instead of wrapping every reply in Result/Maybe, so they can be used in hot loops;
+# the Maybe helpers in the PLC scripts are thin wrappers over them.
+from pymodbus.pdu import ModbusPDU
+from pymodbus.client import AsyncModbusTcpClient
+
+class ModbusTransactionError(Exception):
+    "The server answered with an error, or with a reply that didn't contain the requested value."
+    def __init__(self, pdu:ModbusPDU):
+        super().__init__(f"Modbus Transaction Error: {pdu}")
+        self.pdu = pdu
+
+def _first_bit(pdu:ModbusPDU) -> bool:
+    if pdu.isError() or not pdu.bits:
+        raise ModbusTransactionError(pdu)
+    return pdu.bits[0]
+
+async def read_upper_sensor(client:AsyncModbusTcpClient) -> bool:
+    "Reads the upper water sensor. Raises ModbusTransactionError on failure."
+    return _first_bit(await client.read_discrete_inputs(address=0, count=1))
+
+async def read_lower_sensor(client:AsyncModbusTcpClient) -> bool:
+    "Reads the lower water sensor. Raises ModbusTransactionError on failure."
+    return _first_bit(await client.read_discrete_inputs(address=1, count=1))
+
+async def read_sensors(client:AsyncModbusTcpClient) -> tuple[bool,bool]:
+    "Reads both water sensors in one request, returning (upper, lower). Raises ModbusTransactionError on failure."
+    pdu = await client.read_discrete_inputs(address=0, count=2)
+    if pdu.isError() or len(pdu.bits) < 2:
+        raise ModbusTransactionError(pdu)
+    return pdu.bits[0], pdu.bits[1]
+
+async def read_pump(client:AsyncModbusTcpClient) -> bool:
+    "Reads whether the water pump is active. Raises ModbusTransactionError on failure."
+    return _first_bit(await client.read_coils(address=0, count=1))
+
+async def write_pump(client:AsyncModbusTcpClient, activate:bool) -> None:
+    "Sets the water pump to be active or deactivated. Raises ModbusTransactionError on failure."
+    pdu = await client.write_coil(address=0, value=activate)
+    if pdu.isError():
+        raise ModbusTransactionError(pdu)